@@ -121,8 +121,8 @@ class SfnPipelineDataService
 
     @stage_names = []
     @stage_job_statuses = []
-    @stages_wdl_info = []
     @host_filtering_stage_index = nil
+    stage_wdls = []
 
     @pipeline_run.pipeline_run_stages.each_with_index do |stage, stage_index|
       if stage.name != PipelineRunStage::EXPT_STAGE_NAME || see_experimental
@@ -132,12 +132,13 @@ class SfnPipelineDataService
         end
 
         stage_wdl = retrieve_wdl(stage.dag_name, s3_folder)
-        stage_info = parse_wdl(stage_wdl)
-        @stages_wdl_info.push(stage_info)
+        stage_wdls.push(stage_name: stage.name, wdl_text: stage_wdl)
 
         @stage_job_statuses.push(stage.job_status)
       end
     end
+    # Parse all stages in one invocation of the WDL parser, which parses them in parallel
+    @stages_wdl_info = parse_wdl_batch(stage_wdls)
 
     # get results folder files
     @result_files = {}
@@ -529,16 +530,16 @@ class SfnPipelineDataService
     return wdl
   end
 
-  def parse_wdl(wdl)
+  def parse_wdl_batch(stage_wdls)
     stdout, stderr, status = Open3.capture3(
-      WDL_PARSER,
-      stdin_data: wdl
+      WDL_PARSER, "--batch",
+      stdin_data: stage_wdls.to_json
     )
     unless status.success?
       raise ParseWdlError, stderr
     end
 
     parsed = JSON.parse(stdout)
-    return parsed
+    return stage_wdls.map { |stage_wdl| parsed[stage_wdl[:stage_name]] }
   end
 end
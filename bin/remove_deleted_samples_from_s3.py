@@ -1,83 +1,297 @@
 #!/usr/bin/env python
-import os
+import random
+import re
+import subprocess
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 ENV = "sandbox"  # change to prod as necessary
-DB_SAMPLES_FILENAME = "/tmp/{env}_db_sample_ids".format(env=ENV)
-S3_SAMPLES_FILENAME = "/tmp/{env}_s3_sample_paths".format(env=ENV)
+# Streams the ids in order; --quick makes mysql print rows as the server sends them, like a
+# server-side cursor, instead of buffering the whole result first
+DB_SAMPLE_IDS_COMMAND = (
+    "bin/clam {env} 'mysql --quick --batch --skip-column-names -h $RDS_ADDRESS -u $DB_USERNAME"
+    ' --password=$DB_PASSWORD idseq_{env} -e "select id from samples order by id"\''
+).format(env=ENV)
+DB_FETCH_SIZE = 10000
+# Sample directories are named after their ids; anything else is reported and left alone
+SAMPLE_ID_PATTERN = re.compile(r"[1-9][0-9]{0,17}")
+S3_BUCKET = "idseq-samples-{env}".format(env=ENV)
+SAMPLES_PREFIX = "samples/"
+# Projects are listed concurrently, each by one thread
+S3_LIST_WORKERS = 32
+# Sample prefixes are deleted concurrently, each by one thread
+DELETE_WORKERS = 16
+DELETE_BATCH_SIZE = 1000  # the most keys delete_objects accepts
+# A prefix is listed and deleted again until a listing comes back empty, at most this many times
+MAX_DELETE_PASSES = 3
+MAX_RETRIES = 8
+RETRYABLE_ERROR_CODES = {"SlowDown", "ServiceUnavailable", "InternalError", "RequestTimeout"}
+
+
+def sample_id_array(ids):
+    """Pack sample ids into a sorted array of 64-bit integers, sorting only if they came unsorted."""
+    ids = array("q", ids)
+    if any(a > b for a, b in zip(ids, islice(ids, 1, None))):
+        ids = array("q", sorted(ids))
+    return ids
 
 
-def fetch_sample_ids():
+def fetch_sample_ids(command=DB_SAMPLE_IDS_COMMAND):
+    """Stream the ids of the samples table out of mysql into a sorted array."""
     print("Fetching ids from idseq_{env}.samples table".format(env=ENV))
-    os.system(
-        (
-            'bin/clam {env} \'echo "select id from samples;" > samples.sql; mysql -h $RDS_ADDRESS -u $DB_USERNAME'
-            "--password=$DB_PASSWORD idseq_{env} < samples.sql; rm samples.sql' > {outfile}"
-        ).format(outfile=DB_SAMPLES_FILENAME, env=ENV)
-    )
+    with subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, universal_newlines=True) as process:
+        # Anything but an id fails here, rather than making every sample look deleted
+        ids = sample_id_array(int(line) for line in process.stdout if line.strip())
+    if process.returncode:
+        raise RuntimeError("Fetching sample ids failed with exit status {status}".format(status=process.returncode))
+    return ids
 
 
-def fetch_s3_paths():
-    print("Fetching sample paths under s3://idseq-samples-{env}".format(env=ENV))
-    os.system(
-        (
-            "for dir in `aws s3 ls s3://idseq-samples-{env}/samples/ | awk '{{print $2}}'`;"
-            "do aws s3 ls s3://idseq-samples-{env}/samples/$dir | awk -v dir=$dir '{{print dir $2}}';"
-            "done > {outfile}"
-        ).format(outfile=S3_SAMPLES_FILENAME, env=ENV)
-    )
+def fetch_sample_ids_from_connection(connection, fetch_size=DB_FETCH_SIZE):
+    """Stream the ids of the samples table through a DB-API connection into a sorted array.
 
+    Memory only stays flat with server-side cursors, such as those of a pymysql connection with
+    cursorclass=pymysql.cursors.SSCursor; sqlite3 connections work too.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("select id from samples order by id")
 
-def db_sample_dict():
-    return_dict = {}
-    db_samples_file = open(DB_SAMPLES_FILENAME, "r")
-    line = db_samples_file.readline()  # first line says 'id'
-    while True:
-        line = db_samples_file.readline().strip()
-        if not line:
-            break
-        return_dict[line] = 1
-    return return_dict
-
-
-def delete_unknown_samples(dryrun):
-    s3 = boto3.resource("s3")
-    pd = db_sample_dict()
-    bucket = "idseq-samples-{env}".format(env=ENV)
-    s3_samples_file = open(S3_SAMPLES_FILENAME, "r")
-    while True:
-        line = s3_samples_file.readline()
-        if not line:
+        def ids():
+            rows = cursor.fetchmany(fetch_size)
+            while rows:
+                for (sample_id,) in rows:
+                    yield sample_id
+                rows = cursor.fetchmany(fetch_size)
+
+        return sample_id_array(ids())
+    finally:
+        cursor.close()
+
+
+def s3_client(max_workers=S3_LIST_WORKERS):
+    # boto3 clients are thread safe; a single one is shared, with a pooled connection per worker
+    return boto3.client("s3", config=Config(max_pool_connections=max_workers))
+
+
+def list_common_prefixes(client, bucket, prefix):
+    """The names of the "directories" directly under prefix, without the prefix or trailing slash."""
+    paginator = client.get_paginator("list_objects_v2")
+    names = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        for common_prefix in page.get("CommonPrefixes", []):
+            names.append(common_prefix["Prefix"][len(prefix):].rstrip("/"))
+    return names
+
+
+def fetch_s3_samples(client=None, bucket=S3_BUCKET, max_workers=S3_LIST_WORKERS):
+    """Yield (project, sample_id) for every sample directory under samples/ in the bucket.
+
+    The samples of every project are listed on a thread pool, and yielded as each project is done.
+    """
+    print("Fetching sample paths under s3://{bucket}".format(bucket=bucket))
+    client = client or s3_client(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(list_common_prefixes, client, bucket, SAMPLES_PREFIX + project + "/"): project
+            for project in list_common_prefixes(client, bucket, SAMPLES_PREFIX)
+        }
+        for future in as_completed(futures):
+            project = futures[future]
+            for sample_id in future.result():
+                yield project, sample_id
+
+
+def parse_s3_samples(s3_samples):
+    """Sort (project, sample_id) pairs by sample id, as (id, project, sample_id) tuples.
+
+    Returns them with the pairs whose sample_id isn't a sample id.
+    """
+    parsed = []
+    malformed = []
+    for project, sample_id in s3_samples:
+        if SAMPLE_ID_PATTERN.fullmatch(sample_id):
+            parsed.append((int(sample_id), project, sample_id))
+        else:
+            malformed.append((project, sample_id))
+    parsed.sort()
+    return parsed, malformed
+
+
+def find_orphan_samples(s3_samples, db_ids):
+    """Yield the (project, sample_id) of the S3 samples without a db entry.
+
+    s3_samples come from parse_s3_samples and db_ids are sorted, so both are walked once, in step.
+    """
+    db_ids = iter(db_ids)
+    db_id = next(db_ids, None)
+    for sample_id, project, name in s3_samples:
+        while db_id is not None and db_id < sample_id:
+            db_id = next(db_ids, None)
+        if db_id != sample_id:
+            yield project, name
+
+
+class Throttle:
+    """Delay shared by the deletion threads, doubled on every SlowDown and halved on every success."""
+
+    def __init__(self, min_delay=0.05, max_delay=20.0):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay:
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def slow_down(self):
+        with self.lock:
+            self.delay = min(max(self.delay * 2, self.min_delay), self.max_delay)
+
+    def succeeded(self):
+        with self.lock:
+            self.delay = self.delay / 2 if self.delay > self.min_delay else 0.0
+
+
+def iter_object_versions(client, bucket, prefix):
+    """Yield the Key and VersionId of every version and delete marker under prefix.
+
+    The paginator follows NextKeyMarker and NextVersionIdMarker, so every page is listed once.
+    """
+    paginator = client.get_paginator("list_object_versions")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for entry in page.get("Versions", []) + page.get("DeleteMarkers", []):
+            yield {"Key": entry["Key"], "VersionId": entry["VersionId"]}
+
+
+def delete_batch(client, bucket, objects, throttle):
+    """Delete up to DELETE_BATCH_SIZE object versions, retrying throttled requests and keys.
+
+    Returns the number of versions deleted and Errors entries for the ones that weren't.
+    """
+    deleted = 0
+    failed = []
+    for attempt in range(MAX_RETRIES + 1):
+        throttle.wait()
+        try:
+            resp = client.delete_objects(Bucket=bucket, Delete={"Objects": objects, "Quiet": True})
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in RETRYABLE_ERROR_CODES or attempt == MAX_RETRIES:
+                return deleted, failed + [dict(obj, Code=code, Message=str(e)) for obj in objects]
+            throttle.slow_down()
+            continue
+        # Quiet responses only list the keys that failed
+        errors = resp.get("Errors", [])
+        deleted += len(objects) - len(errors)
+        retryable = [error for error in errors if error.get("Code") in RETRYABLE_ERROR_CODES]
+        failed.extend(error for error in errors if error.get("Code") not in RETRYABLE_ERROR_CODES)
+        if not retryable:
+            throttle.succeeded()
+            return deleted, failed
+        if attempt == MAX_RETRIES:
+            return deleted, failed + retryable
+        throttle.slow_down()
+        objects = [{"Key": error["Key"], "VersionId": error["VersionId"]} for error in retryable]
+
+
+def delete_prefix(client, bucket, prefix, throttle):
+    """Delete every version and delete marker under prefix, in batches, and account for the errors.
+
+    Versions are deleted while the listing is paged through, and the prefix is listed again
+    afterwards to catch anything written meanwhile or left behind by throttled batches. Versions
+    that failed to delete aren't tried again.
+    """
+    report = {"prefix": prefix, "deleted": 0, "batches": 0, "failed_batches": 0, "errors": [], "remaining": 0}
+    failed = set()
+    emptied = False
+    for _ in range(MAX_DELETE_PASSES):
+        versions = (
+            version
+            for version in iter_object_versions(client, bucket, prefix)
+            if (version["Key"], version["VersionId"]) not in failed
+        )
+        batch = list(islice(versions, DELETE_BATCH_SIZE))
+        if not batch:
+            emptied = True
             break
-        sample_id = line.split("/")[1]
-        if sample_id not in pd:
-            subpath = line.strip()
+        while batch:
+            report["batches"] += 1
+            deleted, errors = delete_batch(client, bucket, batch, throttle)
+            report["deleted"] += deleted
+            if errors:
+                report["failed_batches"] += 1
+                report["errors"].extend(errors)
+                failed.update((error.get("Key"), error.get("VersionId")) for error in errors)
+            batch = list(islice(versions, DELETE_BATCH_SIZE))
+    if failed or not emptied:
+        report["remaining"] = sum(1 for _ in iter_object_versions(client, bucket, prefix))
+    return report
+
+
+def delete_prefixes(client, bucket, prefixes, max_workers=DELETE_WORKERS, throttle=None):
+    """Delete everything under each of the prefixes on a pool of threads; yields a report per prefix.
+
+    Only a bounded number of prefixes are queued at a time, so prefixes can be streamed in.
+    """
+    throttle = throttle or Throttle()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for prefix in prefixes:
+            pending.append(executor.submit(delete_prefix, client, bucket, prefix, throttle))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def delete_unknown_samples(orphan_samples, dryrun, client=None):
+    orphan_prefixes = (
+        "{prefix}{project}/{sample_id}/".format(prefix=SAMPLES_PREFIX, project=project, sample_id=sample_id)
+        for project, sample_id in orphan_samples
+    )
+    if dryrun:
+        for prefix in orphan_prefixes:
+            print("Found: {bucket}/{prefix}".format(bucket=S3_BUCKET, prefix=prefix))
+        return
+
+    totals = {"prefixes": 0, "deleted": 0, "batches": 0, "failed_batches": 0, "errors": 0, "remaining": 0}
+    client = client or s3_client(max(S3_LIST_WORKERS, DELETE_WORKERS))
+    for report in delete_prefixes(client, S3_BUCKET, orphan_prefixes):
+        print(
+            "Deleted: {bucket}/{prefix} ({deleted} object versions in {batches} batches)".format(
+                bucket=S3_BUCKET, **report
+            )
+        )
+        for error in report["errors"]:
             print(
-                "{verb}: idseq-samples-{env}/samples/{subpath}".format(
-                    verb="Found" if dryrun else "Deleting", env=ENV, subpath=subpath
+                " Error: {key} {version}: {code} {message}".format(
+                    key=error.get("Key", ""),
+                    version=error.get("VersionId", ""),
+                    code=error.get("Code"),
+                    message=error.get("Message", ""),
                 )
             )
-            if not dryrun:
-                while True:
-                    resp = s3.meta.client.list_object_versions(
-                        Bucket=bucket, Prefix="samples/{subpath}".format(subpath=subpath)
-                    )
-                    objects_to_delete = resp.get("Versions", [])
-                    if len(objects_to_delete) == 0:
-                        break
-
-                    delete_keys = {"Objects": []}
-                    count = 0
-                    for item in objects_to_delete:
-                        delete_keys["Objects"].append({"Key": item["Key"], "VersionId": item["VersionId"]})
-                        count += 1
-                        if count == 1000:  # s3 API only returns and accepts up to 1000 objects at a time
-                            break
-
-                    print(" Deleting {count} objects".format(count=count))
-                    s3.meta.client.delete_objects(Bucket=bucket, Delete=delete_keys)
-                    if count < 1000:  # if we deleted fewer than 1000 objects then no need to check the path again
-                        break
+        if report["remaining"]:
+            print(" {remaining} object versions remain".format(remaining=report["remaining"]))
+        totals["prefixes"] += 1
+        totals["errors"] += len(report["errors"])
+        for name in ["deleted", "batches", "failed_batches", "remaining"]:
+            totals[name] += report[name]
+    print(
+        "Deleted {deleted} object versions under {prefixes} prefixes in {batches} batches; "
+        "{failed_batches} batches had {errors} errors and {remaining} object versions remain".format(**totals)
+    )
 
 
 if __name__ == "__main__":
@@ -89,8 +303,20 @@ if __name__ == "__main__":
     if resp.lower() not in ["y", "yes"]:
         print("Exiting...")
         quit()
-    fetch_s3_paths()
-    fetch_sample_ids()
-    delete_unknown_samples(dryrun=True)
+    # Found once, for both the dry run and the deletion
+    s3_samples, malformed = parse_s3_samples(fetch_s3_samples())
+    for project, name in malformed:
+        print(
+            "Skipping: {bucket}/{prefix}{project}/{name}/ is not named after a sample id".format(
+                bucket=S3_BUCKET, prefix=SAMPLES_PREFIX, project=project, name=name
+            )
+        )
+    db_ids = fetch_sample_ids()
+    if not db_ids:
+        print("No sample ids fetched; exiting...")
+        quit()
+    orphan_samples = list(find_orphan_samples(s3_samples, db_ids))
+    del s3_samples, db_ids
+    delete_unknown_samples(orphan_samples, dryrun=True)
     input("Press enter to continue")
-    delete_unknown_samples(dryrun=False)
+    delete_unknown_samples(orphan_samples, dryrun=False)
@@ -6,6 +6,31 @@
 # To use, just pass the full text of a WDL file through stdin - e.g. using Open3
 # for Ruby.
 #
+# To avoid paying interpreter startup and `import WDL` on every call, the script can also run
+# as a long-lived parse server with --serve. It then reads newline-delimited JSON requests of the
+# form {"id": ..., "wdl": "<full WDL text>", "format": "flat" | "graph"} and answers each with one line of JSON,
+# {"id": ..., "result": {...}} on success or {"id": ..., "error": "..."} on failure, where
+# "result" is exactly what a one-shot invocation would print. Requests are read from stdin by
+# default, or from connections to a local Unix socket when --socket PATH is given.
+#
+# Parse results can be kept in a bounded on-disk cache with --cache-dir. Entries are keyed on a
+# hash of the WDL text plus the installed miniwdl version, so a hit skips WDL.load entirely, and
+# the least recently used entries are evicted once the cache is full. Use --warm to fill the cache
+# ahead of time from local WDL files/directories or s3://bucket/workflow-vX.Y.Z folders.
+#
+# With --batch, stdin instead holds a JSON array of {"stage_name": ..., "wdl_text": ...} objects,
+# one per stage of a pipeline run. The stages are parsed concurrently in a process pool and the
+# output is one JSON object mapping each stage_name to the JSON described above.
+#
+# WDL imports are resolved from the directories given with --import-dir, or from a bundle: with
+# --bundle, stdin holds {"wdl_text": "<main document>", "imports": {"<import uri>": "<text>"}}
+# instead of the bare WDL text. Server requests and batch stages may also carry an "imports" dict.
+#
+# Startup is kept short for one-shot invocations: miniwdl is only imported once a document
+# actually has to be parsed, so a cache hit answers without importing it at all. With
+# --cache-dir, miniwdl's compiled Lark parsers are also serialized under <cache-dir>/grammar and
+# reused by later processes instead of being rebuilt from the grammar every time.
+#
 # The JSON output is as follows:
 # {
 #   'inputs': [], array of strings, external input variables for the WDL workflow
@@ -17,8 +42,27 @@
 #   'outputs': { 'output_name' : 'internal.name' }, a dict where each key is the name
 #            of an output variable and the value is the name of the variable internally
 #            in the workflow
+#   'scattered_tasks': [], array of strings, names of the tasks called inside a scatter block;
+#            their outputs are gathered into arrays with one file per shard
 # }
 #
+# Calls to sub-workflows appear as a single task named after the call. Their outputs are named
+# 'CallName.output_name' like task outputs, with basenames taken from the sub-workflow's tasks.
+#
+# With --format graph, the output also has a 'graph' key holding the same information as a
+# normalized DAG, so consumers don't have to rebuild edges by splitting 'TaskName.var' keys:
+# {
+#   'nodes': [{'id': ..., 'type': 'task' | 'input', ...}], task nodes in task_names order with
+#            their 'index' and 'scattered' flag, then one node per workflow input with its type
+#   'edges': [{'from': node_id, 'to': task_name, 'variables': [...], 'files': [...]}], one edge per
+#            connected pair of nodes, with the variables passed along it and their file basenames
+#   'topological_order': [], task names ordered so every task comes after the tasks it depends on
+#   'outputs': [{'name': ..., 'from': task_name, 'variable': ..., 'file': ...}], where each workflow
+#            output comes from
+# }
+# The graph is derived from the flat output, so it is computed after a parse cache lookup and
+# the cache stays independent of the output format.
+#
 # Variables that are files output by a task in the workflow are named according to the scheme
 # 'TaskName.variable_name'. Workflow inputs and outputs do not have a dot in the name, they are
 # simply 'words_separated_by_underscores'. For consistency and to be explicit about where
@@ -27,15 +71,59 @@
 # previous WDL workflow in the run.
 
 import sys
-import WDL
+import os
+import hashlib
+import heapq
+import importlib
+import tempfile
+import argparse
+import signal
+import socketserver
+import io
 import json
 
 # function names we can parse for Apply expressions
 SELECT_ALL = "select_all"
 SELECT_FIRST = "select_first"
 DEFINED = "defined"
+FLATTEN = "flatten"
 GLOB = "glob"
 
+# Bump this whenever the parsed JSON format changes so stale cache entries are never served
+CACHE_FORMAT_VERSION = 4
+DEFAULT_CACHE_MAX_ENTRIES = 512
+
+WORKFLOW_INPUT_PREFIX = "WorkflowInput"
+OUTPUT_FORMATS = ["flat", "graph"]
+
+
+class LazyModule:
+    """Stands in for a module that is slow to import, and imports it on first attribute access.
+
+    The real module then replaces this stand-in in the module globals under the same name, so
+    only the first access goes through __getattr__.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._import_hooks = []
+
+    def on_import(self, hook):
+        self._import_hooks.append(hook)
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        if globals().get(self._name) is self:
+            globals()[self._name] = module
+            for hook in self._import_hooks:
+                hook(module)
+        return getattr(module, attr)
+
+
+# importing miniwdl pulls in lark, the WDL grammar and the standard library, which is most of the
+# runtime of a one-shot invocation; defer it until a document actually needs to be parsed
+WDL = LazyModule("WDL")
+
 
 class NoWorkflowError(Exception):
     def __init__(self, msg):
@@ -43,6 +131,12 @@ class NoWorkflowError(Exception):
         self.msg = msg
 
 
+class StageParseError(Exception):
+    def __init__(self, msg):
+        super(StageParseError, self).__init__(msg)
+        self.msg = msg
+
+
 # We use this custom source reader to pass in input from stdin
 # Expects the entire text of the WDL file in stdin
 # 'path' and 'importer' are required args for a function
@@ -53,17 +147,73 @@ async def read_stdin(uri, _path, _importer):
     return WDL.ReadSourceResult(wdl, uri)
 
 
+def make_text_reader(wdl_text, imports=None):
+    """Like read_stdin, but serves WDL text that was already read, e.g. from a server request.
+    Imports are looked up by URI in the `imports` bundle, then on disk if an import path was given."""
+
+    async def read_text(uri, path, importer):
+        if importer is None:
+            return WDL.ReadSourceResult(wdl_text, uri)
+        if imports and uri in imports:
+            return WDL.ReadSourceResult(imports[uri], uri)
+        if path:
+            return await WDL.read_source_default(uri, path, importer)
+        raise FileNotFoundError(f"Import {uri} is not in the bundle and no import directory was given")
+
+    return read_text
+
+
 def insert_declarations(task_inputs, decls):
     """Replace the reference to a variable declared in the workflow (e.g. gsnap_filter_input)
-    with all the possible inputs."""
-    for decl, inputs in decls.items():
-        for task in task_inputs.keys():
-            if f"WorkflowInput.{decl}" in task_inputs[task]:
-                task_inputs[task].remove(f"WorkflowInput.{decl}")
-                task_inputs[task].extend(inputs)
+    with all the possible inputs, following declarations that refer to other declarations."""
+    resolved = resolve_declarations(decls)
+    # Index which tasks refer to each declaration, so only those tasks get rewritten
+    tasks_by_decl = {}
+    for task, inputs in task_inputs.items():
+        for key in inputs:
+            if key in resolved:
+                tasks_by_decl.setdefault(key, []).append(task)
+    for task in dict.fromkeys(task for tasks in tasks_by_decl.values() for task in tasks):
+        task_inputs[task] = expand_inputs(task_inputs[task], resolved)
     return task_inputs
 
 
+def resolve_declarations(decls):
+    """Map each 'WorkflowInput.<decl>' key to the task outputs and workflow inputs it can take,
+    with references to other declarations expanded in place, in order and without duplicates."""
+    keys = {f"WorkflowInput.{decl}": inputs for decl, inputs in decls.items()}
+    resolved = {}
+    for key in keys:
+        # Depth-first walk with an explicit stack; each declaration is expanded exactly once. An entry
+        # (decl, True) marks decl as in progress: its references are above it on the stack
+        stack = [(key, False)]
+        in_progress = set()
+        while stack:
+            current, references_done = stack.pop()
+            if current in resolved:
+                continue
+            if references_done:
+                # Only in-progress references are cycles, which miniwdl rejects; drop them defensively
+                resolved[current] = expand_inputs([ref for ref in keys[current] if ref not in in_progress], resolved)
+                in_progress.discard(current)
+                continue
+            if current in in_progress:
+                continue
+            in_progress.add(current)
+            stack.append((current, True))
+            stack.extend(
+                (ref, False) for ref in keys[current] if ref in keys and ref not in resolved and ref not in in_progress
+            )
+    return resolved
+
+
+def expand_inputs(inputs, resolved):
+    expanded = []
+    for key in inputs:
+        expanded.extend(resolved.get(key, [key]))
+    return list(dict.fromkeys(expanded))
+
+
 def get_workflow_input_information(inputs):
     input_info = {}
     for workflow_input in inputs:
@@ -77,160 +227,721 @@ def get_task_information(workflow):
     task_inputs = {}
     task_names = []
     declarations = {}
+    scattered_tasks = []
+    # share one walker across the workflow so common subexpressions are only walked once
+    walker = ReferenceWalker()
     for task in workflow:
         # each object in doc.workflow.body is a task
-        task_information = parse_workflow_task(task)
+        task_information = parse_workflow_task(task, walker)
         for info in task_information:
             if info["type"] == WDL.Tree.Decl:
                 declarations[info["name"]] = info["inputs"]
             else:
                 task_inputs[info["name"]] = info["inputs"]
                 task_names.append(info["name"])
-    return task_inputs, task_names, declarations
+                if info.get("scattered"):
+                    scattered_tasks.append(info["name"])
+    return task_inputs, task_names, declarations, scattered_tasks
 
 
-def parse_workflow_task(task):
+def parse_workflow_task(task, walker):
     if isinstance(task, WDL.Tree.Call):
-        return read_call_task(task)
+        return read_call_task(task, walker)
     elif isinstance(task, WDL.Tree.Conditional):
-        return read_conditional_task(task)
+        return read_conditional_task(task, walker)
+    elif isinstance(task, WDL.Tree.Scatter):
+        return read_scatter_task(task, walker)
     elif isinstance(task, WDL.Tree.Decl):
-        return read_declaration_task(task)
+        return read_declaration_task(task, walker)
 
 
-def read_call_task(call):
+def read_call_task(call, walker):
     task = {}
     task["name"] = call.name
     task["inputs"] = []
     task["type"] = type(call)
     for short_name, reference in call.inputs.items():
-        reference_strings = parse_input_item(reference)
+        reference_strings = walker.references(reference)
         for reference_string in reference_strings:
-            expression_components = reference_string.split(".")
-            output_var = None
-            output_from = None
-
-            if len(expression_components) > 1:  # The file comes from another task in this stage
-                output_from = expression_components[0]
-                output_var = expression_components[1]
-            else:
-                output_from = "WorkflowInput"
-                output_var = reference_string
-
             # add to files list
-            key = ".".join([output_from, output_var])
-            task["inputs"].append(key)
+            task["inputs"].append(get_reference_key(reference_string))
     return [task]
 
 
-def read_conditional_task(conditional):
+def get_reference_key(reference_string):
+    expression_components = reference_string.split(".")
+    output_var = None
+    output_from = None
+
+    if len(expression_components) > 1:  # The file comes from another task in this stage
+        output_from = expression_components[0]
+        output_var = expression_components[1]
+    else:
+        output_from = "WorkflowInput"
+        output_var = reference_string
+
+    return ".".join([output_from, output_var])
+
+
+def read_conditional_task(conditional, walker):
     tasks = []
     for item in conditional.body:
-        tasks.extend(parse_workflow_task(item))
+        tasks.extend(parse_workflow_task(item, walker))
+    return tasks
+
+
+def read_scatter_task(scatter, walker):
+    # References to the scatter variable in the body are replaced here by whatever the scattered
+    # collection comes from. The variable is only in scope inside the body, and sibling scatters can
+    # reuse its name, so it doesn't go into the workflow's declarations
+    variable_key = get_reference_key(scatter.variable)
+    variable = {
+        variable_key: [get_reference_key(reference_string) for reference_string in walker.references(scatter.expr)]
+    }
+    tasks = []
+    for item in scatter.body:
+        for task in parse_workflow_task(item, walker):
+            if variable_key in task["inputs"]:
+                task["inputs"] = expand_inputs(task["inputs"], variable)
+            if task["type"] != WDL.Tree.Decl:
+                task["scattered"] = True
+            tasks.append(task)
     return tasks
 
 
-def read_declaration_task(declaration):
+def read_declaration_task(declaration, walker):
     decl = {}
     decl["name"] = declaration.name
-    decl["inputs"] = []
     decl["type"] = type(declaration)
-    expression = declaration.expr
-    if type(expression) == WDL.Expr.IfThenElse:
-        decl["inputs"].extend(parse_input_item(expression.consequent))
-        decl["inputs"].extend(parse_input_item(expression.alternative))
+    reference_strings = walker.references(declaration.expr) if declaration.expr else []
+    decl["inputs"] = [get_reference_key(reference_string) for reference_string in reference_strings]
     return [decl]
 
 
-def parse_input_item(reference):
+# Handlers for the Apply expressions (function calls) we can parse, keyed by function name.
+# Each returns the argument expressions whose references flow through to the result; calls to
+# functions without a handler, e.g. defined() or comparisons, don't pass any files along.
+APPLY_HANDLERS = {}
+
+
+def register_apply_handler(*function_names):
+    def register(handler):
+        for function_name in function_names:
+            APPLY_HANDLERS[function_name] = handler
+        return handler
+
+    return register
+
+
+@register_apply_handler(SELECT_ALL, SELECT_FIRST, FLATTEN)
+def first_argument(apply_exp):
+    return apply_exp.arguments[:1]
+
+
+@register_apply_handler(DEFINED)
+def no_arguments(apply_exp):
+    return []
+
+
+def get_child_expressions(reference):
     if isinstance(reference, WDL.Expr.Get):
-        return parse_get_expression(reference)
+        return [reference.expr]  # member access on a pair or struct
     elif isinstance(reference, WDL.Expr.Apply):
-        return parse_apply_expression(reference)
+        handler = APPLY_HANDLERS.get(str(reference.function_name), no_arguments)
+        return handler(reference)
     elif isinstance(reference, WDL.Expr.Array):
-        return parse_array_expression(reference)
-    elif isinstance(reference, (WDL.Expr.String, WDL.Expr.Int, WDL.Expr.Float, WDL.Expr.Boolean)):
+        return reference.items
+    elif isinstance(reference, WDL.Expr.IfThenElse):
+        return [reference.consequent, reference.alternative]
+    elif isinstance(reference, WDL.Expr.String):
+        # interpolated parts of a string, e.g. "~{RunTask.output_prefix}.fa"
+        return [part.expr for part in reference.parts if isinstance(part, WDL.Expr.Placeholder)]
+    elif isinstance(reference, WDL.Expr.Pair):
+        return [reference.left, reference.right]
+    elif isinstance(reference, WDL.Expr.Map):
+        return [item for key_value in reference.items for item in key_value]
+    elif isinstance(reference, WDL.Expr.Struct):
+        return list(reference.members.values())
+    elif isinstance(reference, (WDL.Expr.Int, WDL.Expr.Float, WDL.Expr.Boolean)):
         return []  # ignore hard-coded constants
 
     raise Exception(f"Unsupported reference: {reference}")
 
 
-def parse_get_expression(get_exp):
-    expression = get_exp.expr
-    if isinstance(expression, WDL.Expr.Ident):
-        return [str(expression.name)]
-
-
-def parse_apply_expression(apply_exp):
-    function_name = str(apply_exp.function_name)
-    if function_name == SELECT_ALL or function_name == SELECT_FIRST:
-        return parse_array_expression(apply_exp.arguments[0])
-    elif function_name == DEFINED:
-        return []
+class ReferenceWalker:
+    """Collects the names of the variables an expression refers to, in source order.
+
+    The expression tree is walked with an explicit stack into a single output list, so wide or
+    deeply nested expressions don't hit the recursion limit. Results are memoized by node
+    identity, so a subexpression reached more than once is only walked the first time.
+    """
+
+    def __init__(self):
+        # id(node) -> (node, references); the node is kept so its id can't be reused
+        self.memo = {}
+
+    def references(self, expression):
+        references = []
+        stack = [(expression, None)]
+        while stack:
+            node, start = stack.pop()
+            if start is not None:
+                # every child of node has been walked; its references are everything since start
+                self.memo[id(node)] = (node, references[start:])
+                continue
+            if isinstance(node, WDL.Expr.Get) and isinstance(node.expr, WDL.Expr.Ident):
+                references.append(str(node.expr.name))
+                continue
+            memoized = self.memo.get(id(node))
+            if memoized is not None:
+                references.extend(memoized[1])
+                continue
+            stack.append((node, len(references)))
+            stack.extend((child, None) for child in reversed(get_child_expressions(node)))
+        return references
 
 
-def parse_array_expression(array_exp):
-    items = []
-    for item in array_exp.children:
-        items.extend(parse_input_item(item))
-    return items
+def parse_input_item(reference):
+    return ReferenceWalker().references(reference)
 
 
 def get_file_basenames(task_inputs):
     # collect filenames
     basenames = {}
     for task in task_inputs:
-        # add parsing for globs
-        output_name_mapping = [
-            (output.name, output.expr.parts[1]) for output in task.outputs if isinstance(output.type, WDL.Type.File)
-        ]
-        output_name_mapping.extend(
-            [
-                (output.name, output.expr.arguments[0].parts[1])
-                for output in task.outputs
-                if isinstance(output.type, WDL.Type.Array) and output.expr.function_name == GLOB
-            ]
-        )
-        for var_name, filename in output_name_mapping:
+        for var_name, filename in get_task_output_filenames(task):
             key = ".".join([task.name, var_name])
             basenames[key] = filename
     return basenames
 
 
+def get_task_output_filenames(task):
+    # add parsing for globs
+    output_name_mapping = [
+        (output.name, output.expr.parts[1]) for output in task.outputs if isinstance(output.type, WDL.Type.File)
+    ]
+    output_name_mapping.extend(
+        [
+            (output.name, output.expr.arguments[0].parts[1])
+            for output in task.outputs
+            if isinstance(output.type, WDL.Type.Array) and output.expr.function_name == GLOB
+        ]
+    )
+    return output_name_mapping
+
+
+def get_call_basenames(workflow):
+    """Collect filenames for every call in the workflow, keyed by call name rather than task name,
+    including calls nested in conditionals and scatters, calls to imported tasks and sub-workflows."""
+    basenames = {}
+    for call in get_workflow_calls(workflow.body):
+        if isinstance(call.callee, WDL.Tree.Workflow):
+            # a sub-workflow's outputs are aliases for outputs of the calls inside it
+            inner_basenames = get_call_basenames(call.callee)
+            for output_name, alias in get_output_aliases(call.callee.outputs).items():
+                if alias in inner_basenames:
+                    basenames[".".join([call.name, output_name])] = inner_basenames[alias]
+        else:
+            for var_name, filename in get_task_output_filenames(call.callee):
+                basenames[".".join([call.name, var_name])] = filename
+    return basenames
+
+
+def get_workflow_calls(body):
+    stack = list(reversed(body))
+    while stack:
+        node = stack.pop()
+        if isinstance(node, WDL.Tree.Call):
+            yield node
+        elif isinstance(node, (WDL.Tree.Conditional, WDL.Tree.Scatter)):
+            stack.extend(reversed(node.body))
+
+
 def get_output_aliases(outputs):
     # collect stage output aliases
     aliases = {}
     for output in outputs:
         # add parsing for arrays
         if type(output.type) in [WDL.Type.File, WDL.Type.Array]:
-            alias = output.expr.expr.name
+            if isinstance(output.expr, WDL.Expr.Get) and isinstance(output.expr.expr, WDL.Expr.Ident):
+                alias = output.expr.expr.name
+            else:
+                # e.g. flatten() or select_all() over the gathered outputs of a scatter
+                references = parse_input_item(output.expr)
+                if len(references) != 1:
+                    continue
+                alias = references[0]
             aliases[output.name] = alias
     return aliases
 
 
-def main():
-    # load WDL document
-    doc = WDL.load("stdin", read_source=read_stdin)
+class DiskBackedLarkCache(dict):
+    """Drop-in replacement for miniwdl's in-memory cache of compiled Lark parsers, keyed by
+    (grammar, start symbol), that also keeps each parser serialized in cache_dir.
+
+    Building the LALR tables for the WDL grammar takes much longer than loading them back, so
+    every process after the first one skips it. Only point this at a directory the app controls,
+    since the files are pickles.
+    """
+
+    def __init__(self, cache_dir, parser_module, *args):
+        super(DiskBackedLarkCache, self).__init__(*args)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.parser_module = parser_module
+        self._salt = f"{get_miniwdl_version()}:{parser_module.lark.__version__}:".encode("utf-8")
+
+    def _path(self, key):
+        grammar, start = key
+        digest = hashlib.sha256(self._salt + f"{start}:{grammar}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.lark")
+
+    def __contains__(self, key):
+        if super(DiskBackedLarkCache, self).__contains__(key):
+            return True
+        try:
+            with open(self._path(key), "rb") as f:
+                lark_parser = self.parser_module.lark.Lark.load(f)
+            # Lexer callbacks don't survive serialization; reattach the one miniwdl collects comments
+            # with. These are lark and miniwdl internals, so if they've changed, miniwdl builds the
+            # parser itself as if the cache was empty
+            lark_parser.parser.lexer_conf.callbacks = {"COMMENT": self.parser_module._lark_comments_buffer.append}
+            lark_parser.parser.init_lexer()
+        except Exception:
+            return False  # not cached yet, or unreadable; miniwdl rebuilds it and we save it again
+        super(DiskBackedLarkCache, self).__setitem__(key, lark_parser)
+        return True
+
+    def __setitem__(self, key, lark_parser):
+        super(DiskBackedLarkCache, self).__setitem__(key, lark_parser)
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                lark_parser.save(f)
+            os.replace(tmp_path, self._path(key))
+            tmp_path = None
+        except Exception:
+            pass  # the cache is only an optimization
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+
+def cache_grammar(cache_dir):
+    def install(module):
+        # The hook relies on miniwdl internals; if they've changed, or the cache directory can't be
+        # created, parsing goes on with miniwdl's own in-memory cache
+        try:
+            parser_module = module._parser
+            if not isinstance(parser_module._lark_cache, dict) or not hasattr(parser_module, "_lark_comments_buffer"):
+                return
+            parser_module._lark_cache = DiskBackedLarkCache(cache_dir, parser_module, parser_module._lark_cache)
+        except Exception:
+            pass
+
+    if isinstance(WDL, LazyModule):
+        WDL.on_import(install)
+    else:
+        install(WDL)
+
+
+def get_miniwdl_version():
+    try:
+        from importlib import metadata as importlib_metadata
+    except ImportError:  # python < 3.8
+        import importlib_metadata
+    return importlib_metadata.version("miniwdl")
+
+
+class ParseCache:
+    """Bounded on-disk cache of parse results, content-addressed by the WDL text and miniwdl version.
+
+    Each entry is one JSON file whose mtime is refreshed on every hit, so evicting the oldest
+    files first gives LRU behavior that is shared by every process using the same directory.
+    """
+
+    def __init__(self, cache_dir, max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._salt = f"{CACHE_FORMAT_VERSION}:{get_miniwdl_version()}:".encode("utf-8")
+
+    def key(self, wdl_text, imports=None):
+        digest = hashlib.sha256(self._salt + wdl_text.encode("utf-8"))
+        for uri, import_text in sorted((imports or {}).items()):
+            digest.update(f"\0{uri}\0{import_text}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".json")]
+
+    def get(self, wdl_text, imports=None):
+        path = self._path(self.key(wdl_text, imports))
+        try:
+            with open(path) as f:
+                parsed = json.load(f)
+        except (OSError, ValueError):
+            # Missing, or half-written by a process that crashed mid-write; either way a miss
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # evicted by another process in the meantime
+        self.hits += 1
+        return parsed
+
+    def put(self, wdl_text, parsed, imports=None):
+        # Write to a temp file and rename so readers never see a partial entry
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(parsed, f)
+            os.replace(tmp_path, self._path(self.key(wdl_text, imports)))
+            tmp_path = None
+            self.evict()
+        except OSError:
+            pass  # the cache is only an optimization; the parse itself succeeded
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+    def evict(self):
+        entries = self._entries()
+        if len(entries) <= self.max_entries:
+            return
+        mtimes = []
+        for entry in entries:
+            try:
+                mtimes.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass  # evicted by another process sharing the cache directory
+        mtimes.sort()
+        for _, path in mtimes[:max(len(mtimes) - self.max_entries, 0)]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries()),
+            "max_entries": self.max_entries,
+        }
+
+
+def read_wdl_sources(sources):
+    """Yield the text of every WDL document in the given local files/directories and s3:// folders."""
+    for source in sources:
+        if source.startswith("s3://"):
+            import boto3  # only needed when warming from S3
+
+            bucket, _, prefix = source.split("://", 1)[1].partition("/")
+            s3 = boto3.client("s3")
+            paginator = s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix.rstrip("/") + "/"):
+                for item in page.get("Contents", []):
+                    if item["Key"].endswith(".wdl"):
+                        yield s3.get_object(Bucket=bucket, Key=item["Key"])["Body"].read().decode("utf-8")
+        elif os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                if name.endswith(".wdl"):
+                    with open(os.path.join(source, name)) as f:
+                        yield f.read()
+        else:
+            with open(source) as f:
+                yield f.read()
+
+
+def warm_cache(cache, sources):
+    for wdl_text in read_wdl_sources(sources):
+        try:
+            parse_wdl(wdl_text, cache)
+        except NoWorkflowError:
+            pass  # task-only documents have nothing to visualize
+    return cache.stats()
+
+
+def parse_document(doc):
     if not doc.workflow:
         raise NoWorkflowError("No valid WDL workflow found.")
     # collect stage inputs
     workflow_inputs = get_workflow_input_information(doc.workflow.inputs)
     # collect task names and inputs
-    task_inputs, task_names, declarations = get_task_information(doc.workflow.body)
+    task_inputs, task_names, declarations, scattered_tasks = get_task_information(doc.workflow.body)
     # insert declarations into task inputs
     task_inputs = insert_declarations(task_inputs, declarations)
     file_basenames = get_file_basenames(doc.tasks)
+    file_basenames.update(get_call_basenames(doc.workflow))
     outputs = get_output_aliases(doc.workflow.outputs)
-    parsed = {
+    return {
         "inputs": workflow_inputs,
         "task_names": task_names,
         "task_inputs": task_inputs,
         "basenames": file_basenames,
         "outputs": outputs,
+        "scattered_tasks": scattered_tasks,
     }
+
+
+def build_graph(parsed):
+    task_names = parsed["task_names"]
+    scattered_tasks = set(parsed.get("scattered_tasks", []))
+    nodes = [
+        {"id": task_name, "type": "task", "index": index, "scattered": task_name in scattered_tasks}
+        for index, task_name in enumerate(task_names)
+    ]
+    nodes.extend(
+        {"id": f"{WORKFLOW_INPUT_PREFIX}.{input_name}", "type": "input", "name": input_name, "input_type": input_type}
+        for input_name, input_type in parsed["inputs"].items()
+    )
+    node_ids = set(node["id"] for node in nodes)
+
+    # (from, to) -> edge, in order of first appearance
+    edges = {}
+    for task_name in task_names:
+        for variable in parsed["task_inputs"][task_name]:
+            source, _ = variable.split(".", 1)
+            source_id = variable if source == WORKFLOW_INPUT_PREFIX else source
+            if source_id not in node_ids:
+                continue
+            edge = edges.setdefault(
+                (source_id, task_name), {"from": source_id, "to": task_name, "variables": [], "files": []}
+            )
+            if variable not in edge["variables"]:
+                edge["variables"].append(variable)
+                if variable in parsed["basenames"]:
+                    edge["files"].append(parsed["basenames"][variable])
+
+    outputs = []
+    for output_name, variable in parsed["outputs"].items():
+        source, variable_name = variable.split(".", 1) if "." in variable else (WORKFLOW_INPUT_PREFIX, variable)
+        outputs.append(
+            {"name": output_name, "from": source, "variable": variable_name, "file": parsed["basenames"].get(variable)}
+        )
+
+    return {
+        "nodes": nodes,
+        "edges": list(edges.values()),
+        "topological_order": get_topological_order(task_names, edges.keys()),
+        "outputs": outputs,
+    }
+
+
+def get_topological_order(task_names, edges):
+    """Kahn's algorithm over the task nodes, breaking ties by the order tasks appear in the workflow."""
+    task_indexes = {task_name: index for index, task_name in enumerate(task_names)}
+    dependents = {task_name: [] for task_name in task_names}
+    dependency_counts = dict.fromkeys(task_names, 0)
+    for source, target in edges:
+        if source in task_indexes and source != target:
+            dependents[source].append(target)
+            dependency_counts[target] += 1
+
+    # heap of (workflow index, task name) for the tasks whose dependencies have all been ordered
+    ready = [(task_indexes[task_name], task_name) for task_name in task_names if dependency_counts[task_name] == 0]
+    order = []
+    while ready:
+        _, task_name = heapq.heappop(ready)
+        order.append(task_name)
+        for dependent in dependents[task_name]:
+            dependency_counts[dependent] -= 1
+            if dependency_counts[dependent] == 0:
+                heapq.heappush(ready, (task_indexes[dependent], dependent))
+    if len(order) != len(task_names):
+        raise ValueError("Workflow tasks have a cyclic dependency")
+    return order
+
+
+def format_output(parsed, output_format="flat"):
+    if output_format == "graph":
+        return dict(parsed, graph=build_graph(parsed))
+    return parsed
+
+
+def parse_wdl(wdl_text, cache=None, imports=None, import_dir=None):
+    # Imports read from disk aren't part of the cache key, so don't cache documents that use them
+    if import_dir is not None:
+        cache = None
+    if cache is not None:
+        parsed = cache.get(wdl_text, imports)
+        if parsed is not None:
+            return parsed
+    path = [import_dir] if import_dir is not None else None
+    doc = WDL.load("stdin", path=path, read_source=make_text_reader(wdl_text, imports))
+    parsed = parse_document(doc)
+    if cache is not None:
+        cache.put(wdl_text, parsed, imports)
+    return parsed
+
+
+def parse_stage(stage, import_dir=None):
+    try:
+        return parse_wdl(stage["wdl_text"], imports=stage.get("imports"), import_dir=import_dir)
+    except Exception as e:
+        # miniwdl's exceptions can't be pickled back out of a worker process, so report them as text
+        raise StageParseError(f"{stage['stage_name']}: {type(e).__name__}: {e}") from None
+
+
+def parse_batch(stages, cache=None, max_workers=None, import_dir=None):
+    if import_dir is not None:
+        cache = None
+    parsed_stages = {}
+    pending = []
+    for stage in stages:
+        parsed = cache.get(stage["wdl_text"], stage.get("imports")) if cache is not None else None
+        if parsed is None:
+            pending.append(stage)
+        else:
+            parsed_stages[stage["stage_name"]] = parsed
+
+    if len(pending) == 1:
+        # Not worth a worker process for a single stage
+        stage = pending[0]
+        parsed_stages[stage["stage_name"]] = parse_stage(stage, import_dir)
+    elif pending:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # miniwdl typechecking is CPU-bound, so stages are parsed in separate processes
+        max_workers = min(len(pending), max_workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(stage, executor.submit(parse_stage, stage, import_dir)) for stage in pending]
+            for stage, future in futures:
+                parsed_stages[stage["stage_name"]] = future.result()
+
+    if cache is not None:
+        for stage in pending:
+            cache.put(stage["wdl_text"], parsed_stages[stage["stage_name"]], stage.get("imports"))
+
+    # Keep the stages in the order they were given
+    return {stage["stage_name"]: parsed_stages[stage["stage_name"]] for stage in stages}
+
+
+def handle_request(line, cache=None, import_dir=None):
+    request_id = None
+    try:
+        request = json.loads(line)
+        request_id = request.get("id")
+        if request.get("cache_stats"):
+            return {"id": request_id, "result": cache.stats() if cache is not None else None}
+        parsed = parse_wdl(request["wdl"], cache, request.get("imports"), import_dir)
+        return {"id": request_id, "result": format_output(parsed, request.get("format", "flat"))}
+    except Exception as e:
+        # Report the failure to the caller and keep serving; one bad document shouldn't take the server down
+        return {"id": request_id, "error": f"{type(e).__name__}: {e}"}
+
+
+def serve(infile, outfile, cache=None, import_dir=None):
+    for line in infile:
+        if not line.strip():
+            continue
+        outfile.write(json.dumps(handle_request(line, cache, import_dir)) + "\n")
+        outfile.flush()
+
+
+class ParseRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        infile = io.TextIOWrapper(self.rfile, encoding="utf-8")
+        outfile = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=True)
+        serve(infile, outfile, self.server.cache, self.server.import_dir)
+
+
+WARM_UP_WDL = "version 1.0\nworkflow warm_up {}\n"
+
+
+def warm_parser():
+    """Import miniwdl and build its Lark parser for WDL 1.0 documents in this process."""
+    WDL.load("stdin", read_source=make_text_reader(WARM_UP_WDL))
+
+
+class ParseServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    # Each connection is handled in a child forked from the server process, which is warmed up
+    # with warm_parser before serving, so children inherit miniwdl and its parser and concurrent
+    # clients don't queue behind each other's typechecking.
+    # Cache hit/miss counters are therefore per connection; the cache directory itself is shared.
+    cache = None
+    import_dir = None
+
+
+def serve_unix_socket(socket_path, cache=None, import_dir=None):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # Turn SIGTERM into a normal exit so the socket file is cleaned up on shutdown
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+    # Otherwise every forked child would import miniwdl and build the parser all over again
+    warm_parser()
+    with ParseServer(socket_path, ParseRequestHandler) as server:
+        server.cache = cache
+        server.import_dir = import_dir
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+
+def main(cache=None, import_dir=None, bundle=False, output_format="flat"):
+    # load WDL document
+    if bundle:
+        source = json.load(sys.stdin)
+        parsed = parse_wdl(source["wdl_text"], cache, source.get("imports"), import_dir)
+    else:
+        parsed = parse_wdl(sys.stdin.read(), cache, import_dir=import_dir)
     # Return to stdout
-    print(json.dumps(parsed))
+    print(json.dumps(format_output(parsed, output_format)))
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Parse WDL workflows for pipeline visualization",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--serve", action="store_true", help="Serve newline-delimited JSON parse requests")
+    parser.add_argument("--socket", type=str, help="Unix socket to serve on instead of stdin/stdout")
+    parser.add_argument("--batch", action="store_true", help="Parse a JSON array of stage WDLs from stdin")
+    parser.add_argument("--jobs", type=int, help="Maximum number of stages to parse in parallel with --batch")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="flat", help="Output format")
+    parser.add_argument("--import-dir", type=str, help="Directory to resolve WDL imports from")
+    parser.add_argument("--bundle", action="store_true", help="Read the WDL and its imports as a JSON bundle")
+    parser.add_argument("--cache-dir", type=str, help="Directory for the on-disk cache of parse results")
+    parser.add_argument("--cache-max-entries", type=int, default=DEFAULT_CACHE_MAX_ENTRIES)
+    parser.add_argument(
+        "--warm", nargs="+", metavar="SOURCE", help="Fill the cache from WDL files, directories or s3:// folders"
+    )
+
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache_dir:
+        cache = ParseCache(args.cache_dir, args.cache_max_entries)
+        cache_grammar(os.path.join(args.cache_dir, "grammar"))
+
+    if args.warm:
+        if cache is None:
+            parser.error("--warm requires --cache-dir")
+        print(json.dumps(warm_cache(cache, args.warm)))
+    elif args.batch:
+        parsed_stages = parse_batch(json.load(sys.stdin), cache, args.jobs, args.import_dir)
+        print(json.dumps({stage: format_output(parsed, args.format) for stage, parsed in parsed_stages.items()}))
+    elif args.serve and args.socket:
+        serve_unix_socket(args.socket, cache, args.import_dir)
+    elif args.serve:
+        serve(sys.stdin, sys.stdout, cache, args.import_dir)
+    else:
+        main(cache, args.import_dir, args.bundle, args.format)
@@ -1,19 +1,167 @@
 #!/usr/bin/env python3
 
-import boto3
-from botocore.exceptions import ClientError
+import abc
 import os
+import sys
 import json
 import argparse
+import hashlib
 import time
-from jwcrypto.jwk import JWK
-from jwcrypto import jwe, jwt, jwk
+import bisect
+import itertools
+import signal
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from jwcrypto.jwk import JWK, JWKSet
+from jwcrypto import jwe, jws, jwt, jwk
+from jwcrypto.common import JWKeyNotFound, base64url_decode, json_encode
+from typing import Tuple, Union
 from typing_extensions import TypedDict, List
 
 # Generate a ES-384 private key with:
 # openssl ecparam -name secp384r1 -genkey -noout -out tmp/czid-private-key.pem
+#
+# With --compact-project-claims (or "compact": true in a create request), project_roles is stored
+# as {"encoding": "ranges", "version": 1, "roles": {role: runs}}, where runs is a flat list of
+# [gap, length, gap, length, ...] describing consecutive runs of sorted, deduplicated project ids,
+# each gap counted from the end of the previous run. get_token_claims expands it back into plain
+# lists unless asked not to, and ProjectRolesView answers membership checks on either form
+# without expanding it. Only use it for tokens read through this script.
+#
+# Every phase of fetching keys, creating and decrypting tokens is timed into in-process latency
+# histograms (TIMINGS). --timings prints them as a JSON block on stderr when the script exits,
+# the resident service returns them for {"op": "metrics"}, and --benchmark N runs N
+# create/decrypt cycles against a freshly generated key and prints throughput and p50/p99.
+#
+# Keys come from a KeyProvider, which keeps them in memory as a JWKSet: a local PEM file at
+# PRIVATE_KEY_PATH if there is one, otherwise the {ENVIRONMENT}/czid-services-private-key secret
+# in Secrets Manager. The secret holds either a single PEM key or a JWKS ({"keys": [...]}) whose
+# first key signs new tokens; every key in the set can decrypt, picked by the token's kid, so
+# tokens created before a rotation stay valid until they expire. Resident services refresh the
+# keys in the background every --key-refresh-seconds.
+#
+# One-shot invocations share the secret through KEY_CACHE_PATH, a file only the service user can
+# read, so only one of them per --key-refresh-seconds pays for importing boto3 and calling
+# Secrets Manager. A token whose kid isn't among the loaded keys makes the provider reload them
+# from the source unless they were fetched from it in the last KID_MISS_RELOAD_SECONDS, however
+# recently they were read from the cache, so keys rotated in since the last fetch are picked up
+# without waiting for the next refresh. The reload rewrites the cache, so other processes don't
+# repeat it.
+#
+# Besides one-shot --create_token / --decrypt_token invocations, the script can run as a
+# resident token service with --serve, which loads the private key once and then answers
+# newline-delimited JSON requests, one JSON response line each:
+#   {"id": ..., "op": "create", "userid": 1, "project_claims": {...}, "service_identity": ..., "expiration": 3600}
+#   {"id": ..., "op": "decrypt", "token": "<compact JWE>"}
+#   {"id": ..., "op": "revoke", "token": "<compact JWE>"}
+#   {"id": ..., "op": "health"}
+# Responses are {"id": ..., "result": ...} or {"id": ..., "error": "..."}. Requests are read from
+# stdin, or from connections to a local Unix socket with --socket PATH. --health --socket PATH
+# checks that a running service is answering. SIGTERM/SIGINT stop the service after in-flight
+# requests finish. Decrypted tokens are kept in a bounded in-memory cache until they expire, so a
+# client repeating the same bearer token only pays for the EC operations once; "revoke" drops a
+# token from the cache and "health" reports the cache hit rate.
+#
+# --batch reads the same create/decrypt requests from stdin until EOF and writes one response
+# line per request, in the order the requests were given. The EC work is spread over a pool of
+# worker processes (--jobs), each of which loads the key once, so bulk token issuance scales
+# with the number of cores rather than the number of Python processes started.
 
 PRIVATE_KEY_PATH = "/tmp/czid-private-key.pem"
+KEY_CACHE_PATH = "/tmp/czid-services-keys.cache"
+KID_MISS_RELOAD_SECONDS = 30
+DEFAULT_TOKEN_CACHE_SIZE = 1024
+DEFAULT_KEY_REFRESH_SECONDS = 300
+BATCH_CHUNK_SIZE = 64
+REQUIRED_CLAIMS = {"exp": None, "iat": None, "nbf": None}
+INT_TYPES = {int}
+COMPACT_PROJECT_ROLES_ENCODING = "ranges"
+COMPACT_PROJECT_ROLES_VERSION = 1
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS_MS = [
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, float("inf")
+]
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * len(HISTOGRAM_BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, milliseconds: float):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS_MS, milliseconds)] += 1
+        self.count += 1
+        self.total_ms += milliseconds
+        self.max_ms = max(self.max_ms, milliseconds)
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of samples."""
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS_MS, self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(bound, self.max_ms)
+        return 0.0
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": self.max_ms,
+            "buckets": {
+                f"le_{bound}": count
+                for bound, count in zip(HISTOGRAM_BUCKETS_MS, self.counts)
+                if count
+            },
+        }
+
+
+class Timings:
+    def __init__(self):
+        self.histograms = defaultdict(LatencyHistogram)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def record(self, name: str, milliseconds: float):
+        with self._lock:
+            self.histograms[name].record(milliseconds)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {name: h.summary() for name, h in sorted(self.histograms.items())}
+
+
+TIMINGS = Timings()
+
+
+def process_age_ms():
+    """Time since this process was started, which includes interpreter startup, if /proc has it."""
+    try:
+        with open("/proc/self/stat") as f:
+            # the command name can contain spaces, so count fields from after it
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return (uptime - start_ticks / os.sysconf("SC_CLK_TCK")) * 1000
+    except (OSError, ValueError, IndexError):
+        return None
 
 
 class ProjectRole(TypedDict):
@@ -21,38 +169,355 @@ class ProjectRole(TypedDict):
     roles: List[str]
 
 
-def fetch_private_key():
-    if os.path.isfile(PRIVATE_KEY_PATH):
-        return
+def parse_keys(key_text: str) -> List[JWK]:
+    """Parse a PEM private key, or a JWKS whose first key is the signing key."""
+    with TIMINGS.phase("key_parse"):
+        if key_text.lstrip().startswith("-----BEGIN"):
+            return [jwk.JWK.from_pem(key_text.encode("utf-8"))]
+        return [jwk.JWK(**key_dict) for key_dict in json.loads(key_text)["keys"]]
 
-    env = os.environ.get("ENVIRONMENT")
-    secret_name = f"{env}/czid-services-private-key"
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(service_name="secretsmanager", region_name="us-west-2")
+def with_key_id(key: JWK) -> JWK:
+    # Keys without a kid are named by their thumbprint, like JWK.from_pem does
+    if key.get("kid"):
+        return key
+    return jwk.JWK(kid=key.thumbprint(), **key.export(as_dict=True))
 
-    try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
-    except ClientError as e:
-        raise e
-
-    # Decrypts secret using the associated KMS key and stores the private key in a pem file.
-    secret = get_secret_value_response["SecretString"]
-    if secret:
-        with open(PRIVATE_KEY_PATH, "w") as f:
-            f.write(secret)
-
-
-def get_token_claims(private_key: JWK, token: str) -> dict:
-    unpacked_token = jwe.JWE()
-    unpacked_token.deserialize(token)
-    unpacked_token.decrypt(private_key)
-    decrypted_payload = unpacked_token.payload.decode("utf-8")
-    required_claims = {"exp": None, "iat": None, "nbf": None}
-    decoded_jwt = jwt.JWT(
-        key=private_key, jwt=decrypted_payload, check_claims=required_claims
+
+class KeyProvider(abc.ABC):
+    """Loads the service keys and keeps them in memory, reloading them every ttl seconds.
+
+    Subclasses implement load(), returning the keys with the signing key first.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_KEY_REFRESH_SECONDS):
+        self.ttl = ttl
+        self._keys = None
+        self._keyset = None
+        self._signer = None
+        self._loaded_at = 0
+        # Wall clock time the keys were last read from their source rather than a local cache of them
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._stop_refresh = None
+
+    @abc.abstractmethod
+    def load(self) -> List[JWK]:
+        pass
+
+    def refresh(self):
+        # load() moves this back to when its keys were fetched if they come from a cache
+        self._fetched_at = time.time()
+        self._install(self.load())
+
+    def reload(self):
+        """Reload the keys from their source, bypassing any local cache of them."""
+        self.refresh()
+
+    def _install(self, keys: List[JWK]):
+        keys = [with_key_id(key) for key in keys]
+        if not keys:
+            raise ValueError("no keys found")
+        keyset = JWKSet()
+        for key in keys:
+            keyset.add(key)
+        with self._lock:
+            self._keys = keys
+            self._keyset = keyset
+            self._signer = TokenSigner(keys[0], keyset)
+            self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        # With a background refresher running, stale keys are served until it replaces them
+        # rather than making a request wait on the reload
+        stale = time.monotonic() - self._loaded_at >= self.ttl
+        if self._keys is None or (stale and self._stop_refresh is None):
+            self.refresh()
+
+    def keys(self) -> List[JWK]:
+        self._ensure_loaded()
+        return self._keys
+
+    @property
+    def keyset(self) -> JWKSet:
+        self._ensure_loaded()
+        return self._keyset
+
+    @property
+    def signer(self) -> "TokenSigner":
+        self._ensure_loaded()
+        return self._signer
+
+    @property
+    def signing_key(self) -> JWK:
+        return self.keys()[0]
+
+    def decrypt(
+        self, token: str, cache: "VerifiedTokenCache" = None, expand: bool = True
+    ) -> str:
+        """Decrypt a token, reloading the keys once if its kid isn't among them."""
+        try:
+            return self.signer.decrypt(token, cache, expand)
+        except JWKeyNotFound:
+            # Rate limited so that tokens with made-up kids can't hammer the key source
+            if time.time() - self._fetched_at < KID_MISS_RELOAD_SECONDS:
+                raise
+            self.reload()
+            return self.signer.decrypt(token, cache, expand)
+
+    def start_background_refresh(self):
+        if self._stop_refresh is not None:
+            return
+        self._ensure_loaded()
+        self._stop_refresh = threading.Event()
+        threading.Thread(
+            target=self._refresh_loop, args=(self._stop_refresh,), daemon=True
+        ).start()
+
+    def stop_background_refresh(self):
+        if self._stop_refresh is not None:
+            self._stop_refresh.set()
+            self._stop_refresh = None
+
+    def _refresh_loop(self, stop: threading.Event):
+        while not stop.wait(self.ttl):
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep using the keys we have; the next refresh will try again
+                print(f"key refresh failed: {type(e).__name__}: {e}", file=sys.stderr)
+
+
+class StaticKeyProvider(KeyProvider):
+    def __init__(self, *keys: JWK):
+        super().__init__(ttl=float("inf"))
+        self.static_keys = list(keys)
+
+    def load(self) -> List[JWK]:
+        return self.static_keys
+
+
+class FileKeyProvider(KeyProvider):
+    """Reads keys from local PEM or JWKS files; the first key of the first file signs."""
+
+    def __init__(self, *paths: str, ttl: float = DEFAULT_KEY_REFRESH_SECONDS):
+        super().__init__(ttl)
+        self.paths = paths
+
+    def load(self) -> List[JWK]:
+        keys = []
+        for path in self.paths:
+            with TIMINGS.phase("key_fetch"), open(path) as f:
+                key_text = f.read()
+            keys.extend(parse_keys(key_text))
+        return keys
+
+
+class SecretsManagerKeyProvider(KeyProvider):
+    """Reads keys from a Secrets Manager secret. Pass a client to use a stub in place of AWS.
+
+    With a cache_path, the secret is kept in that file for up to ttl seconds, so that short-lived
+    processes can share it instead of each fetching it. The file is written atomically with 0600
+    permissions and ignored unless it belongs to the current user and nobody else can read it.
+    """
+
+    def __init__(
+        self,
+        secret_name: str,
+        client=None,
+        region_name: str = "us-west-2",
+        ttl: float = DEFAULT_KEY_REFRESH_SECONDS,
+        cache_path: str = None,
+    ):
+        super().__init__(ttl)
+        self.secret_name = secret_name
+        self.client = client
+        self.region_name = region_name
+        self.cache_path = cache_path
+
+    def load(self) -> List[JWK]:
+        cached = self.read_cache()
+        if cached is None:
+            return parse_keys(self.fetch())
+        secret, self._fetched_at = cached
+        return parse_keys(secret)
+
+    def reload(self):
+        self._install(parse_keys(self.fetch()))
+
+    def fetch(self) -> str:
+        if self.client is None:
+            with TIMINGS.phase("secretsmanager_client"):
+                # boto3 takes a while to import, so only pay for it when the secret is needed
+                import boto3
+
+                session = boto3.session.Session()
+                self.client = session.client(
+                    service_name="secretsmanager", region_name=self.region_name
+                )
+        with TIMINGS.phase("key_fetch"):
+            # Decrypts secret using the associated KMS key.
+            response = self.client.get_secret_value(SecretId=self.secret_name)
+        secret = response["SecretString"]
+        self._fetched_at = time.time()
+        self.write_cache(secret)
+        return secret
+
+    def read_cache(self) -> Union[Tuple[str, float], None]:
+        """The cached secret and when it was fetched, or None if there is no fresh, private cache."""
+        if self.cache_path is None:
+            return None
+        with TIMINGS.phase("key_cache_read"):
+            try:
+                fd = os.open(self.cache_path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+            except OSError:
+                return None
+            with os.fdopen(fd) as f:
+                info = os.fstat(fd)
+                if (
+                    not stat.S_ISREG(info.st_mode)
+                    or info.st_uid != os.getuid()
+                    or info.st_mode & 0o077
+                    or time.time() - info.st_mtime >= self.ttl
+                ):
+                    return None
+                return f.read(), info.st_mtime
+
+    def write_cache(self, secret: str):
+        if self.cache_path is None:
+            return
+        try:
+            # mkstemp creates the file with 0600 permissions; renaming it makes the update atomic
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.cache_path)), prefix=".czid-keys-"
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(secret)
+                os.replace(tmp_path, self.cache_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            # The keys were fetched; the next process will just fetch them again
+            print(f"key cache write failed: {type(e).__name__}: {e}", file=sys.stderr)
+
+
+def default_key_provider(ttl: float = DEFAULT_KEY_REFRESH_SECONDS) -> KeyProvider:
+    if os.path.isfile(PRIVATE_KEY_PATH):
+        return FileKeyProvider(PRIVATE_KEY_PATH, ttl=ttl)
+    env = os.environ.get("ENVIRONMENT")
+    return SecretsManagerKeyProvider(
+        f"{env}/czid-services-private-key", ttl=ttl, cache_path=KEY_CACHE_PATH
     )
+
+
+def as_key_provider(keys: Union[JWK, KeyProvider]) -> KeyProvider:
+    return StaticKeyProvider(keys) if isinstance(keys, JWK) else keys
+
+
+class VerifiedTokenCache:
+    """Bounded LRU cache of the claims of tokens that have already been decrypted and verified.
+
+    Entries are keyed by a hash of the compact JWE, so the token itself isn't kept in memory, and
+    are only served between the token's nbf and exp claims, and while the key the token was
+    encrypted to (its kid) is still one of the caller's keys.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_TOKEN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str, kids: frozenset = None):
+        key = self.key(token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                claims, not_before, expires_at, kid = entry
+                # Tokens of retired keys must not outlive the key
+                if now >= expires_at or (kids is not None and kid not in kids):
+                    del self._entries[key]
+                elif now >= not_before:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return claims
+            self.misses += 1
+            return None
+
+    def put(self, token: str, claims: str):
+        parsed_claims = json.loads(claims)
+        entry = (claims, parsed_claims["nbf"], parsed_claims["exp"], token_kid(token))
+        key = self.key(token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def revoke(self, token: str) -> bool:
+        with self._lock:
+            return self._entries.pop(self.key(token), None) is not None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+        }
+
+
+def token_kid(token: str) -> Union[str, None]:
+    header = json.loads(base64url_decode(token.split(".", 1)[0]))
+    return header.get("kid")
+
+
+def key_ids(private_key: Union[JWK, JWKSet]) -> frozenset:
+    keys = private_key["keys"] if isinstance(private_key, JWKSet) else [private_key]
+    return frozenset(key.get("kid") or key.thumbprint() for key in keys)
+
+
+def get_token_claims(
+    private_key: Union[JWK, JWKSet],
+    token: str,
+    cache: VerifiedTokenCache = None,
+    expand: bool = True,
+    kids: frozenset = None,
+) -> dict:
+    with TIMINGS.phase("decrypt"):
+        claims = None
+        if cache is not None:
+            claims = cache.get(token, kids if kids is not None else key_ids(private_key))
+        if claims is None:
+            claims = decrypt_token_claims(private_key, token)
+            if cache is not None:
+                cache.put(token, claims)
+        if expand:
+            with TIMINGS.phase("claims_expand"):
+                claims = expand_claims(claims)
+        return claims
+
+
+def decrypt_token_claims(private_key: Union[JWK, JWKSet], token: str) -> str:
+    with TIMINGS.phase("jwe_decrypt"):
+        unpacked_token = jwe.JWE()
+        unpacked_token.deserialize(token)
+        unpacked_token.decrypt(private_key)
+        decrypted_payload = unpacked_token.payload.decode("utf-8")
+    with TIMINGS.phase("jws_verify"):
+        decoded_jwt = jwt.JWT(
+            key=private_key, jwt=decrypted_payload, check_claims=REQUIRED_CLAIMS
+        )
     return decoded_jwt.claims
 
 
@@ -62,72 +527,473 @@ def create_token(
     project_claims: ProjectRole = None,
     service_identity: str = None,
     expiration: int = 3600,
+    compact: bool = False,
 ) -> str:
-    parsed_project_claims = json.loads(project_claims) if project_claims else None
-
-    validate_claims(userid, parsed_project_claims, service_identity)
-
-    # Wrap the JWT in a JWE encrypted with alg ECDH-ES and enc A256CBC-HS512.
-    expires_at = int(time.time()) + int(expiration)
-    jwt_payload = {
-        "sub": str(userid),
-        "iat": int(time.time()),
-        "nbf": int(time.time()),
-        "exp": expires_at,
-        "project_roles": parsed_project_claims,
-        "service_identity": service_identity,
-    }
+    return json.dumps(
+        build_token(
+            private_key, userid, project_claims, service_identity, expiration, compact
+        )
+    )
+
+
+def build_token(
+    private_key: JWK,
+    userid: int,
+    project_claims: ProjectRole = None,
+    service_identity: str = None,
+    expiration: int = 3600,
+    compact: bool = False,
+) -> dict:
+    return TokenSigner(private_key).create(
+        userid, project_claims, service_identity, expiration, compact
+    )
+
 
-    jwt_headers = {
-        "alg": "ES384",
-        "typ": "JWT",
-        "kid": private_key.thumbprint(),
+class TokenSigner:
+    """Creates and decrypts tokens with one key, doing the per-key work only once.
+
+    The key thumbprint, the encoded JWT and JWE protected headers and the public key the JWE is
+    encrypted to are computed when the signer is built, so each token only costs the ES384
+    signature, the ECDH-ES key agreement and the A256CBC-HS512 encryption.
+    """
+
+    def __init__(self, private_key: JWK, keyset: JWKSet = None):
+        self.private_key = private_key
+        # Tokens are decrypted with the key named by their kid when there's a set of keys
+        self.decryption_key = keyset if keyset is not None else private_key
+        self.kid = private_key.get("kid") or private_key.thumbprint()
+        self.kids = key_ids(self.decryption_key)
+        self.public_key = jwk.JWK.from_json(private_key.export_public())
+        self.jwt_header = json_encode({"alg": "ES384", "typ": "JWT", "kid": self.kid})
+        # Encrypt the JWT with a JWE wrapper so that only the intended recipient can read it.
+        self.jwe_header = json_encode(
+            {"alg": "ECDH-ES", "enc": "A256CBC-HS512", "typ": "JWE", "kid": self.kid}
+        )
+
+    def create(
+        self,
+        userid: int,
+        project_claims: Union[str, ProjectRole] = None,
+        service_identity: str = None,
+        expiration: int = 3600,
+        compact: bool = False,
+    ) -> dict:
+        with TIMINGS.phase("create"):
+            return self._create(
+                userid, project_claims, service_identity, expiration, compact
+            )
+
+    def _create(self, userid, project_claims, service_identity, expiration, compact):
+        with TIMINGS.phase("claims_validate"):
+            jwt_payload = CLAIM_SCHEMA.parse(userid, project_claims, service_identity)
+
+        # Wrap the JWT in a JWE encrypted with alg ECDH-ES and enc A256CBC-HS512.
+        now = int(time.time())
+        expires_at = now + int(expiration)
+        with TIMINGS.phase("claims_encode"):
+            if compact and jwt_payload["project_roles"]:
+                jwt_payload["project_roles"] = compact_project_roles(
+                    jwt_payload["project_roles"]
+                )
+            jwt_payload.update({"iat": now, "nbf": now, "exp": expires_at})
+            payload = json_encode(jwt_payload)
+
+        with TIMINGS.phase("jws_sign"):
+            signed_token = jws.JWS(payload)
+            signed_token.add_signature(self.private_key, protected=self.jwt_header)
+            signed_payload = signed_token.serialize(compact=True)
+        with TIMINGS.phase("jwe_encrypt"):
+            jwe_token = jwe.JWE(
+                signed_payload, recipient=self.public_key, protected=self.jwe_header
+            )
+            token = jwe_token.serialize(compact=True)
+        return {"token": token, "expires_at": expires_at}
+
+    def decrypt(
+        self, token: str, cache: VerifiedTokenCache = None, expand: bool = True
+    ) -> str:
+        return get_token_claims(self.decryption_key, token, cache, expand, self.kids)
+
+
+class ClaimSchema:
+    """Validates the caller-supplied token claims in a single pass.
+
+    The set of valid roles and the error messages are built once. Project claims may be a JSON
+    string, as passed on the command line, or an already decoded dict of role to project ids,
+    so in-process callers don't pay for a JSON round trip. Lists of ints, the usual case, are
+    checked with one type scan instead of an int() call per project id.
+    """
+
+    def __init__(self, roles: List[str]):
+        self.roles = frozenset(roles)
+        self.role_error = f"role must be one of {', '.join(roles[:-1])}, or {roles[-1]}"
+
+    def parse(
+        self,
+        user_id: int,
+        project_claims: Union[str, ProjectRole] = None,
+        service_identity: str = None,
+    ) -> dict:
+        if isinstance(project_claims, str):
+            project_claims = json.loads(project_claims) if project_claims else None
+        elif not project_claims:
+            project_claims = None
+
+        if user_id:
+            int(user_id)  # assert user_id is a valid integer
+        if project_claims:
+            self.validate_projects(project_claims)
+        if service_identity and not isinstance(service_identity, str):
+            raise ValueError("service_identity must be a string")
+
+        return {
+            "sub": str(user_id),
+            "project_roles": project_claims,
+            "service_identity": service_identity,
+        }
+
+    def validate_projects(self, projects: ProjectRole):
+        if not isinstance(projects, dict):
+            raise ValueError("projects must be a dictionary")
+
+        for role, project_ids in projects.items():
+            if not isinstance(project_ids, list):
+                raise ValueError("project_ids must be a list")
+
+            if not set(map(type, project_ids)) <= INT_TYPES:
+                for project_id in project_ids:
+                    int(project_id)  # assert project_id is a valid integer
+
+            if role not in self.roles:
+                raise ValueError(self.role_error)
+
+
+CLAIM_SCHEMA = ClaimSchema(["owner", "member", "viewer"])
+
+
+def validate_claims(user_id: int, projects: ProjectRole, service_identity: str):
+    CLAIM_SCHEMA.parse(user_id, projects, service_identity)
+
+
+def validate_projects(projects: ProjectRole):
+    CLAIM_SCHEMA.validate_projects(projects)
+
+
+def compact_project_roles(project_roles: ProjectRole) -> dict:
+    roles = {}
+    for role, project_ids in project_roles.items():
+        runs = []
+        previous_end = 0
+        start = end = None
+        for project_id in sorted(set(map(int, project_ids))):
+            if project_id == end:
+                end += 1
+                continue
+            if start is not None:
+                runs.extend((start - previous_end, end - start))
+                previous_end = end
+            start, end = project_id, project_id + 1
+        if start is not None:
+            runs.extend((start - previous_end, end - start))
+        roles[role] = runs
+    return {
+        "encoding": COMPACT_PROJECT_ROLES_ENCODING,
+        "version": COMPACT_PROJECT_ROLES_VERSION,
+        "roles": roles,
     }
 
-    jwt_token = jwt.JWT(header=jwt_headers, claims=jwt_payload)
-    jwt_token.make_signed_token(private_key)
-    jwe_payload = jwt_token.serialize(compact=True)
 
-    # Encrypt the JWT created above with a JWE wrapper so that only the intended recipient can read it.
-    protected_header = {
-        "alg": "ECDH-ES",
-        "enc": "A256CBC-HS512",
-        "typ": "JWE",
-        "kid": private_key.thumbprint(),
+def is_compact_project_roles(project_roles) -> bool:
+    if not isinstance(project_roles, dict):
+        return False
+    if project_roles.get("encoding") != COMPACT_PROJECT_ROLES_ENCODING:
+        return False
+    if project_roles.get("version") != COMPACT_PROJECT_ROLES_VERSION:
+        raise ValueError(
+            f"unsupported project_roles version: {project_roles.get('version')}"
+        )
+    return True
+
+
+def iter_project_id_ranges(runs: List[int]):
+    """Yield (start, end) for every run of project ids, with end exclusive."""
+    position = 0
+    for gap, length in zip(runs[::2], runs[1::2]):
+        start = position + gap
+        position = start + length
+        yield start, position
+
+
+def expand_project_roles(project_roles) -> ProjectRole:
+    if not is_compact_project_roles(project_roles):
+        return project_roles
+    return {
+        role: list(
+            itertools.chain.from_iterable(
+                range(start, end) for start, end in iter_project_id_ranges(runs)
+            )
+        )
+        for role, runs in project_roles["roles"].items()
     }
-    jwe_token = jwe.JWE(jwe_payload, recipient=private_key, protected=protected_header)
-    return json.dumps(
-        {"token": jwe_token.serialize(compact=True), "expires_at": expires_at}
+
+
+def expand_claims(claims: str) -> str:
+    # Plain tokens are by far the most common, so skip parsing the claims when the marker
+    # can't be in them
+    if f'"encoding":"{COMPACT_PROJECT_ROLES_ENCODING}"' not in claims:
+        return claims
+    parsed_claims = json.loads(claims)
+    if not is_compact_project_roles(parsed_claims.get("project_roles")):
+        return claims
+    parsed_claims["project_roles"] = expand_project_roles(
+        parsed_claims["project_roles"]
     )
+    return json_encode(parsed_claims)
 
 
-# TODO: Plug in a library to do runtime type checking, so we don't have to manualy do it.
-def validate_claims(user_id: int, projects: ProjectRole, service_identity: str):
-    if user_id:
-        int(user_id)  # assert user_id is a valid integer
+class ProjectRolesView:
+    """Answers role membership questions on plain or compact project_roles without expanding them."""
 
-    if projects:
-        validate_projects(projects)
+    def __init__(self, project_roles):
+        self._plain = {}
+        self._ranges = {}
+        if is_compact_project_roles(project_roles):
+            for role, runs in project_roles["roles"].items():
+                ranges = list(iter_project_id_ranges(runs))
+                starts = [start for start, _ in ranges]
+                ends = [end for _, end in ranges]
+                self._ranges[role] = (starts, ends)
+        else:
+            for role, project_ids in (project_roles or {}).items():
+                self._plain[role] = frozenset(map(int, project_ids))
 
-    if service_identity and not isinstance(service_identity, str):
-        raise ValueError("service_identity must be a string")
+    def has_role(self, role: str, project_id: int) -> bool:
+        if role in self._plain:
+            return project_id in self._plain[role]
+        if role not in self._ranges:
+            return False
+        starts, ends = self._ranges[role]
+        i = bisect.bisect_right(starts, project_id) - 1
+        return i >= 0 and project_id < ends[i]
 
+    def roles_for(self, project_id: int) -> List[str]:
+        roles = list(self._plain) + list(self._ranges)
+        return [role for role in roles if self.has_role(role, project_id)]
 
-def validate_projects(projects: ProjectRole):
-    if not isinstance(projects, dict):
-        raise ValueError("projects must be a dictionary")
 
-    for role, project_ids in projects.items():
-        if not isinstance(project_ids, list):
-            raise ValueError("project_ids must be a list")
+class TokenService:
+    """Answers token requests with keys that are loaded once, for the resident mode."""
 
-        for project_id in project_ids:
-            int(project_id)  # assert project_id is a valid integer
+    def __init__(
+        self, keys: Union[JWK, KeyProvider], token_cache: VerifiedTokenCache = None
+    ):
+        self.keys = as_key_provider(keys)
+        self.token_cache = token_cache or VerifiedTokenCache()
+        self.started_at = time.time()
+        self.requests = 0
+        self.in_flight = 0
+        self._lock = threading.Condition()
 
-        valid_roles = set(["owner", "member", "viewer"])
+    def handle(self, request: dict):
+        op = request.get("op")
+        if op == "create":
+            return self.keys.signer.create(
+                request.get("userid"),
+                request.get("project_claims"),
+                request.get("service_identity"),
+                request.get("expiration", 3600),
+                request.get("compact", False),
+            )
+        elif op == "decrypt":
+            claims = self.keys.decrypt(
+                request["token"], self.token_cache, request.get("expand", True)
+            )
+            return json.loads(claims)
+        elif op == "metrics":
+            return TIMINGS.summary()
+        elif op == "revoke":
+            return {"revoked": self.token_cache.revoke(request["token"])}
+        elif op == "health":
+            return {
+                "status": "ok",
+                "kid": self.keys.signer.kid,
+                "kids": [key.get("kid") for key in self.keys.keys()],
+                "uptime_seconds": int(time.time() - self.started_at),
+                "requests": self.requests,
+                "token_cache": self.token_cache.stats(),
+            }
+        raise ValueError(f"unknown op: {op}")
 
-        if role not in valid_roles:
-            raise ValueError("role must be one of owner, member, or viewer")
+    def handle_line(self, line: str) -> dict:
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            return {"id": request_id, "result": self.handle(request)}
+        except Exception as e:
+            # Report the failure to the caller and keep serving
+            return {"id": request_id, "error": f"{type(e).__name__}: {e}"}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self._lock.notify_all()
+
+    def serve(self, infile, outfile):
+        for line in infile:
+            if not line.strip():
+                continue
+            outfile.write(json.dumps(self.handle_line(line)) + "\n")
+            outfile.flush()
+
+    def wait_for_in_flight(self, timeout: float = 10):
+        with self._lock:
+            self._lock.wait_for(lambda: self.in_flight == 0, timeout=timeout)
+
+
+# The TokenService of a --batch worker process, set up once by init_batch_worker
+batch_service = None
+
+
+def init_batch_worker(keys_json: List[str]):
+    global batch_service
+    keys = [jwk.JWK.from_json(key_json) for key_json in keys_json]
+    batch_service = TokenService(StaticKeyProvider(*keys))
+
+
+def handle_batch_chunk(lines: list) -> list:
+    return [batch_service.handle_line(line) for line in lines]
+
+
+def chunk_lines(lines, chunk_size: int):
+    chunk = []
+    for line in lines:
+        if not line.strip():
+            continue
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def process_batch(
+    lines,
+    keys: Union[JWK, KeyProvider],
+    max_workers: int = None,
+    chunk_size: int = BATCH_CHUNK_SIZE,
+):
+    """Yield a response for every request line, in order, handling them in worker processes."""
+    keys = as_key_provider(keys)
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1:
+        service = TokenService(keys)
+        for chunk in chunk_lines(lines, chunk_size):
+            yield from (service.handle_line(line) for line in chunk)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=init_batch_worker,
+        initargs=([key.export() for key in keys.keys()],),
+    ) as executor:
+        # Only keep a few chunks per worker in flight so arbitrarily long streams use bounded memory
+        pending = deque()
+        for chunk in chunk_lines(lines, chunk_size):
+            pending.append(executor.submit(handle_batch_chunk, chunk))
+            if len(pending) >= max_workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+class TokenRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if self.server.shutting_down:
+                break
+            if not line.strip():
+                continue
+            response = self.server.service.handle_line(line)
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+class TokenServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Idle client connections shouldn't keep the process alive on shutdown; in-flight
+    # requests are waited for explicitly instead
+    daemon_threads = True
+    shutting_down = False
+
+    def __init__(self, socket_path: str, service: TokenService):
+        super().__init__(socket_path, TokenRequestHandler)
+        self.service = service
+
+
+def serve_unix_socket(socket_path: str, service: TokenService):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    with TokenServer(socket_path, service) as server:
+
+        def stop(_signum, _frame):
+            server.shutting_down = True
+            # shutdown() blocks until serve_forever() returns, so it can't run on this thread
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        try:
+            server.serve_forever()
+        finally:
+            service.wait_for_in_flight()
+            service.keys.stop_background_refresh()
+            os.unlink(socket_path)
+
+
+def percentile(sorted_samples: List[float], fraction: float) -> float:
+    index = min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))
+    return sorted_samples[index]
+
+
+def run_benchmark(cycles: int, project_claims: ProjectRole = None) -> dict:
+    """Create and decrypt tokens with a freshly generated key, timing every operation."""
+    signer = TokenSigner(jwk.JWK.generate(kty="EC", crv="P-384"))
+    latencies = {"create": [], "decrypt": []}
+    start = time.perf_counter()
+    for userid in range(cycles):
+        operation_start = time.perf_counter()
+        token = signer.create(userid, project_claims)["token"]
+        created = time.perf_counter()
+        signer.decrypt(token)
+        latencies["create"].append((created - operation_start) * 1000)
+        latencies["decrypt"].append((time.perf_counter() - created) * 1000)
+    elapsed = time.perf_counter() - start
+
+    report = {"cycles": cycles, "cycles_per_second": cycles / elapsed}
+    for operation, samples in latencies.items():
+        samples.sort()
+        report[operation] = {
+            "per_second": len(samples) / (sum(samples) / 1000),
+            "p50_ms": percentile(samples, 0.5),
+            "p99_ms": percentile(samples, 0.99),
+        }
+    report["phases"] = TIMINGS.summary()
+    return report
+
+
+def check_health(socket_path: str, timeout: float = 2) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall(b'{"op": "health"}\n')
+        response = json.loads(client.makefile("rb").readline())
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response["result"]
 
 
 if __name__ == "__main__":
@@ -142,22 +1008,93 @@ if __name__ == "__main__":
     parser.add_argument("--token", type=str)
     parser.add_argument("--project-claims", type=str)
     parser.add_argument("--service-identity", type=str)
+    parser.add_argument(
+        "--compact-project-claims",
+        action="store_true",
+        help="Store project_roles in the compact range encoding",
+    )
+    parser.add_argument(
+        "--serve", action="store_true", help="Serve JSON-lines token requests"
+    )
+    parser.add_argument("--socket", type=str, help="Unix socket to serve on")
+    parser.add_argument(
+        "--health", action="store_true", help="Check a service running on --socket"
+    )
+    parser.add_argument(
+        "--batch", action="store_true", help="Handle JSON-lines requests from stdin"
+    )
+    parser.add_argument(
+        "--jobs", type=int, help="Maximum number of worker processes for --batch"
+    )
+    parser.add_argument(
+        "--token-cache-size",
+        type=int,
+        default=DEFAULT_TOKEN_CACHE_SIZE,
+        help="Number of verified tokens kept in memory by --serve",
+    )
+    parser.add_argument(
+        "--timings", action="store_true", help="Print phase timings as JSON to stderr"
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="N",
+        help="Run N create/decrypt cycles against a generated key and print throughput",
+    )
+    parser.add_argument(
+        "--key-refresh-seconds",
+        type=float,
+        default=DEFAULT_KEY_REFRESH_SECONDS,
+        help="How often --serve reloads the keys to pick up rotations",
+    )
 
     args = parser.parse_args()
+    startup_ms = process_age_ms()
+    if startup_ms is not None:
+        TIMINGS.record("startup", startup_ms)
+    if args.timings:
+        import atexit
+
+        atexit.register(
+            lambda: print(json.dumps({"timings": TIMINGS.summary()}), file=sys.stderr)
+        )
+
+    if args.benchmark:
+        print(json.dumps(run_benchmark(args.benchmark, args.project_claims), indent=2))
+        sys.exit(0)
+
+    if args.health:
+        if not args.socket:
+            parser.error("--health requires --socket")
+        try:
+            print(json.dumps(check_health(args.socket)))
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"unhealthy: {e}", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
 
-    fetch_private_key()
-    with open(PRIVATE_KEY_PATH, "rb") as pemfile:
-        key = jwk.JWK.from_pem(pemfile.read())
+    keys = default_key_provider(args.key_refresh_seconds)
 
-    if args.create_token:
+    if args.batch:
+        for response in process_batch(sys.stdin, keys, args.jobs):
+            sys.stdout.write(json.dumps(response) + "\n")
+    elif args.serve:
+        keys.start_background_refresh()
+        service = TokenService(keys, VerifiedTokenCache(args.token_cache_size))
+        if args.socket:
+            serve_unix_socket(args.socket, service)
+        else:
+            service.serve(sys.stdin, sys.stdout)
+    elif args.create_token:
         print(
             create_token(
-                key,
+                keys.signing_key,
                 args.userid,
                 args.project_claims,
                 args.service_identity,
                 args.expiration,
+                args.compact_project_claims,
             )
         )
     elif args.decrypt_token:
-        print(get_token_claims(key, args.token))
+        print(keys.decrypt(args.token))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Measures the per-call latency of scripts/parse_wdl_workflow.py as Rails sees it: a fresh
+# process per document. Three scenarios are timed:
+#
+#   cold          no cache at all; imports miniwdl and builds the Lark parser from the grammar
+#   grammar_warm  parse cache miss, but the serialized Lark parser is loaded from --cache-dir
+#   warm          parse cache hit; answers from the stored result without importing miniwdl
+#
+# For the cold and warm scenarios it also prints the heaviest imports reported by
+# `python -X importtime`, so it's easy to spot which module a startup regression came from.
+#
+# Usage, from the repository root:
+#   python3 test/python/benchmark_parse_wdl_startup.py [--runs N] [--top N] [--json]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+PARSER = os.path.join(REPO_ROOT, "scripts", "parse_wdl_workflow.py")
+
+sys.path.insert(0, REPO_ROOT)
+from test_parse_wdl_workflow import test_wdl  # noqa: E402
+
+
+def run_parser(wdl_text, cache_dir=None, importtime=False):
+    cmd = [sys.executable]
+    if importtime:
+        cmd.extend(["-X", "importtime"])
+    cmd.append(PARSER)
+    if cache_dir:
+        cmd.extend(["--cache-dir", cache_dir])
+    start = time.perf_counter()
+    result = subprocess.run(cmd, input=wdl_text, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result
+
+
+def unique_wdl(i):
+    # a comment is enough to change the content hash, so every call is a parse cache miss
+    return f"# benchmark run {i}\n{test_wdl}"
+
+
+def time_scenario(name, runs, cache_dir):
+    timings = []
+    for i in range(runs):
+        if name == "cold":
+            elapsed, _ = run_parser(unique_wdl(i))
+        elif name == "grammar_warm":
+            elapsed, _ = run_parser(unique_wdl(i), cache_dir)
+        else:
+            elapsed, _ = run_parser(test_wdl, cache_dir)
+        timings.append(elapsed)
+    return {
+        "runs": runs,
+        "median_ms": statistics.median(timings) * 1000,
+        "min_ms": min(timings) * 1000,
+        "max_ms": max(timings) * 1000,
+    }
+
+
+def import_breakdown(result, top):
+    # -X importtime lines look like "import time:  self [us] | cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_us, cumulative_us, module = [field.strip() for field in line.replace(":", "|", 1).split("|")]
+        imports.append({"module": module, "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+    imports.sort(key=lambda item: item["cumulative_us"], reverse=True)
+    return {"total_modules": len(imports), "heaviest": imports[:top]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parse_wdl_workflow.py startup latency")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Number of imports to show in the breakdown")
+    parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # prime the grammar and parse caches
+        run_parser(test_wdl, cache_dir)
+        report = {
+            "timings": {name: time_scenario(name, args.runs, cache_dir) for name in ["cold", "grammar_warm", "warm"]},
+            "imports": {
+                "cold": import_breakdown(run_parser(unique_wdl(-1), importtime=True)[1], args.top),
+                "warm": import_breakdown(run_parser(test_wdl, cache_dir, importtime=True)[1], args.top),
+            },
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    for name, timing in report["timings"].items():
+        print(
+            f"{name:>14}: median {timing['median_ms']:7.1f} ms"
+            f"  (min {timing['min_ms']:.1f}, max {timing['max_ms']:.1f})"
+        )
+    for name, breakdown in report["imports"].items():
+        print(f"\n{name} imports ({breakdown['total_modules']} modules), heaviest by cumulative time:")
+        for item in breakdown["heaviest"]:
+            print(f"  {item['cumulative_us'] / 1000:8.1f} ms  {item['module']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# Scaling benchmark for scripts/parse_wdl_workflow.py. Generates synthetic workflows of increasing
+# size in a few shapes that stress different parts of the parser, and times each phase of
+# parse_document separately:
+#
+#   load                  WDL.load (parse + typecheck)
+#   get_task_information  walking the workflow body and call input expressions
+#   insert_declarations   substituting workflow declarations into task inputs
+#   get_file_basenames    collecting output filenames for tasks and calls
+#   json                  serializing the result
+#
+# The report is JSON, with the median time of every phase for every shape and size plus a
+# log-log scaling exponent per phase (about 1.0 for linear, 2.0 for quadratic), so runs can be
+# compared across releases to see where the parser starts to go superlinear.
+#
+# Usage, from the repository root:
+#   python3 test/python/benchmark_parse_wdl_workflow.py [--sizes 25 50 100 200] [--repeats 3]
+#       [--shapes chain ...] [--output report.json]
+
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, REPO_ROOT)
+
+import WDL  # noqa: E402
+from scripts import parse_wdl_workflow  # noqa: E402
+
+PHASES = ["load", "get_task_information", "insert_declarations", "get_file_basenames", "json"]
+
+TASK_TEMPLATE = """
+task {name} {{
+  input {{
+    Array[File] in_files
+  }}
+  command<<<
+  cat ~{{sep=" " in_files}} > {name}.out
+  >>>
+  output {{
+{outputs}
+  }}
+}}
+"""
+
+
+def task(name, glob_outputs=0):
+    outputs = [f'    File out_file = "{name}.out"']
+    outputs.extend(f'    Array[File] globbed_{i} = glob("{name}_{i}_*.txt")' for i in range(glob_outputs))
+    return TASK_TEMPLATE.format(name=name, outputs="\n".join(outputs))
+
+
+def call(name, in_files, indent="  "):
+    return f"{indent}call {name} {{\n{indent}  input:\n{indent}    in_files = {in_files},\n{indent}}}\n"
+
+
+def workflow(tasks, inputs, body, outputs):
+    input_lines = "\n".join(f"    {decl}" for decl in inputs)
+    output_lines = "\n".join(f"    {decl}" for decl in outputs)
+    return (
+        "version 1.0\n"
+        + "".join(tasks)
+        + f"workflow synthetic {{\n  input {{\n{input_lines}\n  }}\n{body}  output {{\n{output_lines}\n  }}\n}}\n"
+    )
+
+
+def chain_wdl(size):
+    """size calls in a line, each consuming the previous call's output."""
+    names = [f"RunStep{i}" for i in range(size)]
+    body = call(names[0], "[in_file]")
+    body += "".join(call(name, f"[{previous}.out_file]") for previous, name in zip(names, names[1:]))
+    outputs = [f"File {name}_out = {name}.out_file" for name in names]
+    return workflow([task(name) for name in names], ["File in_file"], body, outputs)
+
+
+def conditionals_wdl(size):
+    """size calls, each nested one conditional deeper than the last."""
+    names = [f"RunNested{i}" for i in range(size)]
+    body = call(names[0], "[in_file]")
+    for depth, (previous, name) in enumerate(zip(names, names[1:]), start=1):
+        indent = "  " * (depth + 1)
+        body += f"{'  ' * depth}if (flag_{depth % 4}) {{\n"
+        body += call(name, f"select_all([{previous}.out_file])", indent)
+    for depth in range(len(names) - 1, 0, -1):
+        body += f"{'  ' * depth}}}\n"
+    inputs = ["File in_file"] + [f"Boolean flag_{i}" for i in range(4)]
+    outputs = [f"File? {name}_out = {name}.out_file" for name in names[1:]]
+    return workflow([task(name) for name in names], inputs, body, outputs)
+
+
+def wide_select_all_wdl(size):
+    """one call consuming a select_all over size optional inputs and task outputs."""
+    producers = [f"RunProducer{i}" for i in range(max(1, size // 10))]
+    body = "".join(call(name, "[in_file_0]") for name in producers)
+    items = [f"in_file_{i}" for i in range(size)] + [f"{name}.out_file" for name in producers]
+    body += call("RunConsumer", f"select_all([{', '.join(items)}])")
+    inputs = ["File in_file_0"] + [f"File? in_file_{i}" for i in range(1, size)]
+    tasks = [task(name) for name in producers + ["RunConsumer"]]
+    return workflow(tasks, inputs, body, ["File out = RunConsumer.out_file"])
+
+
+def globs_wdl(size):
+    """size / 10 calls, each with 10 glob outputs."""
+    names = [f"RunGlob{i}" for i in range(max(1, size // 10))]
+    body = "".join(call(name, "[in_file]") for name in names)
+    outputs = [f"Array[File] {name}_globbed_{i} = {name}.globbed_{i}" for name in names for i in range(10)]
+    return workflow([task(name, glob_outputs=10) for name in names], ["File in_file"], body, outputs)
+
+
+def declarations_wdl(size):
+    """size workflow declarations, each choosing between a task output and the previous declaration."""
+    names = [f"RunDecl{i}" for i in range(size)]
+    body = call(names[0], "[in_file]")
+    previous_decl = f"{names[0]}.out_file"
+    for i, name in enumerate(names[1:], start=1):
+        body += f"  File decl_{i} = if (flag) then {previous_decl} else in_file\n"
+        body += call(name, f"[decl_{i}]")
+        previous_decl = f"decl_{i}"
+    inputs = ["File in_file", "Boolean flag"]
+    return workflow([task(name) for name in names], inputs, body, ["File out = RunDecl0.out_file"])
+
+
+SHAPES = {
+    "chain": chain_wdl,
+    "conditionals": conditionals_wdl,
+    "wide_select_all": wide_select_all_wdl,
+    "globs": globs_wdl,
+    "declarations": declarations_wdl,
+}
+
+
+def time_phases(wdl_text):
+    timings = {}
+
+    start = time.perf_counter()
+    doc = WDL.load("stdin", read_source=parse_wdl_workflow.make_text_reader(wdl_text))
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    task_inputs, task_names, declarations, scattered_tasks = parse_wdl_workflow.get_task_information(doc.workflow.body)
+    timings["get_task_information"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    task_inputs = parse_wdl_workflow.insert_declarations(task_inputs, declarations)
+    timings["insert_declarations"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    basenames = parse_wdl_workflow.get_file_basenames(doc.tasks)
+    basenames.update(parse_wdl_workflow.get_call_basenames(doc.workflow))
+    timings["get_file_basenames"] = time.perf_counter() - start
+
+    parsed = {
+        "inputs": parse_wdl_workflow.get_workflow_input_information(doc.workflow.inputs),
+        "task_names": task_names,
+        "task_inputs": task_inputs,
+        "basenames": basenames,
+        "outputs": parse_wdl_workflow.get_output_aliases(doc.workflow.outputs),
+        "scattered_tasks": scattered_tasks,
+    }
+    start = time.perf_counter()
+    json.dumps(parsed)
+    timings["json"] = time.perf_counter() - start
+    return timings
+
+
+def scaling_exponent(sizes, seconds):
+    """Slope of log(time) against log(size) between the smallest and largest size."""
+    if len(sizes) < 2 or seconds[0] <= 0 or seconds[-1] <= 0:
+        return None
+    return math.log(seconds[-1] / seconds[0]) / math.log(sizes[-1] / sizes[0])
+
+
+def run_benchmark(shapes, sizes, repeats):
+    # warm up the grammar so the first load doesn't include building the Lark parser
+    time_phases(chain_wdl(2))
+    results = {}
+    for shape in shapes:
+        runs = []
+        for size in sizes:
+            wdl_text = SHAPES[shape](size)
+            samples = [time_phases(wdl_text) for _ in range(repeats)]
+            runs.append(
+                {
+                    "size": size,
+                    "wdl_bytes": len(wdl_text),
+                    "median_seconds": {phase: statistics.median(s[phase] for s in samples) for phase in PHASES},
+                }
+            )
+        results[shape] = {
+            "runs": runs,
+            "scaling_exponent": {
+                phase: scaling_exponent(sizes, [run["median_seconds"][phase] for run in runs]) for phase in PHASES
+            },
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parse_wdl_workflow.py on synthetic workflows")
+    parser.add_argument("--shapes", nargs="+", choices=sorted(SHAPES), default=sorted(SHAPES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[25, 50, 100, 200])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", type=str, help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    sizes = sorted(args.sizes)
+    report = {
+        "python_version": platform.python_version(),
+        "miniwdl_version": parse_wdl_workflow.get_miniwdl_version(),
+        "sizes": sizes,
+        "repeats": args.repeats,
+        "results": run_benchmark(args.shapes, sizes, args.repeats),
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Microbenchmark for token creation and decryption in scripts/token_auth.py, against a freshly
+# generated ES-384 key. It compares:
+#
+#   create_per_call  the original create_token path: thumbprint, headers and JWT object rebuilt
+#                    for every token (kept below as legacy_create_token)
+#   create_signer    TokenSigner.create, with the per-key work done once
+#   decrypt          get_token_claims without a cache
+#   decrypt_cached   get_token_claims with a VerifiedTokenCache, after the first decrypt
+#
+# and prints tokens/sec for each.
+#
+# Usage, from the repository root:
+#   python3 test/python/benchmark_token_auth.py [--tokens 500] [--json]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from jwcrypto import jwe, jwk, jwt
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, REPO_ROOT)
+
+from scripts import token_auth  # noqa: E402
+
+PROJECT_CLAIMS = json.dumps({"owner": [1, 2, 3], "member": list(range(100)), "viewer": list(range(1000))})
+
+
+def legacy_create_token(private_key, userid, project_claims=None, service_identity=None, expiration=3600):
+    parsed_project_claims = json.loads(project_claims) if project_claims else None
+    token_auth.validate_claims(userid, parsed_project_claims, service_identity)
+    expires_at = int(time.time()) + int(expiration)
+    jwt_payload = {
+        "sub": str(userid),
+        "iat": int(time.time()),
+        "nbf": int(time.time()),
+        "exp": expires_at,
+        "project_roles": parsed_project_claims,
+        "service_identity": service_identity,
+    }
+    jwt_headers = {"alg": "ES384", "typ": "JWT", "kid": private_key.thumbprint()}
+    jwt_token = jwt.JWT(header=jwt_headers, claims=jwt_payload)
+    jwt_token.make_signed_token(private_key)
+    protected_header = {"alg": "ECDH-ES", "enc": "A256CBC-HS512", "typ": "JWE", "kid": private_key.thumbprint()}
+    jwe_token = jwe.JWE(jwt_token.serialize(compact=True), recipient=private_key, protected=protected_header)
+    return {"token": jwe_token.serialize(compact=True), "expires_at": expires_at}
+
+
+def tokens_per_second(fn, count):
+    start = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    return count / (time.perf_counter() - start)
+
+
+def run_benchmark(count):
+    private_key = jwk.JWK.generate(kty="EC", crv="P-384")
+    signer = token_auth.TokenSigner(private_key)
+    tokens = [signer.create(i, PROJECT_CLAIMS)["token"] for i in range(count)]
+    cache = token_auth.VerifiedTokenCache(max_entries=count)
+    for token in tokens:
+        token_auth.get_token_claims(private_key, token, cache)
+
+    return {
+        "create_per_call": tokens_per_second(lambda i: legacy_create_token(private_key, i, PROJECT_CLAIMS), count),
+        "create_signer": tokens_per_second(lambda i: signer.create(i, PROJECT_CLAIMS), count),
+        "decrypt": tokens_per_second(lambda i: token_auth.get_token_claims(private_key, tokens[i]), count),
+        "decrypt_cached": tokens_per_second(
+            lambda i: token_auth.get_token_claims(private_key, tokens[i], cache), count
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark token_auth.py token creation and decryption")
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+    args = parser.parse_args()
+
+    report = {"tokens": args.tokens, "tokens_per_second": run_benchmark(args.tokens)}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    for name, rate in report["tokens_per_second"].items():
+        print(f"{name:>16}: {rate:9.1f} tokens/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+import unittest
+import gzip
+import importlib.util
+import io
+import os
+import subprocess
+import sys
+import tempfile
+
+ALL_READS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "wiki-resources", "AllReads.py")
+spec = importlib.util.spec_from_file_location("AllReads", ALL_READS_PATH)
+AllReads = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(AllReads)
+# --jobs workers look their functions up by module name
+sys.modules["AllReads"] = AllReads
+
+
+# Test cases
+
+
+class TestExtractPairs(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, name, text, compress=False):
+        path = os.path.join(self.tmpdir.name, name)
+        data = text.encode("utf-8")
+        with open(path, "wb") as f:
+            f.write(gzip.compress(data) if compress else data)
+        return path
+
+    def extract(self, all_reads_text, compress=False, compact=False):
+        taxon_path = self.write("taxon.fasta", taxon_fasta, compress)
+        all_reads_path = self.write("all_reads", all_reads_text, compress)
+        out = io.BytesIO()
+        count = AllReads.extract_pairs(all_reads_path, AllReads.read_taxon_ids(taxon_path, compact), out)
+        return count, out.getvalue().decode("utf-8")
+
+    def test_two_line_fasta(self):
+        count, output = self.extract(all_reads_fasta)
+        self.assertEqual(count, 4)
+        self.assertEqual(output, expected_fasta)
+
+    def test_multi_line_fasta(self):
+        wrapped = all_reads_fasta.replace("ACGTACGT", "ACGT\nACGT")
+        count, output = self.extract(wrapped)
+        self.assertEqual(count, 4)
+        self.assertEqual(output, expected_fasta.replace("ACGTACGT", "ACGT\nACGT"))
+
+    def test_fastq(self):
+        count, output = self.extract(all_reads_fastq)
+        self.assertEqual(count, 4)
+        self.assertEqual(output, expected_fastq)
+
+    def test_gzip_and_compact_ids(self):
+        count, output = self.extract(all_reads_fasta, compress=True, compact=True)
+        self.assertEqual(count, 4)
+        self.assertEqual(output, expected_fasta)
+
+    def test_records_split_across_blocks(self):
+        for text, expected in [(all_reads_fasta, expected_fasta), (all_reads_fastq, expected_fastq)]:
+            for block_size in [1, 7, 50]:
+                with self.subTest(block_size=block_size):
+                    out = []
+                    for headers, record in AllReads.iter_record_blocks(io.BytesIO(text.encode()), block_size):
+                        out.extend(record(i) for i in range(len(headers)))
+                    self.assertEqual(b"".join(out).decode(), text)
+
+    def test_chunk_ranges_start_on_records(self):
+        for name, text in [("all.fasta", all_reads_fasta), ("all.fastq", all_reads_fastq)]:
+            path = self.write(name, text)
+            for chunks in [1, 3, 50, len(text)]:
+                with self.subTest(name=name, chunks=chunks):
+                    ranges = AllReads.chunk_ranges(path, chunks)
+                    self.assertEqual("".join(text[start:end] for start, end in ranges), text)
+                    for start, end in ranges:
+                        self.assertIn(text[start], ">@")
+
+    def test_parallel_matches_sequential(self):
+        taxon_ids = AllReads.read_taxon_ids(self.write("taxon.fasta", taxon_fasta))
+        for text, expected in [(all_reads_fasta, expected_fasta), (all_reads_fastq, expected_fastq)]:
+            with self.subTest(expected=expected[:30]):
+                out = io.BytesIO()
+                count = AllReads.extract_pairs_parallel(self.write("all_reads", text), taxon_ids, out, jobs=3)
+                self.assertEqual(count, 4)
+                self.assertEqual(out.getvalue().decode("utf-8"), expected)
+
+    def test_parallel_fastq_with_quality_line_starting_with_at_near_the_end(self):
+        all_reads = all_reads_fastq.replace("AAAA\n+\nIIII\n", "AAAA\n+\n@III\n")
+        expected = expected_fastq.replace("AAAA\n+\nIIII\n", "AAAA\n+\n@III\n")
+        taxon_ids = AllReads.read_taxon_ids(self.write("taxon.fasta", taxon_fasta))
+        all_reads_path = self.write("all_reads", all_reads)
+        for jobs in range(1, 9):
+            with self.subTest(jobs=jobs):
+                out = io.BytesIO()
+                count = AllReads.extract_pairs_parallel(all_reads_path, taxon_ids, out, jobs=jobs)
+                self.assertEqual(count, 4)
+                self.assertEqual(out.getvalue().decode("utf-8"), expected)
+
+    def test_indexed_lookup_matches_scan(self):
+        wrapped = all_reads_fasta.replace("ACGTACGT", "ACGT\nACGT")
+        cases = [(all_reads_fasta, expected_fasta), (wrapped, expected_fasta.replace("ACGTACGT", "ACGT\nACGT")),
+                 (all_reads_fastq, expected_fastq)]
+        for text, expected in cases:
+            for compact in [False, True]:
+                with self.subTest(expected=expected[:30], compact=compact):
+                    all_reads_path = self.write("all_reads", text)
+                    taxon_ids = AllReads.read_taxon_ids(self.write("taxon.fasta", taxon_fasta), compact)
+                    out = io.BytesIO()
+                    with AllReads.open_read_index(all_reads_path) as index:
+                        count = AllReads.extract_pairs_indexed(all_reads_path, taxon_ids, out, index)
+                    self.assertEqual(count, 4)
+                    self.assertEqual(out.getvalue().decode("utf-8"), expected)
+
+    def test_read_index_built_from_merged_runs(self):
+        all_reads_path = self.write("all_reads", all_reads_fastq)
+        AllReads.build_read_index(all_reads_path)
+        with open(AllReads.read_index_path(all_reads_path), "rb") as f:
+            expected = f.read()
+        for run_size in [1, 2, 4]:
+            with self.subTest(run_size=run_size):
+                AllReads.build_read_index(all_reads_path, run_size=run_size)
+                with open(AllReads.read_index_path(all_reads_path), "rb") as f:
+                    self.assertEqual(f.read(), expected)
+                # the runs are cleaned up
+                self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ["all_reads", "all_reads.idx"])
+        with AllReads.ReadIndex(all_reads_path) as index:
+            self.assertEqual(list(index.hashes), sorted(index.hashes))
+            self.assertEqual(sorted(index.offsets), [0, 36, 72, 104, 136, 168])
+
+    def test_read_index_is_rebuilt_when_stale(self):
+        all_reads_path = self.write("all_reads", all_reads_fasta)
+        AllReads.build_read_index(all_reads_path)
+        with AllReads.ReadIndex(all_reads_path) as index:
+            self.assertEqual(len(index.hashes), 6)
+        self.write("all_reads", all_reads_fasta + ">NR:0:NT:0:read_d/1\nA\n")
+        with self.assertRaises(ValueError):
+            AllReads.ReadIndex(all_reads_path)
+        with AllReads.open_read_index(all_reads_path) as index:
+            self.assertEqual(index.locate(AllReads.HashedIdSet.hash(b"read_d/1")), [(len(all_reads_fasta), 22)])
+            self.assertEqual(index.locate(AllReads.HashedIdSet.hash(b"read_e/1")), [])
+
+    def test_split_mates_into_bgzf(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        for text, expected in [(all_reads_fasta, expected_fasta), (all_reads_fastq, expected_fastq)]:
+            with self.subTest(expected=expected[:30]):
+                paths = [os.path.join(self.tmpdir.name, name) for name in ("r1.gz", "r2.gz")]
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    # tiny batches and writes that split records exercise ordering and carried over records
+                    writers = [AllReads.BgzfWriter(path, executor, batch_size=10, max_pending=2) for path in paths]
+                    splitter = AllReads.MateSplitter(*writers)
+                    data = expected.encode("utf-8")
+                    for i in range(0, len(data), 7):
+                        splitter.write(data[i:i + 7])
+                    splitter.close()
+                    for writer in writers:
+                        writer.close()
+                mates = ([], [])
+                lines_per_record = 4 if expected[0] == "@" else 2
+                lines = expected.splitlines(keepends=True)
+                records = ["".join(lines[i:i + lines_per_record]) for i in range(0, len(lines), lines_per_record)]
+                for record in records:
+                    mates[record.split("\n")[0].endswith("/2")].append(record)
+                for path, mate_records in zip(paths, mates):
+                    with open(path, "rb") as f:
+                        compressed = f.read()
+                    self.assertEqual(gzip.decompress(compressed).decode("utf-8"), "".join(mate_records))
+                    self.assertTrue(compressed.endswith(AllReads.BGZF_EOF))
+                    # every block is a gzip member whose BC subfield holds its size less one
+                    offset = 0
+                    while offset < len(compressed):
+                        self.assertEqual(compressed[offset + 12:offset + 14], b"BC")
+                        offset += int.from_bytes(compressed[offset + 16:offset + 18], "little") + 1
+                    self.assertEqual(offset, len(compressed))
+
+    def test_cli_split_mates(self):
+        r1, r2 = (os.path.join(self.tmpdir.name, name) for name in ("r1.fasta.gz", "r2.fasta.gz"))
+        subprocess.run(
+            [sys.executable, ALL_READS_PATH, self.write("taxon.fasta", taxon_fasta),
+             self.write("all.fasta", all_reads_fasta), "--r1", r1, "--r2", r2, "--threads", "2"],
+            check=True,
+        )
+        lines = expected_fasta.splitlines(keepends=True)
+        with gzip.open(r1, "rt") as f:
+            self.assertEqual(f.read(), "".join(lines[0:2] + lines[4:6]))
+        with gzip.open(r2, "rt") as f:
+            self.assertEqual(f.read(), "".join(lines[2:4] + lines[6:8]))
+
+    def test_hashed_id_set(self):
+        ids = AllReads.HashedIdSet([b"read1", b"read2", b"read1"])
+        self.assertEqual(len(ids), 2)
+        self.assertIn(b"read2", ids)
+        self.assertNotIn(b"read3", ids)
+
+
+class TestMultiTaxonExtraction(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_single_pass_routes_pairs_to_every_taxon(self):
+        taxon_paths = [
+            self.write("573.fasta", taxon_fasta),
+            self.write("none.fasta", ""),
+            self.write("b.fasta", taxon_b),
+        ]
+        output_paths = [os.path.join(self.tmpdir.name, f"out_{i}.fasta") for i in range(3)]
+        for compact in [False, True]:
+            with self.subTest(compact=compact):
+                index = AllReads.read_taxon_index(taxon_paths, compact)
+                # max_open=1 and a tiny buffer force files to be closed and reopened for appending
+                with AllReads.TaxonWriters(output_paths, buffer_size=1, max_open=1) as writers:
+                    counts = AllReads.extract_taxa(self.write("all.fasta", all_reads_fasta), index, writers, compact)
+                self.assertEqual(counts, [4, 0, 4])
+                outputs = []
+                for path in output_paths:
+                    with open(path) as f:
+                        outputs.append(f.read())
+                self.assertEqual(outputs, [expected_fasta, "", expected_b])
+
+    def test_cli_with_taxon_map(self):
+        taxon_paths = [self.write("t1.fasta", taxon_fasta), self.write("b.fasta", taxon_b)]
+        taxon_map = self.write("taxa.tsv", f"573\t{taxon_paths[0]}\nb\t{taxon_paths[1]}\n")
+        all_reads = self.write("all.fasta", all_reads_fasta)
+        for options in [["--jobs", "1"], ["--jobs", "2"], ["--index"]]:
+            with self.subTest(options=options):
+                output_dir = os.path.join(self.tmpdir.name, f"out_{options[-1]}")
+                subprocess.run(
+                    [sys.executable, ALL_READS_PATH, all_reads, "--taxon-map", taxon_map, "--output-dir", output_dir]
+                    + options,
+                    check=True,
+                )
+                with open(os.path.join(output_dir, "573.fasta")) as f:
+                    self.assertEqual(f.read(), expected_fasta)
+                with open(os.path.join(output_dir, "b.fasta")) as f:
+                    self.assertEqual(f.read(), expected_b)
+                self.assertEqual(sorted(os.listdir(output_dir)), ["573.fasta", "b.fasta"])
+
+    def test_cli_rejects_taxa_with_the_same_output_name(self):
+        os.makedirs(os.path.join(self.tmpdir.name, "other"))
+        taxon_path = self.write("573.fasta", taxon_fasta)
+        same_stem = self.write(os.path.join("other", "573.fastq"), taxon_b)
+        taxon_map = self.write("taxa.tsv", f"9\t{taxon_path}\nb\t{same_stem}\n9\t{same_stem}\n")
+        all_reads = self.write("all.fasta", all_reads_fasta)
+        output_dir = os.path.join(self.tmpdir.name, "out")
+        cases = [(["--taxon", taxon_path, "--taxon", same_stem], b"573"), (["--taxon-map", taxon_map], b"named 9;")]
+        for options, name in cases:
+            with self.subTest(options=options):
+                result = subprocess.run(
+                    [sys.executable, ALL_READS_PATH, all_reads, "--output-dir", output_dir] + options,
+                    capture_output=True,
+                )
+                self.assertEqual(result.returncode, 2)
+                self.assertIn(name, result.stderr)
+                self.assertFalse(os.path.exists(output_dir))
+
+    def test_cli_rejects_single_taxon_outputs_with_taxon_map(self):
+        taxon_map = self.write("taxa.tsv", f"573\t{self.write('t1.fasta', taxon_fasta)}\n")
+        all_reads = self.write("all.fasta", all_reads_fasta)
+        output_dir = os.path.join(self.tmpdir.name, "out")
+        for options in [["--output", "out.fasta"], ["--r1", "r1.gz", "--r2", "r2.gz"]]:
+            with self.subTest(options=options):
+                result = subprocess.run(
+                    [sys.executable, ALL_READS_PATH, all_reads, "--taxon-map", taxon_map, "--output-dir", output_dir]
+                    + options,
+                    capture_output=True,
+                )
+                self.assertEqual(result.returncode, 2)
+                self.assertIn(b"--taxon/--taxon-map", result.stderr)
+                self.assertFalse(os.path.exists(output_dir))
+
+
+# Test data
+
+taxon_fasta = """>NR:573:573:1280:NT:573:573:1280:family_nr:543:family_nt:543:genus_nr:570:genus_nt:570:read_a/1
+ACGT
+>NR:573:573:1280:NT:573:573:1280:family_nr:543:family_nt:543:genus_nr:570:genus_nt:570:read_c/2
+ACGT
+"""
+
+taxon_b = """>NR:1:1:1:NT:1:1:1:family_nr:1:family_nt:1:genus_nr:1:genus_nt:1:read_b/2
+CCCC
+>NR:1:1:1:NT:1:1:1:family_nr:1:family_nt:1:genus_nr:1:genus_nt:1:read_c/1
+ACGT
+"""
+
+expected_b = """>NR:0:NT:0:read_b/1
+GGGG
+>NR:0:NT:0:read_b/2
+CCCC
+>NR:0:NT:0:read_c/1
+ACGTACGT
+>NR:573:NT:573:read_c/2
+AAAA
+"""
+
+all_reads_fasta = """>NR:573:NT:573:read_a/1
+ACGTACGT
+>NR:573:NT:573:read_a/2
+TTTTACGT
+>NR:0:NT:0:read_b/1
+GGGG
+>NR:0:NT:0:read_b/2
+CCCC
+>NR:0:NT:0:read_c/1
+ACGTACGT
+>NR:573:NT:573:read_c/2
+AAAA
+"""
+
+expected_fasta = """>NR:573:NT:573:read_a/1
+ACGTACGT
+>NR:573:NT:573:read_a/2
+TTTTACGT
+>NR:0:NT:0:read_c/1
+ACGTACGT
+>NR:573:NT:573:read_c/2
+AAAA
+"""
+
+all_reads_fastq = """@NR:573:NT:573:read_a/1
+ACGT
++
+@III
+@NR:573:NT:573:read_a/2
+TTTT
++
+IIII
+@NR:0:NT:0:read_b/1
+GGGG
++
+IIII
+@NR:0:NT:0:read_b/2
+CCCC
++
+IIII
+@NR:0:NT:0:read_c/1
+ACGT
++
+IIII
+@NR:573:NT:573:read_c/2
+AAAA
++
+IIII
+"""
+
+expected_fastq = """@NR:573:NT:573:read_a/1
+ACGT
++
+@III
+@NR:573:NT:573:read_a/2
+TTTT
++
+IIII
+@NR:0:NT:0:read_c/1
+ACGT
++
+IIII
+@NR:573:NT:573:read_c/2
+AAAA
++
+IIII
+"""
@@ -6,6 +6,12 @@ import sys
 from io import StringIO
 import asyncio
 import json
+import os
+import socket
+import subprocess
+import tempfile
+import time
+import types
 
 import WDL
 
@@ -94,6 +100,450 @@ class TestJSONOutput(unittest.TestCase):
             self.assertNotIn(task, value)
 
 
+class TestInsertDeclarations(unittest.TestCase):
+    def test_nested_declarations(self):
+        task_inputs = {
+            "RunA": ["WorkflowInput.docker_image_id"],
+            "RunB": ["WorkflowInput.docker_image_id", "WorkflowInput.outer", "RunA.out"],
+        }
+        decls = {
+            "outer": ["WorkflowInput.inner", "RunA.out", "RunA.other"],
+            "inner": ["RunA.out", "WorkflowInput.fastqs_0"],
+        }
+        result = parse_wdl_workflow.insert_declarations(task_inputs, decls)
+        self.assertEqual(result["RunA"], ["WorkflowInput.docker_image_id"])
+        self.assertEqual(
+            result["RunB"], ["WorkflowInput.docker_image_id", "RunA.out", "WorkflowInput.fastqs_0", "RunA.other"]
+        )
+
+    def test_declaration_cycles_terminate(self):
+        task_inputs = {"RunA": ["WorkflowInput.a"]}
+        decls = {"a": ["WorkflowInput.b", "RunX.x"], "b": ["WorkflowInput.a", "RunY.y"]}
+        result = parse_wdl_workflow.insert_declarations(task_inputs, decls)
+        self.assertEqual(sorted(result["RunA"]), ["RunX.x", "RunY.y"])
+
+    def test_forward_references_are_not_cycles(self):
+        # b is still waiting to be expanded when c refers to it, but it isn't on a cycle
+        task_inputs = {"UsesC": ["WorkflowInput.c"]}
+        decls = {
+            "a": ["WorkflowInput.b", "WorkflowInput.c"],
+            "c": ["WorkflowInput.b", "X.out"],
+            "b": ["T.out"],
+        }
+        result = parse_wdl_workflow.insert_declarations(task_inputs, decls)
+        self.assertEqual(result["UsesC"], ["T.out", "X.out"])
+
+    def test_declarations_in_parsed_workflow(self):
+        parsed = parse_wdl_workflow.parse_wdl(nested_decl_wdl)
+        self.assertEqual(parsed["task_inputs"]["RunConsumer"], ["RunProducer.out_fa", "WorkflowInput.fallback_fa"])
+
+
+class TestReferenceWalker(unittest.TestCase):
+    def setUp(self):
+        self.parsed = parse_wdl_workflow.parse_wdl(expressions_wdl)
+
+    def test_supported_expressions(self):
+        self.assertEqual(
+            self.parsed["task_inputs"]["RunConsumer"],
+            [
+                "RunProducer.out_fa",
+                "RunProducer.out_fa",
+                "WorkflowInput.in_fa",
+                "WorkflowInput.prefix",
+                "RunProducer.out_fa",
+                "WorkflowInput.in_fa",
+                "WorkflowInput.in_fa",
+            ],
+        )
+
+    def test_unregistered_functions_have_no_references(self):
+        self.assertEqual(self.parsed["task_inputs"]["RunProducer"], ["WorkflowInput.in_fa"])
+
+    def test_memoized_by_node(self):
+        doc = WDL.load("stdin", read_source=parse_wdl_workflow.make_text_reader(expressions_wdl))
+        expression = doc.workflow.body[1].inputs["fas"]
+        walker = parse_wdl_workflow.ReferenceWalker()
+        first = walker.references(expression)
+        with patch.object(parse_wdl_workflow, "get_child_expressions") as get_child_expressions:
+            self.assertEqual(walker.references(expression), first)
+            get_child_expressions.assert_not_called()
+
+    def test_wide_array(self):
+        items = ", ".join(f"in_fa_{i}" for i in range(500))
+        inputs = "\n".join(f"    File in_fa_{i}" for i in range(500))
+        wdl = wide_array_wdl.replace("INPUTS", inputs).replace("ITEMS", items)
+        parsed = parse_wdl_workflow.parse_wdl(wdl)
+        self.assertEqual(len(parsed["task_inputs"]["RunConsumer"]), 500)
+
+    def test_deep_nesting(self):
+        pos = WDL.Error.SourcePosition("stdin", "stdin", 1, 1, 1, 1)
+        expression = WDL.Expr.Get(pos, WDL.Expr.Ident(pos, "RunProducer.out_fa"), None)
+        for _ in range(sys.getrecursionlimit() * 2):
+            expression = WDL.Expr.Array(pos, [expression])
+        self.assertEqual(parse_wdl_workflow.parse_input_item(expression), ["RunProducer.out_fa"])
+
+
+class TestScattersAndSubWorkflows(unittest.TestCase):
+    def setUp(self):
+        self.parsed = parse_wdl_workflow.parse_wdl(scatter_wdl, imports={"chunk_lib.wdl": chunk_lib_wdl})
+
+    def test_task_names(self):
+        self.assertEqual(self.parsed["task_names"], ["RunSplit", "RunAlign", "AlignSub", "RunMerge"])
+        self.assertEqual(self.parsed["scattered_tasks"], ["RunAlign"])
+
+    def test_task_inputs(self):
+        task_inputs = self.parsed["task_inputs"]
+        self.assertEqual(task_inputs["RunAlign"], ["RunSplit.chunks"])
+        self.assertEqual(task_inputs["AlignSub"], ["WorkflowInput.in_fa"])
+        self.assertEqual(task_inputs["RunMerge"], ["RunAlign.aligned_fa", "AlignSub.aligned_fa"])
+
+    def test_sibling_scatters_can_share_a_variable_name(self):
+        parsed = parse_wdl_workflow.parse_wdl(sibling_scatters_wdl)
+        task_inputs = parsed["task_inputs"]
+        self.assertEqual(task_inputs["AlignA"], ["SplitA.chunks"])
+        self.assertEqual(task_inputs["AlignB"], ["SplitB.chunks"])
+        self.assertEqual(task_inputs["AlignPairs"], ["SplitA.chunks", "SplitB.chunks"])
+        self.assertEqual(parsed["scattered_tasks"], ["AlignA", "AlignB", "AlignPairs"])
+
+    def test_basenames(self):
+        basenames = self.parsed["basenames"]
+        self.assertEqual(basenames["RunSplit.chunks"], "chunk_*.fa")
+        self.assertEqual(basenames["RunAlign.aligned_fa"], "aligned.fa")
+        self.assertEqual(basenames["AlignSub.aligned_fa"], "sub_aligned.fa")
+        self.assertEqual(self.parsed["outputs"]["merged_fa"], "RunMerge.merged_fa")
+        self.assertEqual(self.parsed["outputs"]["aligned_fas"], "RunAlign.aligned_fa")
+
+    def test_imports_from_directory(self):
+        with tempfile.TemporaryDirectory() as import_dir:
+            with open(os.path.join(import_dir, "chunk_lib.wdl"), "w") as f:
+                f.write(chunk_lib_wdl)
+            self.assertEqual(parse_wdl_workflow.parse_wdl(scatter_wdl, import_dir=import_dir), self.parsed)
+
+    def test_missing_import(self):
+        with self.assertRaises(WDL.Error.ImportError):
+            parse_wdl_workflow.parse_wdl(scatter_wdl)
+
+    def test_bundle_on_stdin(self):
+        bundle = json.dumps({"wdl_text": scatter_wdl, "imports": {"chunk_lib.wdl": chunk_lib_wdl}})
+        with patch("sys.stdin", StringIO(bundle)), patch("sys.stdout", new_callable=StringIO):
+            parse_wdl_workflow.main(bundle=True)
+            self.assertEqual(json.loads(sys.stdout.getvalue()), self.parsed)
+
+
+class TestGraphOutput(unittest.TestCase):
+    def setUp(self):
+        self.parsed = parse_wdl_workflow.parse_wdl(test_wdl)
+        self.graph = parse_wdl_workflow.format_output(self.parsed, "graph")["graph"]
+
+    def get_edge(self, source, target):
+        edges = [edge for edge in self.graph["edges"] if edge["from"] == source and edge["to"] == target]
+        self.assertEqual(len(edges), 1)
+        return edges[0]
+
+    def test_flat_output_unchanged(self):
+        self.assertEqual(parse_wdl_workflow.format_output(self.parsed), self.parsed)
+        graph_output = parse_wdl_workflow.format_output(self.parsed, "graph")
+        self.assertEqual(graph_output["task_inputs"], self.parsed["task_inputs"])
+
+    def test_nodes(self):
+        task_nodes = [node["id"] for node in self.graph["nodes"] if node["type"] == "task"]
+        self.assertEqual(task_nodes, self.parsed["task_names"])
+        input_nodes = {node["id"]: node["input_type"] for node in self.graph["nodes"] if node["type"] == "input"}
+        self.assertEqual(input_nodes["WorkflowInput.fastqs_0"], "File")
+        self.assertEqual(input_nodes["WorkflowInput.host_genome"], "String")
+
+    def test_edges(self):
+        edge = self.get_edge("RunValidateInput", "RunGsnapFilter")
+        self.assertEqual(
+            edge["variables"], ["RunValidateInput.valid_input1_fastq", "RunValidateInput.valid_input2_fastq"]
+        )
+        self.assertEqual(edge["files"], ["valid_input1.fastq", "valid_input2.fastq"])
+        edge = self.get_edge("RunBowtie2_bowtie2_human_out", "RunGsnapFilter")
+        self.assertEqual(edge["files"], ["bowtie2_human_1.fa", "bowtie2_human_2.fa", "bowtie2_human_merged.fa"])
+        edge = self.get_edge("WorkflowInput.fastqs_0", "RunValidateInput")
+        self.assertEqual(edge["files"], [])
+
+    def test_topological_order(self):
+        self.assertEqual(
+            self.graph["topological_order"], ["RunValidateInput", "RunBowtie2_bowtie2_human_out", "RunGsnapFilter"]
+        )
+        # dependencies win over the order tasks were declared in
+        self.assertEqual(
+            parse_wdl_workflow.get_topological_order(["A", "B", "C"], [("C", "A"), ("A", "B")]), ["C", "A", "B"]
+        )
+        with self.assertRaises(ValueError):
+            parse_wdl_workflow.get_topological_order(["A", "B"], [("A", "B"), ("B", "A")])
+
+    def test_outputs(self):
+        outputs = {output["name"]: output for output in self.graph["outputs"]}
+        self.assertEqual(
+            outputs["gsnap_filter_out_gsnap_filter_1_fa"],
+            {
+                "name": "gsnap_filter_out_gsnap_filter_1_fa",
+                "from": "RunGsnapFilter",
+                "variable": "gsnap_filter_1_fa",
+                "file": "gsnap_filter_1.fa",
+            },
+        )
+
+    def test_scattered_tasks(self):
+        parsed = parse_wdl_workflow.parse_wdl(scatter_wdl, imports={"chunk_lib.wdl": chunk_lib_wdl})
+        graph = parse_wdl_workflow.build_graph(parsed)
+        scattered = [node["id"] for node in graph["nodes"] if node.get("scattered")]
+        self.assertEqual(scattered, ["RunAlign"])
+        edge = [edge for edge in graph["edges"] if edge["to"] == "RunAlign"][0]
+        self.assertEqual(edge["from"], "RunSplit")
+        self.assertEqual(edge["files"], ["chunk_*.fa"])
+        self.assertEqual(graph["topological_order"], ["RunSplit", "RunAlign", "AlignSub", "RunMerge"])
+
+    def test_serve_graph_format(self):
+        outfile = StringIO()
+        parse_wdl_workflow.serve(StringIO(json.dumps({"wdl": test_wdl, "format": "graph"}) + "\n"), outfile)
+        self.assertEqual(json.loads(outfile.getvalue())["result"]["graph"], self.graph)
+
+
+class TestServeMode(unittest.TestCase):
+    def test_serve_matches_main(self):
+        with patch("sys.stdin", StringIO(test_wdl)), patch("sys.stdout", new_callable=StringIO):
+            parse_wdl_workflow.main()
+            expected = json.loads(sys.stdout.getvalue())
+        requests = [json.dumps({"id": 1, "wdl": test_wdl}), "", json.dumps({"id": 2, "wdl": test_wdl})]
+        outfile = StringIO()
+        parse_wdl_workflow.serve(StringIO("\n".join(requests) + "\n"), outfile)
+        responses = [json.loads(line) for line in outfile.getvalue().splitlines()]
+        self.assertEqual([response["id"] for response in responses], [1, 2])
+        for response in responses:
+            self.assertEqual(response["result"], expected)
+
+    def test_serve_reports_errors_and_continues(self):
+        requests = [json.dumps({"id": "bad", "wdl": "version 1.0\ntask {"}), "not json", json.dumps({"wdl": test_wdl})]
+        outfile = StringIO()
+        parse_wdl_workflow.serve(StringIO("\n".join(requests) + "\n"), outfile)
+        responses = [json.loads(line) for line in outfile.getvalue().splitlines()]
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(responses[0]["id"], "bad")
+        self.assertIn("error", responses[0])
+        self.assertIn("error", responses[1])
+        self.assertIn("result", responses[2])
+
+
+class TestUnixSocketServer(unittest.TestCase):
+    def test_connections_reuse_the_warm_parser(self):
+        # The server counts every Lark parser it builds, in itself or in the children it forks
+        server_code = (
+            "import sys, lark\n"
+            "from scripts import parse_wdl_workflow\n"
+            "builds_path, socket_path = sys.argv[1:]\n"
+            "lark_init = lark.Lark.__init__\n"
+            "def counting_init(self, *args, **kwargs):\n"
+            "    with open(builds_path, 'a') as f:\n"
+            "        f.write('build\\n')\n"
+            "    lark_init(self, *args, **kwargs)\n"
+            "lark.Lark.__init__ = counting_init\n"
+            "parse_wdl_workflow.serve_unix_socket(socket_path)\n"
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            builds_path = os.path.join(tmpdir, "builds")
+            socket_path = os.path.join(tmpdir, "parse.sock")
+            repo_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+            server = subprocess.Popen([sys.executable, "-c", server_code, builds_path, socket_path], cwd=repo_root)
+            try:
+                for _ in range(300):
+                    if os.path.exists(socket_path):
+                        break
+                    time.sleep(0.1)
+                with open(builds_path) as f:
+                    warm_builds = len(f.readlines())
+                self.assertGreater(warm_builds, 0)
+                for request_id in [1, 2]:
+                    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                        client.connect(socket_path)
+                        client.sendall((json.dumps({"id": request_id, "wdl": test_wdl}) + "\n").encode("utf-8"))
+                        client.shutdown(socket.SHUT_WR)
+                        response = json.loads(client.makefile().readline())
+                    self.assertEqual(response["id"], request_id)
+                    self.assertIn("result", response)
+                with open(builds_path) as f:
+                    self.assertEqual(len(f.readlines()), warm_builds)
+            finally:
+                server.terminate()
+                server.wait()
+
+
+class TestParseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = parse_wdl_workflow.ParseCache(self.tmpdir.name, max_entries=2)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_hit_skips_wdl_load(self):
+        parsed = parse_wdl_workflow.parse_wdl(test_wdl, self.cache)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+        with patch("WDL.load", side_effect=AssertionError("WDL.load called on a cache hit")):
+            self.assertEqual(parse_wdl_workflow.parse_wdl(test_wdl, self.cache), parsed)
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_key_includes_miniwdl_version(self):
+        key = self.cache.key(test_wdl)
+        with patch.object(parse_wdl_workflow, "get_miniwdl_version", return_value="0.0.0"):
+            other_cache = parse_wdl_workflow.ParseCache(self.tmpdir.name)
+        self.assertNotEqual(key, other_cache.key(test_wdl))
+        self.assertNotEqual(key, self.cache.key(test_wdl + "\n"))
+
+    def test_lru_eviction(self):
+        for i, text in enumerate(["a", "b", "c"]):
+            self.cache.put(text, {"n": i})
+            path = os.path.join(self.tmpdir.name, f"{self.cache.key(text)}.json")
+            os.utime(path, (i, i))
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), {"n": 1})
+        # "b" is now the most recently used, so adding "d" evicts "c"
+        self.cache.put("d", {"n": 3})
+        self.assertIsNone(self.cache.get("c"))
+        self.assertEqual(self.cache.get("b"), {"n": 1})
+
+    def test_eviction_skips_entries_removed_by_other_processes(self):
+        self.cache.put("a", {"n": 0})
+        self.cache.put("b", {"n": 1})
+        # another process adds "c", then evicts "a" after this one listed the directory
+        with open(os.path.join(self.tmpdir.name, f"{self.cache.key('c')}.json"), "w") as f:
+            json.dump({"n": 2}, f)
+        entries = self.cache._entries()
+        os.unlink(os.path.join(self.tmpdir.name, f"{self.cache.key('a')}.json"))
+        with patch.object(self.cache, "_entries", return_value=entries):
+            self.cache.evict()
+        self.assertEqual(self.cache.stats()["entries"], 2)
+
+    def test_write_errors_are_not_fatal(self):
+        with patch("os.replace", side_effect=OSError("disk full")):
+            self.cache.put("a", {"n": 0})
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_warm_cache(self):
+        with tempfile.TemporaryDirectory() as wdl_dir:
+            with open(os.path.join(wdl_dir, "host_filter.wdl"), "w") as f:
+                f.write(test_wdl)
+            stats = parse_wdl_workflow.warm_cache(self.cache, [wdl_dir])
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+
+class TestBatchMode(unittest.TestCase):
+    def test_batch_matches_single_parse(self):
+        expected = parse_wdl_workflow.parse_wdl(test_wdl)
+        stages = [
+            {"stage_name": "Host Filtering", "wdl_text": test_wdl},
+            {"stage_name": "Experimental", "wdl_text": test_wdl.replace("idseq_host_filter", "idseq_experimental")},
+        ]
+        parsed = parse_wdl_workflow.parse_batch(stages, max_workers=2)
+        self.assertEqual(list(parsed.keys()), ["Host Filtering", "Experimental"])
+        for stage_info in parsed.values():
+            self.assertEqual(stage_info, expected)
+
+    def test_batch_uses_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = parse_wdl_workflow.ParseCache(cache_dir)
+            stages = [{"stage_name": "Host Filtering", "wdl_text": test_wdl}]
+            first = parse_wdl_workflow.parse_batch(stages, cache)
+            with patch("WDL.load", side_effect=AssertionError("WDL.load called on a cache hit")):
+                self.assertEqual(parse_wdl_workflow.parse_batch(stages, cache), first)
+            self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_batch_raises_on_invalid_stage(self):
+        stages = [
+            {"stage_name": "Host Filtering", "wdl_text": test_wdl},
+            {"stage_name": "Broken", "wdl_text": "version 1.0\ntask {"},
+        ]
+        with self.assertRaisesRegex(parse_wdl_workflow.StageParseError, "^Broken: SyntaxError"):
+            parse_wdl_workflow.parse_batch(stages)
+
+
+class TestStartup(unittest.TestCase):
+    repo_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+    parser_script = os.path.join(repo_root, "scripts", "parse_wdl_workflow.py")
+
+    def run_parser(self, wdl_text, cache_dir):
+        cmd = [sys.executable, "-X", "importtime", self.parser_script, "--cache-dir", cache_dir]
+        result = subprocess.run(cmd, input=wdl_text, capture_output=True, text=True, check=True)
+        imported = [line.rsplit("|", 1)[-1].strip() for line in result.stderr.splitlines()]
+        return json.loads(result.stdout), imported
+
+    def test_cache_hit_does_not_import_miniwdl(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold, cold_imports = self.run_parser(test_wdl, cache_dir)
+            warm, warm_imports = self.run_parser(test_wdl, cache_dir)
+        self.assertEqual(warm, cold)
+        self.assertIn("WDL._parser", cold_imports)
+        self.assertEqual([module for module in warm_imports if module.startswith(("WDL", "lark"))], [])
+
+    def test_serialized_grammar_is_reused(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.run_parser(test_wdl, cache_dir)
+            grammar_files = os.listdir(os.path.join(cache_dir, "grammar"))
+            self.assertEqual(len(grammar_files), 1)
+            # a different document misses the parse cache, but loads the parser saved by the first run
+            expected = parse_wdl_workflow.parse_wdl(nested_decl_wdl)
+            parsed, _ = self.run_parser(nested_decl_wdl, cache_dir)
+            self.assertEqual(parsed, expected)
+            self.assertEqual(os.listdir(os.path.join(cache_dir, "grammar")), grammar_files)
+
+
+class TestGrammarCacheFallback(unittest.TestCase):
+    def test_hook_is_not_installed_when_miniwdl_internals_change(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            renamed = types.SimpleNamespace(_parser=types.SimpleNamespace(_lark_cache={}))
+            with patch.object(parse_wdl_workflow, "WDL", renamed):
+                parse_wdl_workflow.cache_grammar(cache_dir)
+            self.assertIs(type(renamed._parser._lark_cache), dict)
+            without_cache = types.SimpleNamespace(_parser=types.SimpleNamespace())
+            with patch.object(parse_wdl_workflow, "WDL", without_cache):
+                parse_wdl_workflow.cache_grammar(cache_dir)
+            self.assertEqual(vars(without_cache._parser), {})
+
+    def test_saved_parser_that_cannot_be_reattached_is_rebuilt(self):
+        expected = parse_wdl_workflow.parse_wdl(nested_decl_wdl)
+        parser_module = WDL._parser
+        with tempfile.TemporaryDirectory() as cache_dir:
+            saved = parse_wdl_workflow.DiskBackedLarkCache(cache_dir, parser_module)
+            for key, lark_parser in parser_module._lark_cache.items():
+                saved[key] = lark_parser
+            self.assertTrue(os.listdir(cache_dir))
+
+            cache = parse_wdl_workflow.DiskBackedLarkCache(cache_dir, parser_module)
+            # a lark whose loaded parsers no longer have the lexer configuration the hook reattaches
+            unusable_parser = types.SimpleNamespace()
+            with patch.object(parser_module.lark.Lark, "load", return_value=unusable_parser):
+                with patch.object(parser_module, "_lark_cache", cache):
+                    self.assertEqual(parse_wdl_workflow.parse_wdl(nested_decl_wdl), expected)
+            self.assertEqual(set(cache), set(saved))
+
+
+class TestBenchmarkCorpus(unittest.TestCase):
+    def test_synthetic_workflows_parse(self):
+        from benchmark_parse_wdl_workflow import SHAPES
+
+        expected_task_counts = {"chain": 20, "conditionals": 20, "wide_select_all": 3, "globs": 2, "declarations": 20}
+        for shape, generate in SHAPES.items():
+            parsed = parse_wdl_workflow.parse_wdl(generate(20))
+            self.assertEqual(len(parsed["task_names"]), expected_task_counts[shape], shape)
+
+    def test_report(self):
+        from benchmark_parse_wdl_workflow import PHASES, run_benchmark
+
+        results = run_benchmark(["chain", "declarations"], [2, 4], 1)
+        for result in results.values():
+            self.assertEqual([run["size"] for run in result["runs"]], [2, 4])
+            self.assertEqual(sorted(result["scaling_exponent"]), sorted(PHASES))
+            for run in result["runs"]:
+                self.assertEqual(sorted(run["median_seconds"]), sorted(PHASES))
+
+
 # Test document
 
 test_wdl = """
@@ -205,3 +655,285 @@ workflow idseq_host_filter {
   }
 }
 """  # noqa
+
+nested_decl_wdl = """
+version 1.0
+task RunProducer {
+  input {
+    File in_fa
+  }
+  command<<<
+  cat ~{in_fa} > out.fa
+  >>>
+  output {
+    File out_fa = "out.fa"
+  }
+}
+task RunConsumer {
+  input {
+    Array[File] fas
+  }
+  command<<<
+  cat ~{sep=" " fas} > consumed.fa
+  >>>
+  output {
+    File consumed_fa = "consumed.fa"
+  }
+}
+workflow nested_decls {
+  input {
+    File in_fa
+    File? fallback_fa
+    Boolean produce
+  }
+  if (produce) {
+    call RunProducer {
+      input:
+        in_fa = in_fa,
+    }
+  }
+  File? produced = RunProducer.out_fa
+  File chosen = select_first([produced, fallback_fa])
+  Array[File] consumer_input = if (produce) then [chosen] else select_all([fallback_fa, chosen])
+  call RunConsumer {
+    input:
+      fas = consumer_input,
+  }
+  output {
+    File consumed_fa = RunConsumer.consumed_fa
+  }
+}
+"""
+
+expressions_wdl = """
+version 1.0
+task RunProducer {
+  input {
+    File in_fa
+    Boolean flag
+  }
+  command<<<
+  cat ~{in_fa} > out.fa
+  >>>
+  output {
+    File out_fa = "out.fa"
+  }
+}
+task RunConsumer {
+  input {
+    Array[File] fas
+    String name
+    Pair[File, File] pair
+    Map[String, File] named_fas
+  }
+  command<<<
+  cat ~{sep=" " fas} > consumed.fa
+  >>>
+  output {
+    File consumed_fa = "consumed.fa"
+  }
+}
+workflow expressions {
+  input {
+    File in_fa
+    String prefix
+  }
+  call RunProducer {
+    input:
+      in_fa = in_fa,
+      flag = length([in_fa]) > 0,
+  }
+  call RunConsumer {
+    input:
+      fas = flatten([[RunProducer.out_fa], if defined(in_fa) then [RunProducer.out_fa] else [in_fa]]),
+      name = "~{prefix}.fa",
+      pair = (RunProducer.out_fa, in_fa),
+      named_fas = {"input": in_fa},
+  }
+  output {
+    File consumed_fa = RunConsumer.consumed_fa
+  }
+}
+"""
+
+wide_array_wdl = """
+version 1.0
+task RunConsumer {
+  input {
+    Array[File] fas
+  }
+  command<<<
+  cat ~{sep=" " fas} > consumed.fa
+  >>>
+  output {
+    File consumed_fa = "consumed.fa"
+  }
+}
+workflow wide_array {
+  input {
+INPUTS
+  }
+  call RunConsumer {
+    input:
+      fas = select_all([ITEMS]),
+  }
+  output {
+    File consumed_fa = RunConsumer.consumed_fa
+  }
+}
+"""
+
+scatter_wdl = """
+version 1.0
+import "chunk_lib.wdl" as lib
+task RunSplit {
+  input {
+    File in_fa
+  }
+  command<<<
+  split ~{in_fa}
+  >>>
+  output {
+    Array[File] chunks = glob("chunk_*.fa")
+  }
+}
+task RunAlign {
+  input {
+    File chunk_fa
+  }
+  command<<<
+  align ~{chunk_fa} > aligned.fa
+  >>>
+  output {
+    File aligned_fa = "aligned.fa"
+  }
+}
+task RunMerge {
+  input {
+    Array[File] fas
+  }
+  command<<<
+  cat ~{sep=" " fas} > merged.fa
+  >>>
+  output {
+    File merged_fa = "merged.fa"
+  }
+}
+workflow scattered {
+  input {
+    File in_fa
+  }
+  call RunSplit {
+    input:
+      in_fa = in_fa,
+  }
+  scatter (chunk in RunSplit.chunks) {
+    call RunAlign {
+      input:
+        chunk_fa = chunk,
+    }
+  }
+  call lib.align_chunk as AlignSub {
+    input:
+      in_fa = in_fa,
+  }
+  call RunMerge {
+    input:
+      fas = flatten([RunAlign.aligned_fa, [AlignSub.aligned_fa]]),
+  }
+  output {
+    Array[File] aligned_fas = RunAlign.aligned_fa
+    File merged_fa = RunMerge.merged_fa
+  }
+}
+"""
+
+sibling_scatters_wdl = """
+version 1.0
+task Split {
+  input {
+    File in_fa
+  }
+  command<<<
+  split ~{in_fa}
+  >>>
+  output {
+    Array[File] chunks = glob("chunk_*.fa")
+  }
+}
+task Align {
+  input {
+    File c
+  }
+  command<<<
+  align ~{c} > aligned.fa
+  >>>
+  output {
+    File aligned_fa = "aligned.fa"
+  }
+}
+workflow sibling_scatters {
+  input {
+    File in_fa
+  }
+  call Split as SplitA {
+    input:
+      in_fa = in_fa,
+  }
+  call Split as SplitB {
+    input:
+      in_fa = in_fa,
+  }
+  scatter (chunk in SplitA.chunks) {
+    call Align as AlignA {
+      input:
+        c = chunk,
+    }
+  }
+  scatter (chunk in SplitB.chunks) {
+    call Align as AlignB {
+      input:
+        c = chunk,
+    }
+  }
+  scatter (a in SplitA.chunks) {
+    scatter (b in SplitB.chunks) {
+      File pair_fa = if defined(a) then a else b
+      call Align as AlignPairs {
+        input:
+          c = pair_fa,
+      }
+    }
+  }
+  output {
+    Array[File] aligned_fas = AlignA.aligned_fa
+  }
+}
+"""
+
+chunk_lib_wdl = """
+version 1.0
+task RunAlignInner {
+  input {
+    File in_fa
+  }
+  command<<<
+  align ~{in_fa} > sub_aligned.fa
+  >>>
+  output {
+    File aligned_fa = "sub_aligned.fa"
+  }
+}
+workflow align_chunk {
+  input {
+    File in_fa
+  }
+  call RunAlignInner {
+    input:
+      in_fa = in_fa,
+  }
+  output {
+    File aligned_fa = RunAlignInner.aligned_fa
+  }
+}
+"""
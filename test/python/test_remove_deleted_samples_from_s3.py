@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import unittest
+import importlib.util
+import os
+import sqlite3
+import threading
+
+from botocore.exceptions import ClientError
+
+SCRIPT_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "bin", "remove_deleted_samples_from_s3.py"
+)
+spec = importlib.util.spec_from_file_location("remove_deleted_samples_from_s3", SCRIPT_PATH)
+remove_deleted_samples_from_s3 = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(remove_deleted_samples_from_s3)
+
+
+# Test cases
+
+
+class StubPaginator:
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        return getattr(self.client, self.operation + "_pages")(**kwargs)
+
+
+class StubS3Client:
+    """Enough of an S3 client for the script, over a list of keys, with page_size entries a page."""
+
+    def __init__(self, keys, page_size=2, versions=None):
+        self.keys = sorted(keys)
+        self.page_size = page_size
+        self.requests = []
+        # (key, version id) -> whether it's a delete marker
+        self.versions = dict(versions or {})
+        self.delete_requests = []
+        self.throttled_requests = 0
+        self.throttled_keys = set()
+        self.denied_keys = set()
+        self.lock = threading.Lock()
+
+    def get_paginator(self, operation):
+        return StubPaginator(self, operation)
+
+    def list_objects_v2_pages(self, Bucket, Prefix, Delimiter):
+        self.requests.append(("list_objects_v2", Prefix))
+        entries = []
+        for key in self.keys:
+            if key.startswith(Prefix):
+                rest = key[len(Prefix):]
+                if Delimiter in rest:
+                    common_prefix = {"Prefix": Prefix + rest.split(Delimiter)[0] + Delimiter}
+                    if common_prefix not in entries:
+                        entries.append(common_prefix)
+        for i in range(0, max(len(entries), 1), self.page_size):
+            yield {"CommonPrefixes": entries[i:i + self.page_size]} if entries else {}
+
+    def list_object_versions_pages(self, Bucket, Prefix):
+        marker = ("", "")
+        while True:
+            with self.lock:
+                # Pages start after the key and version markers, as S3's do
+                entries = sorted(v for v in self.versions if v[0].startswith(Prefix) and v > marker)
+                page = entries[:self.page_size]
+                is_delete_marker = [self.versions[v] for v in page]
+            yield {
+                "Versions": [{"Key": k, "VersionId": v} for (k, v), dm in zip(page, is_delete_marker) if not dm],
+                "DeleteMarkers": [{"Key": k, "VersionId": v} for (k, v), dm in zip(page, is_delete_marker) if dm],
+            }
+            if len(entries) <= self.page_size:
+                return
+            marker = page[-1]
+
+    def delete_objects(self, Bucket, Delete):
+        objects = Delete["Objects"]
+        assert len(objects) <= 1000 and Delete["Quiet"]
+        with self.lock:
+            self.delete_requests.append(len(objects))
+            if self.throttled_requests:
+                self.throttled_requests -= 1
+                raise ClientError({"Error": {"Code": "SlowDown", "Message": "Slow down"}}, "DeleteObjects")
+            errors = []
+            for obj in objects:
+                version = (obj["Key"], obj["VersionId"])
+                if obj["Key"] in self.denied_keys:
+                    errors.append(dict(obj, Code="AccessDenied", Message="Access Denied"))
+                elif obj["Key"] in self.throttled_keys:
+                    self.throttled_keys.discard(obj["Key"])
+                    errors.append(dict(obj, Code="SlowDown", Message="Slow down"))
+                else:
+                    self.versions.pop(version, None)
+            return {"Errors": errors} if errors else {}
+
+
+class TestFetchS3Samples(unittest.TestCase):
+    def test_lists_every_sample_of_every_project(self):
+        keys = [f"samples/{p}/{s}/results/out_{i}.txt" for p in range(5) for s in range(7) for i in range(3)]
+        keys += ["samples/4/700/fastqs/r1.fastq.gz", "samples/top_level_file.txt"]
+        client = StubS3Client(keys)
+        samples = list(remove_deleted_samples_from_s3.fetch_s3_samples(client, "bucket", max_workers=3))
+        expected = [(str(p), str(s)) for p in range(5) for s in range(7)] + [("4", "700")]
+        self.assertEqual(sorted(samples), sorted(expected))
+        # one listing for the projects, one for each project's samples
+        self.assertEqual(len({prefix for _, prefix in client.requests}), 6)
+
+    def test_empty_bucket(self):
+        client = StubS3Client([])
+        self.assertEqual(list(remove_deleted_samples_from_s3.fetch_s3_samples(client, "bucket")), [])
+
+
+class TestDeletePrefixes(unittest.TestCase):
+    def delete(self, client, prefixes):
+        throttle = remove_deleted_samples_from_s3.Throttle(min_delay=0.0001, max_delay=0.001)
+        return list(
+            remove_deleted_samples_from_s3.delete_prefixes(client, "bucket", prefixes, max_workers=2, throttle=throttle)
+        )
+
+    def test_deletes_every_version_and_delete_marker(self):
+        # 800 keys with two versions and a delete marker each, in each of 3 samples
+        versions = {
+            (f"samples/1/{s}/file_{i}", f"v{v}"): v == 2 for s in range(3) for i in range(800) for v in range(3)
+        }
+        client = StubS3Client([], page_size=700, versions=versions)
+        reports = self.delete(client, ["samples/1/0/", "samples/1/1/"])
+        self.assertEqual([report["deleted"] for report in reports], [2400, 2400])
+        self.assertEqual([report["batches"] for report in reports], [3, 3])
+        self.assertEqual([report["remaining"] for report in reports], [0, 0])
+        self.assertEqual(sorted({key.split("/")[2] for key, _ in client.versions}), ["2"])
+
+    def test_retries_throttling_and_reports_errors(self):
+        versions = {(f"samples/1/2/file_{i}", "v1"): False for i in range(10)}
+        client = StubS3Client([], versions=versions)
+        client.throttled_requests = 2
+        client.throttled_keys = {"samples/1/2/file_3", "samples/1/2/file_4"}
+        client.denied_keys = {"samples/1/2/file_7"}
+        [report] = self.delete(client, ["samples/1/2/"])
+        self.assertEqual(report["deleted"], 9)
+        self.assertEqual(report["failed_batches"], 1)
+        errors = [(error["Key"], error["Code"]) for error in report["errors"]]
+        self.assertEqual(errors, [("samples/1/2/file_7", "AccessDenied")])
+        self.assertEqual(report["remaining"], 1)
+        self.assertEqual(list(client.versions), [("samples/1/2/file_7", "v1")])
+
+
+class TestFindOrphanSamples(unittest.TestCase):
+    def test_sample_ids_from_sqlite(self):
+        connection = sqlite3.connect(":memory:")
+        self.addCleanup(connection.close)
+        connection.execute("create table samples (id integer primary key)")
+        connection.executemany("insert into samples values (?)", [(i,) for i in range(1, 25001, 2)])
+        ids = remove_deleted_samples_from_s3.fetch_sample_ids_from_connection(connection, fetch_size=1000)
+        self.assertEqual(ids.typecode, "q")
+        self.assertEqual(list(ids), list(range(1, 25001, 2)))
+
+    def test_sample_ids_from_command(self):
+        ids = remove_deleted_samples_from_s3.fetch_sample_ids("printf '3\\n10\\n7\\n'")
+        self.assertEqual(list(ids), [3, 7, 10])
+        with self.assertRaises(RuntimeError):
+            remove_deleted_samples_from_s3.fetch_sample_ids("printf '3\\n'; exit 1")
+        with self.assertRaises(ValueError):
+            remove_deleted_samples_from_s3.fetch_sample_ids("printf 'id\\n3\\n'")
+
+    def test_sorted_merge_and_malformed_prefixes(self):
+        s3_samples = [("2", "10"), ("1", "3"), ("1", "abc"), ("5", "7"), ("1", "007"), ("2", "12"), ("3", "100")]
+        parsed, malformed = remove_deleted_samples_from_s3.parse_s3_samples(s3_samples)
+        self.assertEqual(malformed, [("1", "abc"), ("1", "007")])
+        db_ids = remove_deleted_samples_from_s3.sample_id_array([12, 3, 4, 99])
+        orphans = list(remove_deleted_samples_from_s3.find_orphan_samples(parsed, db_ids))
+        self.assertEqual(orphans, [("5", "7"), ("2", "10"), ("3", "100")])
@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+
+import unittest
+from unittest.mock import patch
+from io import StringIO
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from jwcrypto import jwk
+from jwcrypto.common import JWKeyNotFound
+
+from scripts import token_auth
+
+
+# Test cases
+
+
+class TestCreateAndDecrypt(unittest.TestCase):
+    def test_round_trip(self):
+        created = json.loads(token_auth.create_token(private_key, 12, json.dumps(project_claims), "rails"))
+        claims = json.loads(token_auth.get_token_claims(private_key, created["token"]))
+        self.assertEqual(claims["sub"], "12")
+        self.assertEqual(claims["project_roles"], project_claims)
+        self.assertEqual(claims["service_identity"], "rails")
+        self.assertEqual(claims["exp"], created["expires_at"])
+
+    def test_invalid_role(self):
+        with self.assertRaises(ValueError):
+            token_auth.create_token(private_key, 12, json.dumps({"admin": [1]}))
+
+
+class TestClaimSchema(unittest.TestCase):
+    def test_decoded_and_json_claims_are_equivalent(self):
+        from_json = token_auth.CLAIM_SCHEMA.parse(12, json.dumps(project_claims), "rails")
+        from_dict = token_auth.CLAIM_SCHEMA.parse(12, project_claims, "rails")
+        self.assertEqual(from_json, from_dict)
+        self.assertEqual(from_dict, {"sub": "12", "project_roles": project_claims, "service_identity": "rails"})
+
+    def test_empty_project_claims(self):
+        for empty in [None, "", {}]:
+            self.assertIsNone(token_auth.CLAIM_SCHEMA.parse(12, empty)["project_roles"])
+
+    def test_numeric_strings_are_accepted(self):
+        claims = {"owner": ["1", 2]}
+        self.assertEqual(token_auth.CLAIM_SCHEMA.parse(12, claims)["project_roles"], claims)
+
+    def test_invalid_claims(self):
+        invalid = [
+            ("x", None, None),
+            (12, ["owner"], None),
+            (12, {"owner": 1}, None),
+            (12, {"owner": ["one"]}, None),
+            (12, {"admin": [1]}, None),
+            (12, None, 7),
+        ]
+        for user_id, projects, service_identity in invalid:
+            with self.subTest(user_id=user_id, projects=projects, service_identity=service_identity):
+                with self.assertRaises(ValueError):
+                    token_auth.validate_claims(user_id, projects, service_identity)
+
+    def test_role_error_message(self):
+        with self.assertRaisesRegex(ValueError, "role must be one of owner, member, or viewer"):
+            token_auth.validate_projects({"admin": [1]})
+
+
+class TestCompactProjectRoles(unittest.TestCase):
+    def test_round_trip(self):
+        roles = {"owner": [9, 3, 4, 5, 3], "member": [], "viewer": list(range(100, 200)) + [7, 1000]}
+        compact = token_auth.compact_project_roles(roles)
+        self.assertEqual(compact["encoding"], "ranges")
+        self.assertEqual(compact["version"], 1)
+        self.assertEqual(compact["roles"]["owner"], [3, 3, 3, 1])
+        self.assertEqual(compact["roles"]["member"], [])
+        self.assertEqual(compact["roles"]["viewer"], [7, 1, 92, 100, 800, 1])
+        self.assertEqual(
+            token_auth.expand_project_roles(compact),
+            {role: sorted(set(project_ids)) for role, project_ids in roles.items()},
+        )
+
+    def test_token_is_smaller_and_expands_transparently(self):
+        roles = {"owner": list(range(1, 500)), "viewer": list(range(1, 5000))}
+        signer = token_auth.TokenSigner(private_key)
+        plain = signer.create(12, roles)["token"]
+        compact = signer.create(12, roles, compact=True)["token"]
+        self.assertLess(len(compact) * 10, len(plain))
+        self.assertEqual(json.loads(signer.decrypt(compact))["project_roles"], roles)
+        self.assertEqual(json.loads(signer.decrypt(compact, expand=False))["project_roles"]["encoding"], "ranges")
+
+    def test_unknown_version(self):
+        with self.assertRaises(ValueError):
+            token_auth.expand_project_roles({"encoding": "ranges", "version": 2, "roles": {}})
+
+    def test_view(self):
+        roles = {"owner": [3, 4, 5, 9], "viewer": list(range(1, 20))}
+        for project_roles in [roles, token_auth.compact_project_roles(roles)]:
+            view = token_auth.ProjectRolesView(project_roles)
+            self.assertTrue(view.has_role("owner", 4))
+            self.assertTrue(view.has_role("owner", 9))
+            self.assertFalse(view.has_role("owner", 6))
+            self.assertFalse(view.has_role("owner", 2))
+            self.assertFalse(view.has_role("member", 4))
+            self.assertEqual(view.roles_for(9), ["owner", "viewer"])
+            self.assertEqual(view.roles_for(25), [])
+
+
+class TestTokenSigner(unittest.TestCase):
+    def test_thumbprint_is_computed_once(self):
+        signer = token_auth.TokenSigner(private_key)
+        with patch.object(token_auth.jwk.JWK, "thumbprint") as thumbprint:
+            tokens = [signer.create(userid)["token"] for userid in range(3)]
+            thumbprint.assert_not_called()
+        for userid, token in enumerate(tokens):
+            self.assertEqual(json.loads(signer.decrypt(token))["sub"], str(userid))
+
+    def test_headers(self):
+        token = token_auth.TokenSigner(private_key).create(12)["token"]
+        unpacked_token = token_auth.jwe.JWE()
+        unpacked_token.deserialize(token, key=private_key)
+        protected_header = json.loads(unpacked_token.objects["protected"])
+        # the ephemeral public key is added by ECDH-ES for every token
+        self.assertIn("epk", protected_header)
+        del protected_header["epk"]
+        self.assertEqual(
+            protected_header,
+            {"alg": "ECDH-ES", "enc": "A256CBC-HS512", "typ": "JWE", "kid": private_key.thumbprint()},
+        )
+        signed_token = token_auth.jws.JWS()
+        signed_token.deserialize(unpacked_token.payload.decode("utf-8"), key=private_key)
+        self.assertEqual(signed_token.jose_header, {"alg": "ES384", "typ": "JWT", "kid": private_key.thumbprint()})
+
+
+class StubSecretsManagerClient:
+    def __init__(self, secret):
+        self.secret = secret
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        self.calls += 1
+        return {"SecretString": self.secret}
+
+
+class TestKeyProviders(unittest.TestCase):
+    def test_file_provider_reads_pem(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            key_path = os.path.join(tmpdir, "key.pem")
+            with open(key_path, "wb") as f:
+                f.write(private_key.export_to_pem(private_key=True, password=None))
+            provider = token_auth.FileKeyProvider(key_path)
+            self.assertEqual(provider.signing_key.thumbprint(), private_key.thumbprint())
+            self.assertEqual(provider.signing_key.get("kid"), private_key.thumbprint())
+
+    def test_providers_must_implement_load(self):
+        class IncompleteKeyProvider(token_auth.KeyProvider):
+            pass
+
+        with self.assertRaises(TypeError):
+            IncompleteKeyProvider()
+
+    def test_old_tokens_decrypt_after_rotation(self):
+        old_token = token_auth.TokenSigner(private_key).create(1)["token"]
+        client = StubSecretsManagerClient(jwks([new_key, private_key]))
+        provider = token_auth.SecretsManagerKeyProvider("test/czid-services-private-key", client=client)
+
+        self.assertEqual(provider.signer.kid, new_key.thumbprint())
+        self.assertEqual(json.loads(provider.signer.decrypt(old_token))["sub"], "1")
+        new_token = provider.signer.create(2)["token"]
+        self.assertEqual(json.loads(provider.signer.decrypt(new_token))["sub"], "2")
+
+        # once the old key is retired, its tokens no longer decrypt
+        client.secret = jwks([new_key])
+        provider.refresh()
+        with self.assertRaises(JWKeyNotFound):
+            provider.signer.decrypt(old_token)
+
+    def test_cached_tokens_are_dropped_when_their_key_is_retired(self):
+        old_token = token_auth.TokenSigner(private_key).create(1)["token"]
+        client = StubSecretsManagerClient(jwks([new_key, private_key]))
+        provider = token_auth.SecretsManagerKeyProvider("test/czid-services-private-key", client=client)
+        service = token_auth.TokenService(provider)
+        request = {"op": "decrypt", "token": old_token}
+        self.assertEqual(service.handle(request)["sub"], "1")
+        self.assertEqual(service.handle(request)["sub"], "1")
+        self.assertEqual(service.token_cache.stats()["hits"], 1)
+
+        client.secret = jwks([new_key])
+        provider.refresh()
+        with self.assertRaises(JWKeyNotFound):
+            service.handle(request)
+        self.assertEqual(service.token_cache.stats()["entries"], 0)
+
+    def test_keys_are_cached_until_the_ttl(self):
+        client = StubSecretsManagerClient(private_key.export_to_pem(private_key=True, password=None).decode())
+        provider = token_auth.SecretsManagerKeyProvider("test/czid-services-private-key", client=client)
+        for _ in range(3):
+            provider.signer
+        self.assertEqual(client.calls, 1)
+
+        provider.ttl = 0
+        provider.signer
+        self.assertEqual(client.calls, 2)
+
+    def test_one_shot_processes_share_the_key_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = os.path.join(tmpdir, "keys.cache")
+            first_client = StubSecretsManagerClient(jwks([private_key]))
+            first = token_auth.SecretsManagerKeyProvider("test/key", client=first_client, cache_path=cache_path)
+            self.assertEqual(first.signer.kid, private_key.thumbprint())
+            self.assertEqual(first_client.calls, 1)
+            self.assertEqual(os.stat(cache_path).st_mode & 0o777, 0o600)
+
+            second_client = StubSecretsManagerClient(jwks([new_key]))
+            second = token_auth.SecretsManagerKeyProvider("test/key", client=second_client, cache_path=cache_path)
+            self.assertEqual(second.signer.kid, private_key.thumbprint())
+            self.assertEqual(second_client.calls, 0)
+
+            # a stale cache, or one other users could have written, is fetched again
+            os.utime(cache_path, (0, 0))
+            third = token_auth.SecretsManagerKeyProvider("test/key", client=second_client, cache_path=cache_path)
+            self.assertEqual(third.signer.kid, new_key.thumbprint())
+            os.chmod(cache_path, 0o644)
+            fourth = token_auth.SecretsManagerKeyProvider("test/key", client=second_client, cache_path=cache_path)
+            fourth.signer
+            self.assertEqual(second_client.calls, 2)
+
+    def test_kid_miss_reloads_keys_past_the_cache(self):
+        new_token = token_auth.TokenSigner(new_key).create(1)["token"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = os.path.join(tmpdir, "keys.cache")
+            writer_client = StubSecretsManagerClient(jwks([private_key]))
+            writer = token_auth.SecretsManagerKeyProvider("test/key", client=writer_client, cache_path=cache_path)
+            writer.signer
+            # the secret has been rotated since the cache was written
+            client = StubSecretsManagerClient(jwks([new_key, private_key]))
+            writer_client.secret = client.secret
+            # keys that were only just fetched aren't fetched again, even by a process reading the cache
+            with self.assertRaises(JWKeyNotFound):
+                writer.decrypt(new_token)
+            fresh = token_auth.SecretsManagerKeyProvider("test/key", client=client, cache_path=cache_path)
+            with self.assertRaises(JWKeyNotFound):
+                fresh.decrypt(new_token)
+            self.assertEqual((writer_client.calls, client.calls), (1, 0))
+
+            # a one-shot process that has just read a cache written a while ago does reload
+            written_at = time.time() - token_auth.KID_MISS_RELOAD_SECONDS - 1
+            os.utime(cache_path, (written_at, written_at))
+            one_shot = token_auth.SecretsManagerKeyProvider("test/key", client=client, cache_path=cache_path)
+            self.assertEqual(json.loads(one_shot.decrypt(new_token))["sub"], "1")
+            self.assertEqual(client.calls, 1)
+            # and the reload rewrote the cache for the processes after it
+            later = token_auth.SecretsManagerKeyProvider("test/key", client=client, cache_path=cache_path)
+            self.assertEqual(json.loads(later.decrypt(new_token))["sub"], "1")
+            self.assertEqual(client.calls, 1)
+
+    def test_background_refresh(self):
+        client = StubSecretsManagerClient(jwks([private_key]))
+        provider = token_auth.SecretsManagerKeyProvider("test/czid-services-private-key", client=client, ttl=0.01)
+        provider.start_background_refresh()
+        try:
+            client.secret = jwks([new_key])
+            for _ in range(200):
+                if provider.signer.kid == new_key.thumbprint():
+                    break
+                time.sleep(0.01)
+            self.assertEqual(provider.signer.kid, new_key.thumbprint())
+        finally:
+            provider.stop_background_refresh()
+
+    def test_service_reports_key_ids(self):
+        service = token_auth.TokenService(token_auth.StaticKeyProvider(new_key, private_key))
+        health = service.handle({"op": "health"})
+        self.assertEqual(health["kid"], new_key.thumbprint())
+        self.assertEqual(sorted(health["kids"]), sorted([new_key.thumbprint(), private_key.thumbprint()]))
+
+
+class TestVerifiedTokenCache(unittest.TestCase):
+    def token(self, userid=12, expiration=3600):
+        return json.loads(token_auth.create_token(private_key, userid, expiration=expiration))["token"]
+
+    def test_repeat_decrypt_is_a_hit(self):
+        cache = token_auth.VerifiedTokenCache()
+        token = self.token()
+        claims = token_auth.get_token_claims(private_key, token, cache)
+        with patch.object(token_auth.jwe.JWE, "decrypt") as decrypt:
+            self.assertEqual(token_auth.get_token_claims(private_key, token, cache), claims)
+            decrypt.assert_not_called()
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["hit_rate"], 0.5)
+
+    def test_expired_entries_are_not_served(self):
+        cache = token_auth.VerifiedTokenCache()
+        token = self.token(expiration=60)
+        cache.put(token, token_auth.get_token_claims(private_key, token))
+        later = time.time() + 120
+        with patch.object(token_auth.time, "time", return_value=later):
+            self.assertIsNone(cache.get(token))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_not_served_before_nbf(self):
+        cache = token_auth.VerifiedTokenCache()
+        token = self.token()
+        cache.put(token, token_auth.get_token_claims(private_key, token))
+        earlier = time.time() - 120
+        with patch.object(token_auth.time, "time", return_value=earlier):
+            self.assertIsNone(cache.get(token))
+        self.assertIsNotNone(cache.get(token))
+
+    def test_lru_eviction(self):
+        cache = token_auth.VerifiedTokenCache(max_entries=2)
+        tokens = [self.token(userid) for userid in range(3)]
+        for token in tokens[:2]:
+            token_auth.get_token_claims(private_key, token, cache)
+        cache.get(tokens[0])
+        token_auth.get_token_claims(private_key, tokens[2], cache)
+        self.assertIsNone(cache.get(tokens[1]))
+        self.assertIsNotNone(cache.get(tokens[0]))
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_revoke(self):
+        cache = token_auth.VerifiedTokenCache()
+        token = self.token()
+        token_auth.get_token_claims(private_key, token, cache)
+        self.assertTrue(cache.revoke(token))
+        self.assertFalse(cache.revoke(token))
+        self.assertIsNone(cache.get(token))
+
+
+class TestServeMode(unittest.TestCase):
+    def serve(self, requests):
+        infile = StringIO("".join(json.dumps(request) + "\n" for request in requests))
+        outfile = StringIO()
+        token_auth.TokenService(private_key).serve(infile, outfile)
+        return [json.loads(line) for line in outfile.getvalue().splitlines()]
+
+    def test_compact_create(self):
+        request = {"id": 1, "op": "create", "userid": 7, "project_claims": project_claims, "compact": True}
+        [created] = self.serve([request])
+        [decrypted] = self.serve([{"id": 2, "op": "decrypt", "token": created["result"]["token"]}])
+        self.assertEqual(decrypted["result"]["project_roles"], project_claims)
+
+    def test_create_then_decrypt(self):
+        [created] = self.serve([{"id": 1, "op": "create", "userid": 7, "project_claims": project_claims}])
+        self.assertEqual(created["id"], 1)
+        [decrypted] = self.serve([{"id": 2, "op": "decrypt", "token": created["result"]["token"]}])
+        self.assertEqual(decrypted["id"], 2)
+        self.assertEqual(decrypted["result"]["sub"], "7")
+        self.assertEqual(decrypted["result"]["project_roles"], project_claims)
+
+    def test_errors_do_not_stop_the_service(self):
+        responses = self.serve(
+            [
+                {"id": "a", "op": "decrypt", "token": "not a token"},
+                {"id": "b", "op": "rotate"},
+                {"id": "c", "op": "health"},
+            ]
+        )
+        self.assertEqual([response["id"] for response in responses], ["a", "b", "c"])
+        self.assertIn("error", responses[0])
+        self.assertIn("unknown op", responses[1]["error"])
+        self.assertEqual(responses[2]["result"]["status"], "ok")
+        self.assertEqual(responses[2]["result"]["kid"], private_key.thumbprint())
+        self.assertEqual(responses[2]["result"]["requests"], 3)
+        self.assertEqual(responses[2]["result"]["token_cache"]["entries"], 0)
+
+    def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            socket_path = os.path.join(tmpdir, "token_auth.sock")
+            server = token_auth.TokenServer(socket_path, token_auth.TokenService(private_key))
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                health = token_auth.check_health(socket_path)
+                self.assertEqual(health["status"], "ok")
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+    def test_sigterm_removes_socket(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            socket_path = os.path.join(tmpdir, "token_auth.sock")
+            script = (
+                "import sys; from jwcrypto import jwk; from scripts import token_auth; "
+                "key = jwk.JWK.from_json(sys.argv[1]); "
+                "token_auth.serve_unix_socket(sys.argv[2], token_auth.TokenService(key))"
+            )
+            process = subprocess.Popen([sys.executable, "-c", script, private_key.export(), socket_path])
+            try:
+                for _ in range(100):
+                    if os.path.exists(socket_path):
+                        break
+                    time.sleep(0.05)
+                self.assertEqual(token_auth.check_health(socket_path)["status"], "ok")
+                process.terminate()
+                self.assertEqual(process.wait(timeout=10), 0)
+                self.assertFalse(os.path.exists(socket_path))
+            finally:
+                if process.poll() is None:
+                    process.kill()
+
+
+class TestBatchMode(unittest.TestCase):
+    def test_responses_are_in_request_order(self):
+        tokens = {
+            userid: json.loads(token_auth.create_token(private_key, userid))["token"] for userid in range(3)
+        }
+        requests = []
+        for i in range(9):
+            if i % 3 == 0:
+                requests.append({"id": i, "op": "create", "userid": i})
+            else:
+                requests.append({"id": i, "op": "decrypt", "token": tokens[i % 3]})
+        requests.append({"id": 9, "op": "decrypt", "token": "garbage"})
+        lines = [json.dumps(request) + "\n" for request in requests] + ["\n"]
+
+        responses = list(token_auth.process_batch(lines, private_key, max_workers=2, chunk_size=2))
+        self.assertEqual([response["id"] for response in responses], list(range(10)))
+        for i, response in enumerate(responses[:9]):
+            if i % 3 == 0:
+                self.assertIn("token", response["result"])
+            else:
+                self.assertEqual(response["result"]["sub"], str(i % 3))
+        self.assertIn("error", responses[9])
+
+    def test_single_worker_runs_inline(self):
+        lines = [json.dumps({"id": "x", "op": "create", "userid": 5})]
+        with patch("concurrent.futures.ProcessPoolExecutor") as executor:
+            [response] = token_auth.process_batch(lines, private_key, max_workers=1)
+            executor.assert_not_called()
+        self.assertIn("token", response["result"])
+
+
+class TestTimings(unittest.TestCase):
+    def test_histogram(self):
+        histogram = token_auth.LatencyHistogram()
+        for milliseconds in [0.2] * 98 + [3, 40]:
+            histogram.record(milliseconds)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["p50_ms"], 0.25)
+        self.assertEqual(summary["p99_ms"], 5)
+        self.assertEqual(summary["max_ms"], 40)
+        self.assertEqual(summary["buckets"], {"le_0.25": 98, "le_5": 1, "le_50": 1})
+
+    def test_phases_are_recorded(self):
+        timings = token_auth.Timings()
+        with patch.object(token_auth, "TIMINGS", timings):
+            signer = token_auth.TokenSigner(private_key)
+            signer.decrypt(signer.create(12, project_claims)["token"])
+        phases = timings.summary()
+        for phase in ["create", "claims_validate", "jws_sign", "jwe_encrypt", "decrypt", "jwe_decrypt", "jws_verify"]:
+            self.assertEqual(phases[phase]["count"], 1, phase)
+
+    def test_metrics_op(self):
+        service = token_auth.TokenService(private_key)
+        service.handle({"op": "create", "userid": 1})
+        self.assertIn("create", service.handle({"op": "metrics"}))
+
+    def test_benchmark_flag(self):
+        result = subprocess.run(
+            [sys.executable, "scripts/token_auth.py", "--benchmark", "3", "--timings"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        report = json.loads(result.stdout)
+        self.assertEqual(report["cycles"], 3)
+        self.assertGreater(report["create"]["per_second"], 0)
+        self.assertLessEqual(report["decrypt"]["p50_ms"], report["decrypt"]["p99_ms"])
+        timings = json.loads(result.stderr.strip().splitlines()[-1])["timings"]
+        self.assertEqual(timings["create"]["count"], 3)
+
+
+# Test data
+
+private_key = jwk.JWK.generate(kty="EC", crv="P-384")
+new_key = jwk.JWK.generate(kty="EC", crv="P-384")
+
+
+def jwks(keys):
+    return json.dumps({"keys": [key.export(as_dict=True) for key in keys]})
+
+
+project_claims = {"owner": [1, 2], "member": [3], "viewer": [4, 5, 6]}
@@ -1,40 +1,812 @@
-#!/usr/bin/env python
-import sys
+#!/usr/bin/env python3
+#
+# Shows both reads in a paired-end read for every read that mapped to a particular taxon (even if
+# only one of the reads mapped to that taxon).
+#
+# Usage: ./AllReads.py <taxon_specific_file> <all_reads_file> [--output FILE] [--compact-ids]
+#        ./AllReads.py <all_reads_file> --output-dir DIR (--taxon FILE ... | --taxon-map TSV) [--compact-ids]
+#        ./AllReads.py <taxon_specific_file> <all_reads_file> --r1 FILE --r2 FILE [--threads N]
+#        ./AllReads.py <all_reads_file> --build-index
+#
+# The second form pulls the pairs for many taxa in a single pass over the all-reads file. Each
+# --taxon file, or each "<taxid>\t<taxon_specific_file>" line of --taxon-map, gets its own
+# output file in DIR, named after the taxid or the taxon file, and a pair that belongs to several
+# taxa goes to each of them. Output is buffered per taxon, and only a bounded number of output
+# files are kept open at a time.
+#
+# --jobs N splits an uncompressed all-reads file into byte ranges that start on record boundaries
+# and scans them in N worker processes. Workers read the file through mmap, so they share the page
+# cache, and write to temporary files that are concatenated in order, so the output is the same
+# as a sequential scan. Gzipped input can't be split and is always scanned sequentially.
+#
+# --index looks reads up in an index of the all-reads file instead of scanning it, which pays off
+# when the taxa have few reads and the sample has many. The index, <all_reads_file>.idx, is built
+# once (by --build-index, or by the first --index run) and maps the 64-bit hash of every read id to
+# the offset and length of its record, sorted by hash so it can be memory-mapped and binary
+# searched. The entries are sorted in bounded runs that are merged through temporary files next
+# to the index, so building it takes about the same memory for any size of reads file. Matching
+# records are then read with pread and written in file order, and hash
+# collisions are weeded out by checking the id of every record read. The index records the size
+# and modification time of the reads file, and is rebuilt when they change. Only uncompressed
+# all-reads files can be indexed.
+#
+# --r1 FILE --r2 FILE split the pairs of the first form by read number suffix, /1 reads (and any
+# without a suffix) to --r1 and /2 reads to --r2, instead of writing them interleaved. Both files
+# are BGZF, the blocked gzip of samtools and htslib, which any gzip reader can decompress. Blocks
+# are compressed in large batches on a pool of --threads threads, so compression keeps up with
+# extraction instead of being limited by a single gzip process downstream.
+#
+# Both files may be FASTA (with sequences on one or several lines) or 4-line FASTQ, plain or
+# gzipped. Records are read in large blocks and split into lines with a single bytes operation
+# per block; the usual 2-line FASTA and 4-line FASTQ records are then picked out by slicing, and
+# matching records are written out in bulk. Read ids are the part of the header after IDseq's
+# prefix, without the /1 or /2 read number suffix, so both mates of every taxon read are selected.
+# --compact-ids keeps 8-byte hashes of the taxon read ids in a sorted array instead of a set of
+# the ids, for taxon files with tens of millions of reads.
+import argparse
+import bisect
+import contextlib
+import gzip
+import hashlib
+import heapq
+import mmap
 import os
+import shutil
+import struct
+import sys
+import tempfile
+import zlib
+from collections import OrderedDict, deque
+from array import array
+from itertools import chain, compress, islice
 
+BLOCK_SIZE = 16 * 1024 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+# Number of ":"-separated IDseq prefix fields before the read id in each kind of file
+TAXON_PREFIX_FIELDS = 16
+ALL_READS_PREFIX_FIELDS = 4
+READ_NUMBER_SUFFIXES = (b"/1", b"/2")
+TAXON_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+MAX_OPEN_TAXON_FILES = 64
+CHUNKS_PER_JOB = 4
+READ_INDEX_SUFFIX = ".idx"
+# magic, number of reads, size and mtime_ns of the reads file; followed by the read id hashes in
+# sorted order and the offsets and lengths of their records, as arrays of native 64-bit integers
+READ_INDEX_MAGIC = b"ARIDX\x00\x00\x01"
+READ_INDEX_HEADER = struct.Struct("=8sQQQ")
+# Index entries are packed big-endian while the index is built, so that sorting them as bytes
+# sorts them by hash; runs of READ_INDEX_RUN_SIZE entries are sorted in memory at a time, and
+# merged READ_INDEX_BATCH_SIZE entries at a time
+READ_INDEX_ENTRY = struct.Struct(">QQQ")
+READ_INDEX_RUN_SIZE = 1024 * 1024
+READ_INDEX_BATCH_SIZE = 4096
+# Largest uncompressed block that still fits a BGZF block when deflate can't shrink it
+BGZF_MAX_BLOCK_SIZE = 65280
+# gzip header with the "BC" extra subfield holding the size of the whole block, less one
+BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+COMPRESS_BATCH_SIZE = 4 * 1024 * 1024
 
-def main():
-    if len(sys.argv) < 2:
-        script_name = os.path.basename(sys.argv[0])
-        print(
-            "\n%s shows both reads in a paired-end read for every read that mapped to a "
-            "particular taxon (even if only one of the reads mapped to that taxon).\n\n"
-            "Usage: ./%s <taxon_specific_file> <all_reads_file>\n\n" % (script_name, script_name)
+
+def is_compressed(path):
+    with open(path, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_reads(path):
+    return gzip.open(path, "rb") if is_compressed(path) else open(path, "rb")
+
+
+def reads_format(path):
+    with open_reads(path) as f:
+        return "fastq" if f.read(4096).lstrip()[:1] == b"@" else "fasta"
+
+
+def split_fasta(data, final):
+    """Split a block of FASTA into records, returning (headers, record, rest).
+
+    headers holds the header line of every record, in order; record(i) gives the bytes of the
+    i-th record; rest is the incomplete record at the end of the block, which is carried over to
+    the next one.
+    """
+    lines = data.split(b"\n")
+    if final:
+        while lines and not lines[-1]:
+            lines.pop()
+        end = len(lines)
+    else:
+        # The last record might continue in the next block, so it's carried over from its header
+        end = len(lines) - 1
+        while end > 0 and lines[end][:1] != b">":
+            end -= 1
+    rest = b"\n".join(lines[end:]) if not final else b""
+    if end == 0:
+        return [], None, rest
+
+    headers = lines[0:end:2]
+    # When the even lines hold every ">" in the block and all start with one, every record has its
+    # sequence on a single line, so records can be picked out by position
+    header_text = b"\n".join(headers)
+    block_end = len(data) - len(rest)
+    if (
+        end % 2 == 0
+        and header_text[:1] == b">"
+        and header_text.count(b"\n>") == len(headers) - 1
+        and data.count(b">", 0, block_end) == len(headers)
+    ):
+
+        def record(i):
+            return lines[2 * i] + b"\n" + lines[2 * i + 1] + b"\n"
+
+        return headers, record, rest
+
+    # Otherwise every part is a record without its leading ">" and trailing newline
+    parts = b"\n".join(lines[:end]).strip(b"\n")[1:].split(b"\n>")
+    headers = [b">" + part.partition(b"\n")[0] for part in parts]
+    return headers, lambda i: b">" + parts[i] + b"\n", rest
+
+
+def split_fastq(data, final):
+    """Split a block of 4-line FASTQ into records, returning (headers, record, rest)."""
+    lines = data.split(b"\n")
+    if final:
+        while lines and not lines[-1]:
+            lines.pop()
+        complete = len(lines)
+    else:
+        # The last element is an incomplete line, or empty if the block ends with a newline
+        complete = len(lines) - 1
+    end = complete - complete % 4
+    rest = b"\n".join(lines[end:]) if not final else b""
+    headers = lines[0:end:4]
+
+    def record(i):
+        start = 4 * i
+        return b"\n".join(lines[start:start + 4]) + b"\n"
+
+    return headers, record, rest
+
+
+def iter_record_blocks(f, block_size=BLOCK_SIZE):
+    """Yield (headers, record) for every block of complete records in the file, as split_fasta."""
+    block = f.read(block_size)
+    split = split_fastq if block.lstrip()[:1] == b"@" else split_fasta
+    rest = b""
+    while block:
+        headers, record, rest = split(rest + block, final=False)
+        if headers:
+            yield headers, record
+        block = f.read(block_size)
+    headers, record, _ = split(rest, final=True)
+    if headers:
+        yield headers, record
+
+
+def read_ids(headers, prefix_fields):
+    # get rid of IDseq's prefix; read number suffixes are kept
+    return [header.split(b":", prefix_fields)[-1] for header in headers]
+
+
+def mate_ids(identifier):
+    """All the ids the mates of a read can have in the all-reads file."""
+    if identifier[-2:] in READ_NUMBER_SUFFIXES:
+        identifier = identifier[:-2]  # get rid of read number suffix
+    return [identifier] + [identifier + suffix for suffix in READ_NUMBER_SUFFIXES]
+
+
+class HashedIdSet:
+    """Compact set of read ids, stored as a sorted array of 64-bit hashes."""
+
+    def __init__(self, identifiers):
+        self.hashes = array("Q", sorted({self.hash(identifier) for identifier in identifiers}))
+
+    @staticmethod
+    def hash(identifier):
+        return int.from_bytes(hashlib.blake2b(identifier, digest_size=8).digest(), "little")
+
+    def __contains__(self, identifier):
+        value = self.hash(identifier)
+        i = bisect.bisect_left(self.hashes, value)
+        return i < len(self.hashes) and self.hashes[i] == value
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+def read_taxon_ids(path, compact=False):
+    """The ids, with and without read number suffixes, of every mate of the reads in a taxon file.
+
+    Matching the all-reads ids against every suffixed form directly saves normalizing each of them.
+    """
+    with open_reads(path) as f:
+        identifiers = (
+            mate_id
+            for headers, _ in iter_record_blocks(f)
+            for identifier in read_ids(headers, TAXON_PREFIX_FIELDS)
+            for mate_id in mate_ids(identifier)
         )
-        return
+        return HashedIdSet(identifiers) if compact else set(identifiers)
 
-    id_dict = {}
-    taxon_specific_file = open(sys.argv[1], "r")
-    while True:
-        line = taxon_specific_file.readline()
-        read = taxon_specific_file.readline()
-        if not line or not read:
-            break
-        identifier = line.split(":", 16)[-1]  # get rid of IDseq's taxonomic prefix
-        identifier = identifier[:-3]  # get rid of read number suffix and newline
-        id_dict[identifier] = 1
-
-    all_reads_file = open(sys.argv[2], "r")
+
+def extract_pairs(all_reads_path, taxon_ids, out):
+    """Write every record of the all-reads file whose read id is in taxon_ids; returns the count."""
+    with open_reads(all_reads_path) as f:
+        return scan_pairs(f, taxon_ids, out)
+
+
+def scan_pairs(f, taxon_ids, out):
+    matched = 0
+    for headers, record in iter_record_blocks(f):
+        identifiers = read_ids(headers, ALL_READS_PREFIX_FIELDS)
+        matches = compress(range(len(identifiers)), map(taxon_ids.__contains__, identifiers))
+        matches = [record(i) for i in matches]
+        if matches:
+            out.write(b"".join(matches))
+            matched += len(matches)
+    return matched
+
+
+def read_taxon_index(taxon_paths, compact=False):
+    """Map the mate ids of the reads in every taxon file to the tuple of taxa they belong to.
+
+    Taxa are numbered by their position in taxon_paths. With compact, ids are replaced by their
+    64-bit hashes, which take less memory than the ids themselves.
+    """
+    index = {}
+    # Reads in a single taxon, by far the most common case, all share the same tuple
+    taxa_tuples = {}
+    for taxon, path in enumerate(taxon_paths):
+        with open_reads(path) as f:
+            for headers, _ in iter_record_blocks(f):
+                for identifier in read_ids(headers, TAXON_PREFIX_FIELDS):
+                    for mate_id in mate_ids(identifier):
+                        key = HashedIdSet.hash(mate_id) if compact else mate_id
+                        taxa = index.get(key, ())
+                        if taxon not in taxa:
+                            taxa += (taxon,)
+                            index[key] = taxa_tuples.setdefault(taxa, taxa)
+    return index
+
+
+class TaxonWriters:
+    """Buffered output files for many taxa, keeping at most max_open of them open at once."""
+
+    def __init__(self, paths, buffer_size=TAXON_WRITE_BUFFER_SIZE, max_open=MAX_OPEN_TAXON_FILES):
+        self.paths = paths
+        self.buffer_size = buffer_size
+        self.max_open = max_open
+        self.buffers = [[] for _ in paths]
+        self.buffered = [0] * len(paths)
+        self.counts = [0] * len(paths)
+        self.handles = OrderedDict()
+        self.started = set()
+
+    def write(self, taxon, record):
+        self.buffers[taxon].append(record)
+        self.buffered[taxon] += len(record)
+        self.counts[taxon] += 1
+        if self.buffered[taxon] >= self.buffer_size:
+            self.flush(taxon)
+
+    def flush(self, taxon):
+        handle = self.handles.get(taxon)
+        if handle is None:
+            if len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            # Files closed to make room for others are reopened for appending
+            handle = open(self.paths[taxon], "ab" if taxon in self.started else "wb")
+            self.started.add(taxon)
+            self.handles[taxon] = handle
+        else:
+            self.handles.move_to_end(taxon)
+        handle.write(b"".join(self.buffers[taxon]))
+        self.buffers[taxon] = []
+        self.buffered[taxon] = 0
+
+    def close(self):
+        # Flushing every taxon also creates empty files for taxa without any reads
+        for taxon in range(len(self.paths)):
+            self.flush(taxon)
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def extract_taxa(all_reads_path, taxon_index, writers, compact=False):
+    """Route every record of the all-reads file to the writers of the taxa its read id belongs to."""
+    with open_reads(all_reads_path) as f:
+        return scan_taxa(f, taxon_index, writers, compact)
+
+
+def scan_taxa(f, taxon_index, writers, compact=False):
+    for headers, record in iter_record_blocks(f):
+        identifiers = read_ids(headers, ALL_READS_PREFIX_FIELDS)
+        if compact:
+            identifiers = map(HashedIdSet.hash, identifiers)
+        for i, taxa in enumerate(map(taxon_index.get, identifiers)):
+            if taxa:
+                matched_record = record(i)
+                for taxon in taxa:
+                    writers.write(taxon, matched_record)
+    return writers.counts
+
+
+def record_start(mapped, position, fastq):
+    """Offset of the first record that starts at or after position."""
+    if position == 0:
+        return 0
+    size = len(mapped)
+    if not fastq:
+        found = mapped.find(b"\n>", position - 1)
+        return size if found == -1 else found + 1
+    # FASTQ quality lines can start with "@" too, so a header is an "@" line whose next line but one
+    # is the "+" separator; an "@" line too close to the end of the file for that is a quality line
+    line_start = mapped.find(b"\n", position - 1) + 1
+    while 0 < line_start < size:
+        if mapped[line_start] == ord("@"):
+            second_line = mapped.find(b"\n", line_start) + 1
+            third_line = mapped.find(b"\n", second_line) + 1 if second_line else 0
+            if third_line and mapped[third_line:third_line + 1] == b"+":
+                return line_start
+        line_start = mapped.find(b"\n", line_start) + 1
+    return size
+
+
+def chunk_ranges(path, chunks):
+    """Split a file into up to the given number of (start, end) byte ranges aligned to records."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    fastq = reads_format(path) == "fastq"
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        starts = sorted({record_start(mapped, size * i // chunks, fastq) for i in range(chunks)} - {size})
+    return list(zip(starts, starts[1:] + [size]))
+
+
+class MappedRange:
+    """Read-only file-like view of a byte range of a memory-mapped file."""
+
+    def __init__(self, mapped, start, end):
+        self.mapped = mapped
+        self.position = start
+        self.end = end
+
+    def read(self, size=-1):
+        end = self.end if size < 0 else min(self.position + size, self.end)
+        data = self.mapped[self.position:end]
+        self.position = end
+        return data
+
+
+# What a --jobs worker process scans for, set up once by init_scan_worker
+scan_state = {}
+
+
+def init_scan_worker(all_reads_path, taxon_ids, compact):
+    scan_state.update(all_reads_path=all_reads_path, taxon_ids=taxon_ids, compact=compact)
+
+
+def scan_pairs_chunk(start, end, out_path):
+    with open(scan_state["all_reads_path"], "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with open(out_path, "wb", buffering=BLOCK_SIZE) as out:
+            return scan_pairs(MappedRange(mapped, start, end), scan_state["taxon_ids"], out)
+
+
+def scan_taxa_chunk(start, end, out_paths):
+    with open(scan_state["all_reads_path"], "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with TaxonWriters(out_paths) as writers:
+            return scan_taxa(MappedRange(mapped, start, end), scan_state["taxon_ids"], writers, scan_state["compact"])
+
+
+def scan_in_parallel(all_reads_path, taxon_ids, jobs, chunk_outputs, scan_chunk, compact=False):
+    """Run scan_chunk(start, end, outputs) over record-aligned ranges of the file in worker processes.
+
+    chunk_outputs(i) gives the temporary outputs of the i-th range. Returns the results in order.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    ranges = chunk_ranges(all_reads_path, jobs * CHUNKS_PER_JOB)
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=init_scan_worker, initargs=(all_reads_path, taxon_ids, compact)
+    ) as executor:
+        futures = [executor.submit(scan_chunk, start, end, chunk_outputs(i)) for i, (start, end) in enumerate(ranges)]
+        return [future.result() for future in futures]
+
+
+def concatenate(paths, out):
+    for path in paths:
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, out, BLOCK_SIZE)
+
+
+def extract_pairs_parallel(all_reads_path, taxon_ids, out, jobs):
+    if jobs <= 1 or is_compressed(all_reads_path):
+        return extract_pairs(all_reads_path, taxon_ids, out)
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        def chunk_output(i):
+            return os.path.join(tmpdir, f"chunk_{i}")
+
+        counts = scan_in_parallel(all_reads_path, taxon_ids, jobs, chunk_output, scan_pairs_chunk)
+        concatenate([chunk_output(i) for i in range(len(counts))], out)
+    return sum(counts)
+
+
+def extract_taxa_parallel(all_reads_path, taxon_index, output_paths, jobs, compact=False):
+    if jobs <= 1 or is_compressed(all_reads_path):
+        with TaxonWriters(output_paths) as writers:
+            return extract_taxa(all_reads_path, taxon_index, writers, compact)
+    output_dir = os.path.dirname(output_paths[0]) if output_paths else None
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmpdir:
+
+        def chunk_outputs(i):
+            return [os.path.join(tmpdir, f"chunk_{i}_{taxon}") for taxon in range(len(output_paths))]
+
+        chunk_counts = scan_in_parallel(
+            all_reads_path, taxon_index, jobs, chunk_outputs, scan_taxa_chunk, compact
+        )
+        for taxon, output_path in enumerate(output_paths):
+            with open(output_path, "wb") as out:
+                concatenate([chunk_outputs(i)[taxon] for i in range(len(chunk_counts))], out)
+    return [sum(counts) for counts in zip(*chunk_counts)] or [0] * len(output_paths)
+
+
+def read_index_path(all_reads_path):
+    return all_reads_path + READ_INDEX_SUFFIX
+
+
+def build_read_index(all_reads_path, run_size=READ_INDEX_RUN_SIZE):
+    """Write the read id index of an uncompressed all-reads file next to it.
+
+    The (hash, offset, length) entries are sorted run_size at a time, and runs that don't fit are
+    spilled to temporary files next to the index and merged from there, so memory use doesn't grow
+    with the number of reads.
+    """
+    if is_compressed(all_reads_path):
+        raise ValueError(f"{all_reads_path} is gzipped; only uncompressed all-reads files can be indexed")
+    stat = os.stat(all_reads_path)
+    index_path = read_index_path(all_reads_path)
+    index_dir = os.path.dirname(os.path.abspath(index_path))
+    with tempfile.TemporaryDirectory(dir=index_dir) as run_dir:
+        run_paths = []
+        run = []
+        count = offset = 0
+        with open(all_reads_path, "rb") as f:
+            for headers, record in iter_record_blocks(f):
+                for i, identifier in enumerate(read_ids(headers, ALL_READS_PREFIX_FIELDS)):
+                    length = len(record(i))
+                    run.append(READ_INDEX_ENTRY.pack(HashedIdSet.hash(identifier), offset, length))
+                    offset += length
+                    if len(run) == run_size:
+                        run_paths.append(write_index_run(run, os.path.join(run_dir, str(len(run_paths)))))
+                        count += len(run)
+                        run = []
+        run.sort()
+        count += len(run)
+
+        # Written under a temporary name and renamed, so readers never see a partial index
+        fd, tmp_path = tempfile.mkstemp(dir=index_dir)
+        try:
+            with contextlib.ExitStack() as stack:
+                f = stack.enter_context(os.fdopen(fd, "wb"))
+                f.write(READ_INDEX_HEADER.pack(READ_INDEX_MAGIC, count, stat.st_size, stat.st_mtime_ns))
+                runs = [iter_index_run(stack.enter_context(open(path, "rb"))) for path in run_paths]
+                write_index_columns(f, heapq.merge(*runs, run), count)
+            os.replace(tmp_path, index_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def write_index_run(run, path):
+    run.sort()
+    with open(path, "wb") as f:
+        f.writelines(run)
+    return path
+
+
+def iter_index_run(f):
+    """Yield the packed entries of a sorted run file."""
+    size = READ_INDEX_ENTRY.size
     while True:
-        line = all_reads_file.readline()
-        read = all_reads_file.readline()
-        if not line or not read:
-            break
-        identifier = line.split(":", 4)[-1]  # get rid of IDseq prefix
-        identifier = identifier[:-3]  # get rid of read number suffix and newline
-        if identifier in id_dict:
-            print(line[:-1])
-            print(read[:-1])
+        block = f.read(size * READ_INDEX_BATCH_SIZE)
+        if not block:
+            return
+        for i in range(0, len(block), size):
+            yield block[i:i + size]
+
+
+def write_index_columns(f, entries, count):
+    """Write sorted packed entries as the index's hash, offset and length columns, a batch at a time."""
+    column_start = f.tell()
+    f.truncate(column_start + 3 * 8 * count)
+    written = 0
+    for batch in iter(lambda: list(islice(entries, READ_INDEX_BATCH_SIZE)), []):
+        columns = zip(*READ_INDEX_ENTRY.iter_unpack(b"".join(batch)))
+        for column, values in enumerate(columns):
+            f.seek(column_start + 8 * (column * count + written))
+            array("Q", values).tofile(f)
+        written += len(batch)
+
+
+class ReadIndex:
+    """Memory-mapped read id index of an all-reads file, as written by build_read_index.
+
+    Raises ValueError if the index doesn't match the current reads file.
+    """
+
+    def __init__(self, all_reads_path):
+        index_path = read_index_path(all_reads_path)
+        with open(index_path, "rb") as f:
+            self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, size, mtime_ns = READ_INDEX_HEADER.unpack_from(self.mapped)
+        stat = os.stat(all_reads_path)
+        if magic != READ_INDEX_MAGIC or (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            self.mapped.close()
+            raise ValueError(f"{index_path} is not an up to date index of {all_reads_path}")
+        self.table = memoryview(self.mapped)[READ_INDEX_HEADER.size:].cast("Q")
+        self.hashes = self.table[:count]
+        self.offsets = self.table[count:2 * count]
+        self.lengths = self.table[2 * count:]
+
+    def locate(self, value):
+        """(offset, length) of every record whose read id hashes to value."""
+        i = bisect.bisect_left(self.hashes, value)
+        locations = []
+        while i < len(self.hashes) and self.hashes[i] == value:
+            locations.append((self.offsets[i], self.lengths[i]))
+            i += 1
+        return locations
+
+    def close(self):
+        for view in (self.hashes, self.offsets, self.lengths, self.table):
+            view.release()
+        self.mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_read_index(all_reads_path):
+    """The index of the all-reads file, building it first if it's missing or out of date."""
+    try:
+        return ReadIndex(all_reads_path)
+    except (FileNotFoundError, ValueError):
+        build_read_index(all_reads_path)
+        return ReadIndex(all_reads_path)
+
+
+def read_indexed_records(all_reads_path, index, hashes):
+    """Yield (read id, record) for the records whose read ids have the given hashes, in file order."""
+    locations = sorted(set(chain.from_iterable(map(index.locate, hashes))))
+    fd = os.open(all_reads_path, os.O_RDONLY)
+    try:
+        for offset, length in locations:
+            record = os.pread(fd, length, offset)
+            header = record[:record.find(b"\n")]
+            yield read_ids([header], ALL_READS_PREFIX_FIELDS)[0], record
+    finally:
+        os.close(fd)
+
+
+def extract_pairs_indexed(all_reads_path, taxon_ids, out, index):
+    """extract_pairs, reading only the matching records through the all-reads file's index."""
+    hashes = taxon_ids.hashes if isinstance(taxon_ids, HashedIdSet) else map(HashedIdSet.hash, taxon_ids)
+    matched = 0
+    for identifier, record in read_indexed_records(all_reads_path, index, hashes):
+        # Skip records that only share a hash with a taxon read
+        if identifier in taxon_ids:
+            out.write(record)
+            matched += 1
+    return matched
+
+
+def extract_taxa_indexed(all_reads_path, taxon_index, writers, index, compact=False):
+    """extract_taxa, reading only the matching records through the all-reads file's index."""
+    hashes = taxon_index if compact else map(HashedIdSet.hash, taxon_index)
+    for identifier, record in read_indexed_records(all_reads_path, index, hashes):
+        for taxon in taxon_index.get(HashedIdSet.hash(identifier) if compact else identifier, ()):
+            writers.write(taxon, record)
+    return writers.counts
+
+
+def bgzf_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25)
+    return header + compressed + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def bgzf_compress(data, level):
+    # zlib releases the GIL, so batches compress in parallel on a thread pool
+    blocks = range(0, len(data), BGZF_MAX_BLOCK_SIZE)
+    return b"".join(bgzf_block(data[i:i + BGZF_MAX_BLOCK_SIZE], level) for i in blocks)
+
+
+class BgzfWriter:
+    """Binary file writer that compresses to BGZF on an executor, keeping the blocks in order.
+
+    At most max_pending batches are being compressed at a time.
+    """
+
+    def __init__(self, path, executor, level=6, batch_size=COMPRESS_BATCH_SIZE, max_pending=2):
+        self.f = open(path, "wb", buffering=BLOCK_SIZE)
+        self.executor = executor
+        self.level = level
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.buffer = []
+        self.buffered = 0
+        self.pending = deque()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.batch_size:
+            self.submit()
+
+    def submit(self):
+        self.pending.append(self.executor.submit(bgzf_compress, b"".join(self.buffer), self.level))
+        self.buffer = []
+        self.buffered = 0
+        while len(self.pending) > self.max_pending:
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffered:
+            self.submit()
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+        self.f.write(BGZF_EOF)
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MateSplitter:
+    """File-like object that passes /2 records written to it on to r2 and all others to r1.
+
+    Writes don't have to end on record boundaries; close passes on the last record.
+    """
+
+    def __init__(self, r1, r2):
+        self.outputs = (r1, r2)
+        self.split = None
+        self.rest = b""
+
+    def write(self, data):
+        if self.split is None:
+            if not data.strip():
+                return
+            self.split = split_fastq if data.lstrip()[:1] == b"@" else split_fasta
+        headers, record, self.rest = self.split(self.rest + data, final=False)
+        self.route(headers, record)
+
+    def route(self, headers, record):
+        mates = ([], [])
+        for i, header in enumerate(headers):
+            mates[header[-2:] == READ_NUMBER_SUFFIXES[1]].append(record(i))
+        for out, records in zip(self.outputs, mates):
+            if records:
+                out.write(b"".join(records))
+
+    def close(self):
+        if self.rest:
+            self.route(*self.split(self.rest, final=True)[:2])
+            self.rest = b""
+
+
+def read_taxon_map(path):
+    """Read "<taxid>\t<taxon_specific_file>" lines into a list of (taxid, path)."""
+    taxa = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                taxid, taxon_path = line.rstrip("\n").split("\t", 1)
+                taxa.append((taxid, taxon_path))
+    return taxa
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s taxon_specific_file all_reads_file [options]\n"
+        "       %(prog)s all_reads_file --output-dir DIR (--taxon FILE ... | --taxon-map TSV) [options]\n"
+        "       %(prog)s all_reads_file --build-index",
+        description="Show both reads in a paired-end read for every read that mapped to a particular taxon "
+        "(even if only one of the reads mapped to that taxon)."
+    )
+    parser.add_argument("files", nargs="+", metavar="FILE")
+    parser.add_argument("--output", help="Write the records to this file instead of stdout")
+    parser.add_argument("--compact-ids", action="store_true", help="Keep hashed read ids to save memory")
+    parser.add_argument("--taxon", action="append", default=[], help="Taxon specific file to extract pairs for")
+    parser.add_argument("--taxon-map", help="File of <taxid>\\t<taxon_specific_file> lines to extract pairs for")
+    parser.add_argument("--output-dir", help="Directory for the per-taxon outputs of --taxon/--taxon-map")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes to scan the all-reads file with")
+    parser.add_argument(
+        "--index", action="store_true", help="Look reads up in the all-reads file's index instead of scanning it"
+    )
+    parser.add_argument("--build-index", action="store_true", help="Build the index of an all-reads file and exit")
+    parser.add_argument("--r1", help="Write the /1 reads to this BGZF file (needs --r2)")
+    parser.add_argument("--r2", help="Write the /2 reads to this BGZF file (needs --r1)")
+    parser.add_argument(
+        "--threads", type=int, default=os.cpu_count() or 1, help="Number of threads to compress --r1/--r2 with"
+    )
+    parser.add_argument("--compression-level", type=int, default=6, help="gzip level of --r1/--r2")
+    args = parser.parse_args()
+
+    if args.build_index:
+        if len(args.files) != 1:
+            parser.error("--build-index takes a single all_reads_file")
+        build_read_index(args.files[0])
+        return
+    if args.index and is_compressed(args.files[-1]):
+        parser.error("--index needs an uncompressed all_reads_file")
+
+    if args.taxon or args.taxon_map:
+        if len(args.files) != 1 or not args.output_dir:
+            parser.error("--taxon/--taxon-map take a single all_reads_file and need --output-dir")
+        if args.output or args.r1 or args.r2:
+            parser.error("--output and --r1/--r2 only apply to a single taxon_specific_file, not --taxon/--taxon-map")
+        taxa = [(os.path.basename(path).split(".")[0], path) for path in args.taxon]
+        if args.taxon_map:
+            taxa.extend(read_taxon_map(args.taxon_map))
+        # Taxa with the same name would write over each other's output file
+        names = [name for name, _ in taxa]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            parser.error(f"more than one taxon is named {', '.join(duplicates)}; output files are named after taxa")
+        all_reads_file = args.files[0]
+        os.makedirs(args.output_dir, exist_ok=True)
+        extension = reads_format(all_reads_file)
+        output_paths = [os.path.join(args.output_dir, f"{name}.{extension}") for name, _ in taxa]
+        taxon_index = read_taxon_index([path for _, path in taxa], args.compact_ids)
+        if args.index:
+            with open_read_index(all_reads_file) as index, TaxonWriters(output_paths) as writers:
+                extract_taxa_indexed(all_reads_file, taxon_index, writers, index, args.compact_ids)
+        else:
+            extract_taxa_parallel(all_reads_file, taxon_index, output_paths, args.jobs, args.compact_ids)
+        return
+
+    if len(args.files) != 2:
+        parser.error("expected a taxon_specific_file and an all_reads_file")
+    if bool(args.r1) != bool(args.r2) or (args.r1 and args.output):
+        parser.error("--r1 and --r2 go together, instead of --output")
+    taxon_specific_file, all_reads_file = args.files
+    taxon_ids = read_taxon_ids(taxon_specific_file, args.compact_ids)
+    with contextlib.ExitStack() as stack:
+        if args.r1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=args.threads))
+            mates = [
+                stack.enter_context(BgzfWriter(path, executor, args.compression_level, max_pending=args.threads))
+                for path in (args.r1, args.r2)
+            ]
+            out = MateSplitter(*mates)
+            stack.callback(out.close)
+        elif args.output:
+            out = stack.enter_context(open(args.output, "wb", buffering=BLOCK_SIZE))
+        else:
+            out = sys.stdout.buffer
+            stack.callback(out.flush)
+        if args.index:
+            with open_read_index(all_reads_file) as index:
+                extract_pairs_indexed(all_reads_file, taxon_ids, out, index)
+        else:
+            extract_pairs_parallel(all_reads_file, taxon_ids, out, args.jobs)
 
 
 if __name__ == "__main__":